@@ -0,0 +1,689 @@
+import logging
+import asyncio
+import protocol
+import crc
+import cryptUtil
+import database
+import storage
+import storageCodec
+import resumableUploads
+import multiStreamUploads
+import metrics
+import rateLimit
+import time
+import uuid
+from Crypto.Cipher import AES
+from requestHandler import isValidFileName, canReuseKeys, storeBatchFile, saveBatch, checkUploadLimits
+
+#Size of the reads used when streaming file content. Content is a continuous stream, so this is independent of PACKET_SIZE
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+#Per-connection state of the asyncio server
+class AsyncSession:
+    def __init__(self, reader, writer, padResponses=True, timeout=0):
+        self.reader = reader
+        self.writer = writer
+        #Seconds a read or write may wait for the client (0 - no timeout)
+        self.timeout = timeout or None
+        #done is used to indicate wether to expect any more requests on this connection, or not.
+        self.done = False
+        #Responses are padded to PACKET_SIZE, unless large frame mode is negotiated (or padding is disabled)
+        self.padResponses = padResponses
+        #In session mode the connection stays open after the CRC requests
+        self.sessionMode = False
+        #Correlation ID of the current request, if it is pipelined (version 7)
+        self.correlationId = None
+        self.pipelined = False
+        #Received bytes of the current frame which weren't read yet. Requests before version 7 are sent in PACKET_SIZE
+        #frames (padded by some clients), so like requestHandler.Handler a whole frame is received, and its bytes left
+        #after the request (the padding) are discarded. Pipelined requests are read exactly, and their bytes are kept
+        self.frame = b""
+        #Uploads waiting for CRC confirmation before they are promoted to their final path -
+        #(client ID, file name): (temp path, content hash, codec)
+        self.pendingUploads = {}
+
+    #Wait for a read from the client, within the timeout
+    async def wait(self, read):
+        if self.timeout is None:
+            return await read
+        try:
+            return await asyncio.wait_for(read, self.timeout)
+        except asyncio.TimeoutError:
+            raise Exception(f"No data received from the client for {self.timeout} seconds!")
+
+    #Read exactly size bytes - from the current frame first
+    async def read(self, size):
+        if not self.frame:
+            return await self.wait(self.reader.readexactly(size))
+        data = self.frame[:size]
+        self.frame = self.frame[size:]
+        if len(data) < size:
+            data += await self.wait(self.reader.readexactly(size - len(data)))
+        return data
+
+    #Read up to size bytes of what was received (at least one byte). Returns b"" if the connection was closed
+    async def readAvailable(self, size):
+        if not self.frame:
+            return await self.wait(self.reader.read(size))
+        data = self.frame[:size]
+        self.frame = self.frame[size:]
+        return data
+
+    #Read the next chunk of upload content, with contentLeft bytes left. Content of requests before version 7 is received
+    #as it arrives (like requestHandler.Handler receives whole frames), and the bytes past the content (the padding of
+    #the last frame) are discarded. Chunks before the end of the content are whole AES blocks - the rest of the received
+    #bytes stay in the frame for the next read
+    async def readContent(self, contentLeft):
+        if self.pipelined:
+            return await self.read(min(UPLOAD_CHUNK_SIZE, contentLeft))
+        data = await self.readAvailable(UPLOAD_CHUNK_SIZE)
+        if not data:
+            raise asyncio.IncompleteReadError(data, contentLeft)
+        if len(data) >= contentLeft:
+            return data[:contentLeft]
+        if len(data) < AES.block_size:
+            data += await self.read(min(AES.block_size, contentLeft) - len(data))
+        size = len(data) - len(data) % AES.block_size
+        self.frame = data[size:] + self.frame
+        return data[:size]
+
+    #Receive the header of the next request, or None if the connection was closed. Requests before version 7 start a new
+    #frame - the header, and the rest of the frame received with it
+    async def readRequestHeader(self):
+        if self.pipelined:
+            try:
+                data = await self.read(protocol.REQUEST_HEADER.size)
+            except asyncio.IncompleteReadError:
+                return None
+        else:
+            data = await self.readAvailable(protocol.PACKET_SIZE)
+            if not data:
+                return None
+            if len(data) < protocol.REQUEST_HEADER.size:
+                data += await self.read(protocol.REQUEST_HEADER.size - len(data))
+        #Pipelined requests (version 7) have a correlation ID at the end of the header
+        headerSize = protocol.getRequestHeaderSize(data[protocol.VERSION_OFFSET])
+        if headerSize > len(data):
+            data += await self.read(headerSize - len(data))
+        self.frame = data[headerSize:] + self.frame
+        return data[:headerSize]
+
+    #Done with the current request. The rest of its frame is padding, unless requests are pipelined
+    def endRequest(self):
+        if not self.pipelined:
+            self.frame = b""
+
+    #Wait until the write buffer is drained below its limit, within the timeout
+    async def drain(self):
+        if self.timeout is None:
+            return await self.writer.drain()
+        try:
+            return await asyncio.wait_for(self.writer.drain(), self.timeout)
+        except asyncio.TimeoutError:
+            raise Exception(f"Client didn't read responses for {self.timeout} seconds!")
+
+#Asyncio version of requestHandler.Handler. Uses the same protocol classes so both servers are wire compatible.
+#Anything that may block (crypto, CRC, disk and DB writes) is run in the executor, so the event loop is never blocked
+class AsyncHandler:
+    #crcExecutor is used to calculate CRC of large files in parallel. It must not be the same executor as executor,
+    #since chunks processed in executor wait for CRC results
+    #databaseOptions - keyword arguments for database.Database
+    #keyReuseTTL - seconds during which a client presenting the same public key again gets its current AES key (0 to disable)
+    #storageOptions - keyword arguments for storage.Storage
+    #resumeTTL - seconds during which an interrupted upload can be resumed (0 to disable resumable uploads)
+    #responseWindow - maximal number of (PACKET_SIZE) responses to pipelined requests waiting to be written on a connection.
+    #When it is reached, the next requests are not handled until responses are written
+    #multiStreamTTL - seconds after which a multi-stream upload without activity is removed
+    #padResponses - pad responses to PACKET_SIZE (the framing clients expect) until large frame mode is negotiated.
+    #Without it, responses are written without padding and clients read them by their payload size
+    #maxContentSize - maximal size of an upload (0 for no limit)
+    #rateLimitOptions - keyword arguments for rateLimit.ClientRateLimiter
+    #socketTimeout - seconds a read or write may wait for the client before the connection is closed (0 for no timeout)
+    #maxMultiStreamUploads - maximal number of multi-stream uploads in progress per client (0 for no limit)
+    def __init__(self, databaseFile, clientFilesFolder, executor=None, crcExecutor=None, databaseOptions=None, keyReuseTTL=0, storageOptions=None,
+                 resumeTTL=0, responseWindow=16, multiStreamTTL=60 * 60, padResponses=True, maxContentSize=0, rateLimitOptions=None,
+                 socketTimeout=0, maxMultiStreamUploads=0):
+        self.database = database.Database(databaseFile, **(databaseOptions or {}))
+        self.keyReuseTTL = keyReuseTTL
+        self.responseWindow = responseWindow
+        self.padResponses = padResponses
+        self.maxContentSize = maxContentSize
+        self.rateLimiter = rateLimit.ClientRateLimiter(**(rateLimitOptions or {}))
+        self.socketTimeout = socketTimeout
+        self.storage = storage.Storage(clientFilesFolder, **(storageOptions or {}))
+        self.uploads = resumableUploads.ResumableUploads(self.database, self.storage, resumeTTL)
+        self.uploads.removeExpired()
+        self.storage.cleanup(self.uploads.getTempPaths())
+        self.multiStreamUploads = multiStreamUploads.MultiStreamUploads(self.storage, multiStreamTTL, maxContentSize, maxMultiStreamUploads)
+        self.storage.startGarbageCollector(self.database)
+        self.executor = executor
+        self.crcExecutor = crcExecutor
+        self.handlers = {
+            protocol.RequestCode.REQUEST_REGISTRATION.value: self.handleRegistrationRequest,
+            protocol.RequestCode.REQUEST_PUBLIC_KEY.value: self.handlePublicKeyRequest,
+            protocol.RequestCode.REQUEST_SEND_FILE.value: self.handleSendFileRequest,
+            protocol.RequestCode.REQUEST_VALID_CRC.value: self.handleValidCRCRequest,
+            protocol.RequestCode.REQUEST_INVALID_CRC.value: self.handleInvalidCRCRequest,
+            protocol.RequestCode.REQUEST_LAST_INVALID_CRC.value: self.handleLastInvalidCRCRequest,
+            protocol.RequestCode.REQUEST_LARGE_FRAME.value: self.handleLargeFrameRequest,
+            protocol.RequestCode.REQUEST_UPLOAD_OFFSET.value: self.handleUploadOffsetRequest,
+            protocol.RequestCode.REQUEST_RESUME_FILE.value: self.handleResumeFileRequest,
+            protocol.RequestCode.REQUEST_SESSION_MODE.value: self.handleSessionModeRequest,
+            protocol.RequestCode.REQUEST_SEND_BATCH.value: self.handleSendBatchRequest,
+            protocol.RequestCode.REQUEST_OPEN_STREAMS.value: self.handleOpenStreamsRequest,
+            protocol.RequestCode.REQUEST_SEND_SEGMENT.value: self.handleSendSegmentRequest,
+            protocol.RequestCode.REQUEST_CLOSE_STREAMS.value: self.handleCloseStreamsRequest
+        }
+
+    #Run a blocking function in the executor
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    #Write response. Responses are padded to PACKET_SIZE (unless large frame mode is negotiated), same as requestHandler.Handler.write.
+    #Responses are buffered by the transport, so requests are handled while earlier responses are written - the writer
+    #only waits for the buffer to drain above the response window
+    async def write(self, session, data):
+        session.writer.writelines(protocol.getResponseBuffers(data, session.correlationId, session.padResponses))
+        await session.drain()
+
+    #Read the payload of a request with a fixed size payload
+    async def readPayload(self, session, requestHeader):
+        if requestHeader.payloadSize > protocol.PACKET_SIZE:
+            raise Exception(f"Payload size {requestHeader.payloadSize} is too big for request {requestHeader.code}!")
+        return await session.read(requestHeader.payloadSize)
+
+    async def handle(self, reader, writer):
+        session = AsyncSession(reader, writer, self.padResponses, self.socketTimeout)
+        metrics.connectionOpened()
+        try:
+            while not session.done:
+                data = await session.readRequestHeader()
+                if data is None:
+                    break
+                #Parse request header and call the appropriate method to handle the request
+                requestHeader = protocol.RequestHeader()
+                requestHeader.unpack(data)
+                if requestHeader.version >= protocol.PIPELINE_VERSION and not session.pipelined:
+                    session.pipelined = True
+                    writer.transport.set_write_buffer_limits(high=self.responseWindow * protocol.PACKET_SIZE)
+                session.correlationId = requestHeader.correlationId
+                if requestHeader.code in self.handlers.keys():
+                    start = time.perf_counter()
+                    failed = True
+                    try:
+                        await self.handlers[requestHeader.code](session, requestHeader)
+                        failed = False
+                        session.endRequest()
+                    finally:
+                        metrics.recordRequest(requestHeader.code, time.perf_counter() - start, failed)
+                else:
+                    raise Exception(f"Request code {requestHeader.code} doesn't exist!")
+        except Exception as e:
+            #The traceback only at DEBUG level - clients disconnecting mid-request are common
+            logging.error("Exception in handle request: %s", e, exc_info=logging.getLogger().isEnabledFor(logging.DEBUG))
+        finally:
+            metrics.connectionClosed()
+            writer.close()
+            #Uploads that were never confirmed are discarded
+            for tempPath, contentHash, codec in session.pendingUploads.values():
+                await self.run(self.storage.remove, tempPath)
+
+    #Check username is available and store the new client. Runs in the executor, under the DB lock
+    def registerClient(self, name):
+        with self.database.lock:
+            if self.database.getClientByUsername(name) is not None:
+                return None
+            client = database.Client(uuid.uuid4().bytes, name, None, None, None)
+            self.database.storeClient(client)
+            return client
+
+    #Handle registration request
+    async def handleRegistrationRequest(self, session, requestHeader):
+        request = protocol.RegistrationRequest()
+        request.unpack(await self.readPayload(session, requestHeader))
+
+        client = await self.run(self.registerClient, request.name)
+        if client is None:
+            response = protocol.RegistrationFailedResponse()
+            await self.write(session, response.pack())
+            return
+
+        response = protocol.RegistrationSuccessResponse()
+        response.clientID = client.ID
+        await self.write(session, response.pack())
+        logging.info("Successful registration of client: %s", client.Name)
+
+    #Generate and store new AES key for client (unless the current one can be reused), and return it encrypted with the client public key
+    def exchangeKeys(self, client, publicKey):
+        if canReuseKeys(client, publicKey, self.keyReuseTTL):
+            AESKey = client.AES
+        else:
+            AESKey = cryptUtil.generateAESKey()
+            self.database.setClientKeys(client, publicKey, AESKey)
+            self.uploads.discardClient(client)
+        return cryptUtil.encryptWithPublicKey(AESKey, client.PublicKey)
+
+    #Handle key exchange request
+    async def handlePublicKeyRequest(self, session, requestHeader):
+        data = await self.readPayload(session, requestHeader)
+        client = await self.run(self.database.getClientById, requestHeader.clientID)
+        if client is None:
+            raise Exception(f"User with id {requestHeader.clientID} doesn't exist!")
+
+        await self.run(self.database.updateClientLastSeen, client)
+
+        request = protocol.PublicKeyRequest()
+        request.unpack(data)
+
+        response = protocol.AESKeyResponse()
+        response.clientID = client.ID
+        response.AESKey = await self.run(self.exchangeKeys, client, request.publicKey)
+        await self.write(session, response.pack())
+        logging.info("Successful registration of encryption keys for client: %s", client.Name)
+
+    #Decrypt a chunk, update CRC calculation and write decrypted data to the file, adding the time of each stage to times
+    #(metrics.UploadTimes). Runs in the executor
+    def processChunk(self, decryptor, cksum, file, data, isLastBlock, times):
+        start = time.perf_counter()
+        decrypted = decryptor.decrypt(data, isLastBlock)
+        decryptEnd = time.perf_counter()
+        cksum.update(decrypted)
+        crcEnd = time.perf_counter()
+        file.write(decrypted)
+        times.decrypt += decryptEnd - start
+        times.crc += crcEnd - decryptEnd
+        times.write += time.perf_counter() - crcEnd
+        return len(decrypted)
+
+    #Handle new file request
+    async def handleSendFileRequest(self, session, requestHeader):
+        request = protocol.SendFileRequest()
+        request.unpack(await session.read(request.SIZE))
+
+        client = await self.run(self.database.getClientById, requestHeader.clientID)
+        if client is None:
+            raise Exception(f"User with id {requestHeader.clientID} doesn't exist!")
+
+        await self.run(self.database.updateClientLastSeen, client)
+
+        #Make sure keys were exchanged for this client (otherwise we can't decrypt the file..)
+        if client.AES is None:
+            raise Exception(f"User with id {requestHeader.clientID} doesn't have AES key yet!")
+
+        if not isValidFileName(request.fileName):
+            raise Exception(f"Filename {request.fileName} is invalid!")
+
+        checkUploadLimits(client, request.contentSize, self.maxContentSize, self.rateLimiter)
+
+        #A new upload of the file replaces its interrupted upload
+        await self.run(self.uploads.discard, client, request.fileName)
+
+        #Create the file on the server. The upload is written to a temp file, so the previous version stays intact until it is replaced.
+        #It is compressed while it is written if the storage codec of the file isn't CODEC_NONE
+        codec = self.storage.getCodec(client, request.fileName)
+        file, tempPath = await self.run(self.storage.createTempFile, client.ID, request.fileName, codec)
+
+        cksum = self.storage.createChecksum(crc.createChecksum(request.contentSize, self.crcExecutor))
+        decryptor = cryptUtil.AESDecrypt(client.AES)
+        await self.receiveUpload(session, client, request, codec, file, tempPath, decryptor, cksum, resumableUploads.UploadProgress())
+
+    #Handle resume file request (version 5) - the rest of the content of an interrupted upload
+    async def handleResumeFileRequest(self, session, requestHeader):
+        if requestHeader.version < protocol.RESUME_VERSION:
+            raise Exception(f"Resuming uploads requires version {protocol.RESUME_VERSION}, got {requestHeader.version}!")
+
+        request = protocol.ResumeFileRequest()
+        request.unpack(await session.read(request.SIZE))
+
+        client = await self.run(self.database.getClientById, requestHeader.clientID)
+        if client is None:
+            raise Exception(f"User with id {requestHeader.clientID} doesn't exist!")
+
+        await self.run(self.database.updateClientLastSeen, client)
+
+        if client.AES is None:
+            raise Exception(f"User with id {requestHeader.clientID} doesn't have AES key yet!")
+
+        if not isValidFileName(request.fileName):
+            raise Exception(f"Filename {request.fileName} is invalid!")
+
+        checkUploadLimits(client, request.contentSize - request.offset, self.maxContentSize, self.rateLimiter)
+
+        #Continue writing the temp file, decryption and CRC calculation from where the upload was interrupted
+        file, tempPath, decryptor, cksum, progress = await self.run(self.uploads.resume, client, request, self.crcExecutor)
+        await self.receiveUpload(session, client, request, storageCodec.CODEC_NONE, file, tempPath, decryptor, cksum, progress)
+
+    #Handle upload offset request (version 5) - how much of an interrupted upload can be skipped when it is resumed
+    async def handleUploadOffsetRequest(self, session, requestHeader):
+        data = await self.readPayload(session, requestHeader)
+        if requestHeader.version < protocol.RESUME_VERSION:
+            raise Exception(f"Resuming uploads requires version {protocol.RESUME_VERSION}, got {requestHeader.version}!")
+
+        client = await self.run(self.database.getClientById, requestHeader.clientID)
+        if client is None:
+            raise Exception(f"User with id {requestHeader.clientID} doesn't exist!")
+
+        request = protocol.UploadOffsetRequest()
+        request.unpack(data)
+
+        response = protocol.UploadOffsetResponse()
+        response.clientID = client.ID
+        response.fileName = request.fileName
+        response.contentSize, response.offset = self.uploads.getOffset(client, request.fileName)
+        await self.write(session, response.pack())
+
+    #Read upload content (from progress.offset), decrypt it, update CRC calculation with each incoming chunk and write it
+    #to the temp file, then promote the upload (now or on CRC confirmation) and respond with the CRC. An interrupted
+    #upload is kept to be resumed later, if possible
+    async def receiveUpload(self, session, client, request, codec, file, tempPath, decryptor, cksum, progress):
+        bytesRead = progress.offset
+        times = metrics.UploadTimes()
+        startOffset, startSize = progress.offset, progress.decryptedSize
+        try:
+            while bytesRead < request.contentSize:
+                start = time.perf_counter()
+                chunk = await session.readContent(request.contentSize - bytesRead)
+                times.recv += time.perf_counter() - start
+                bytesRead += len(chunk)
+                progress.decryptedSize += await self.run(self.processChunk, decryptor, cksum, file, chunk, bytesRead == request.contentSize, times)
+                progress.offset = bytesRead
+            times.record(progress.offset - startOffset, progress.decryptedSize - startSize)
+            start = time.perf_counter()
+            await self.run(self.storage.syncFile, file)
+            metrics.recordStage("sync", time.perf_counter() - start)
+        except Exception:
+            await self.run(self.uploads.interrupt, client, request, codec, file, tempPath, progress, decryptor, cksum)
+            raise
+        finally:
+            await self.run(file.close)
+
+        await self.completeUpload(session, client, request.fileName, tempPath, cksum, codec, bytesRead, progress.decryptedSize)
+
+    #Promote a received upload (now or on CRC confirmation) and respond with its CRC
+    async def completeUpload(self, session, client, fileName, tempPath, cksum, codec, contentSize, decryptedSize):
+        #Promote the upload now, or when the client confirms the CRC
+        contentHash = self.storage.getContentHash(cksum, codec)
+        if self.storage.promoteOnVerify:
+            previous = session.pendingUploads.pop((client.ID, fileName), None)
+            if previous is not None:
+                await self.run(self.storage.remove, previous[0])
+            session.pendingUploads[(client.ID, fileName)] = (tempPath, contentHash, codec)
+        else:
+            await self.run(self.promoteUpload, client, tempPath, fileName, contentHash, codec)
+
+        #Send response to client
+        response = protocol.FileReceivedResponse()
+        response.clientID = client.ID
+        response.contentSize = contentSize
+        response.fileName = fileName + "\0" #Protocol requires to return filename as it was received from client - with null terminator
+        response.checksum = cksum.digest()
+        await self.write(session, response.pack())
+        logging.info("Successful file upload for client: %s, Name: %s, Content size(Encrypted): %d, Content size(Decrypted): %d, Checksum: %d, Codec: %s",
+                     client.Name, fileName, contentSize, decryptedSize, response.checksum, codec)
+
+    #Get the client of a multi-stream upload request (version 8), which must have an AES key
+    async def getMultiStreamClient(self, requestHeader):
+        if requestHeader.version < protocol.MULTI_STREAM_VERSION:
+            raise Exception(f"Multi-stream uploads require version {protocol.MULTI_STREAM_VERSION}, got {requestHeader.version}!")
+
+        client = await self.run(self.database.getClientById, requestHeader.clientID)
+        if client is None:
+            raise Exception(f"User with id {requestHeader.clientID} doesn't exist!")
+
+        await self.run(self.database.updateClientLastSeen, client)
+
+        if client.AES is None:
+            raise Exception(f"User with id {requestHeader.clientID} doesn't have AES key yet!")
+        return client
+
+    #Handle open streams request (version 8) - start a multi-stream upload, whose segments may be sent on any connection
+    async def handleOpenStreamsRequest(self, session, requestHeader):
+        data = await self.readPayload(session, requestHeader)
+        client = await self.getMultiStreamClient(requestHeader)
+
+        request = protocol.OpenStreamsRequest()
+        request.unpack(data)
+
+        if not isValidFileName(request.fileName):
+            raise Exception(f"Filename {request.fileName} is invalid!")
+
+        checkUploadLimits(client, request.fileSize, self.maxContentSize, self.rateLimiter)
+
+        upload = await self.run(self.multiStreamUploads.open, client, request.fileName, request.fileSize, request.segmentSize)
+
+        response = protocol.StreamsOpenedResponse()
+        response.clientID = client.ID
+        response.uploadID = upload.uploadId
+        response.segmentCount = upload.segmentCount
+        await self.write(session, response.pack())
+        logging.info("Multi-stream upload of file %s for client %s opened: %d bytes in %d segments", request.fileName, client.Name, request.fileSize, upload.segmentCount)
+
+    #Handle send segment request (version 8) - read a segment, encrypted with its own IV, and write it at its offset
+    async def handleSendSegmentRequest(self, session, requestHeader):
+        request = protocol.SendSegmentRequest()
+        request.unpack(await session.read(request.SIZE))
+        client = await self.getMultiStreamClient(requestHeader)
+
+        upload = self.multiStreamUploads.get(client, request.uploadID, request.fileName)
+        writer = upload.startSegment(request.segmentIndex)
+        cksum = crc.createChecksum(request.contentSize, self.crcExecutor)
+        decryptor = cryptUtil.AESDecrypt(client.AES, request.iv)
+        bytesRead = 0
+        decryptedSize = 0
+        times = metrics.UploadTimes()
+        try:
+            while bytesRead < request.contentSize:
+                start = time.perf_counter()
+                chunk = await session.readContent(request.contentSize - bytesRead)
+                times.recv += time.perf_counter() - start
+                bytesRead += len(chunk)
+                decryptedSize += await self.run(self.processChunk, decryptor, cksum, writer, chunk, bytesRead == request.contentSize, times)
+        except Exception:
+            upload.finishSegment(request.segmentIndex)
+            raise
+        times.record(bytesRead, decryptedSize)
+        await self.run(upload.finishSegment, request.segmentIndex, cksum, request.contentSize)
+
+        response = protocol.SegmentReceivedResponse()
+        response.clientID = client.ID
+        response.uploadID = upload.uploadId
+        response.segmentIndex = request.segmentIndex
+        response.checksum = cksum.digest()
+        await self.write(session, response.pack())
+
+    #Combine the CRCs of the segments of a complete multi-stream upload (and hash its content for the deduplicated
+    #store) and sync its file. Runs in the executor
+    def finishMultiStreamUpload(self, upload):
+        try:
+            cksum = self.storage.createChecksum(crc.Checksum())
+            self.storage.restoreChecksum(cksum, upload.getChecksum().getState(), upload.file, upload.fileSize)
+            self.storage.syncFile(upload.file)
+        except Exception:
+            self.storage.remove(upload.tempPath)
+            raise
+        finally:
+            upload.file.close()
+        return cksum
+
+    #Handle close streams request (version 8) - complete a multi-stream upload whose segments were all received. Its CRC
+    #is combined from the CRCs of the segments, and it is confirmed with the CRC requests like any upload
+    async def handleCloseStreamsRequest(self, session, requestHeader):
+        data = await self.readPayload(session, requestHeader)
+        client = await self.getMultiStreamClient(requestHeader)
+
+        request = protocol.CloseStreamsRequest()
+        request.unpack(data)
+
+        upload = self.multiStreamUploads.take(client, request.uploadID, request.fileName)
+        await self.run(self.uploads.discard, client, request.fileName)
+        cksum = await self.run(self.finishMultiStreamUpload, upload)
+        await self.completeUpload(session, client, request.fileName, upload.tempPath, cksum, storageCodec.CODEC_NONE, upload.encryptedSize, upload.fileSize)
+
+    #Move upload to its final path and store it in the DB. Runs in the executor
+    def promoteUpload(self, client, tempPath, fileName, contentHash=None, codec=storageCodec.CODEC_NONE, verified=False):
+        start = time.perf_counter()
+        filePath = self.storage.getFilePath(client.ID, fileName)
+        self.storage.promote(tempPath, filePath, contentHash)
+        self.database.saveFile(client, filePath, fileName, contentHash, codec, verified)
+        metrics.recordStage("commit", time.perf_counter() - start)
+
+    #Handle CRC valid request
+    async def handleValidCRCRequest(self, session, requestHeader):
+        data = await self.readPayload(session, requestHeader)
+        client = await self.run(self.database.getClientById, requestHeader.clientID)
+        if client is None:
+            raise Exception(f"User with id {requestHeader.clientID} doesn't exist!")
+
+        await self.run(self.database.updateClientLastSeen, client)
+
+        request = protocol.CRCRequest()
+        request.unpack(data)
+
+        #An upload promoted now is stored as verified right away (a single DB write)
+        pending = session.pendingUploads.pop((client.ID, request.fileName), None)
+        if pending is not None:
+            await self.run(self.promoteUpload, client, pending[0], request.fileName, pending[1], pending[2], True)
+
+        file = await self.run(self.database.getFile, client, request.fileName)
+
+        if file is None:
+            raise Exception(f"File {request.fileName} doesn't exist for client {client.Name}!")
+
+        if not file.Verified:
+            await self.run(self.database.verifyFile, file)
+
+        response = protocol.MessageReceivedResponse()
+        await self.write(session, response.pack())
+        logging.info("Successful validation of CRC of file: %s for client %s", file.FileName, client.Name)
+        session.done = not session.sessionMode
+
+    #Remove file from disk and DB. Runs in the executor
+    def removeFile(self, file, filePath):
+        self.storage.remove(filePath)
+        self.database.removeFile(file)
+
+    # Handle CRC invalid request
+    async def handleInvalidCRCRequest(self, session, requestHeader):
+        data = await self.readPayload(session, requestHeader)
+        client = await self.run(self.database.getClientById, requestHeader.clientID)
+        if client is None:
+            raise Exception(f"User with id {requestHeader.clientID} doesn't exist!")
+
+        await self.run(self.database.updateClientLastSeen, client)
+
+        request = protocol.CRCRequest()
+        request.unpack(data)
+
+        #An upload that wasn't promoted yet is just discarded - the previous version of the file stays as it was
+        pending = session.pendingUploads.pop((client.ID, request.fileName), None)
+        if pending is not None:
+            await self.run(self.storage.remove, pending[0])
+        else:
+            file = await self.run(self.database.getFile, client, request.fileName)
+
+            if file is None:
+                raise Exception(f"File {request.fileName} doesn't exist for client {client.Name}!")
+            if file.Verified:
+                raise Exception(f"File {request.fileName} for client {client.Name} is alrealy verified!")
+
+            await self.run(self.removeFile, file, self.storage.getFilePath(client.ID, request.fileName))
+
+        response = protocol.MessageReceivedResponse()
+        await self.write(session, response.pack())
+        logging.info("File: %s of client %s removed due to invalid CRC", request.fileName, client.Name)
+
+    # Handle last CRC invalid request (No more attempts to send the file are expected)
+    async def handleLastInvalidCRCRequest(self, session, requestHeader):
+        await self.handleInvalidCRCRequest(session, requestHeader)
+        logging.info("Last invalid CRC. No more attempts expected")
+        session.done = not session.sessionMode
+
+    #Handle large frame mode request (version 4). File content is always streamed in UPLOAD_CHUNK_SIZE reads here,
+    #so this only switches off response padding (starting with this response)
+    async def handleLargeFrameRequest(self, session, requestHeader):
+        data = await self.readPayload(session, requestHeader)
+        if requestHeader.version < protocol.LARGE_FRAME_VERSION:
+            raise Exception(f"Large frame mode requires version {protocol.LARGE_FRAME_VERSION}, got {requestHeader.version}!")
+
+        request = protocol.LargeFrameRequest()
+        request.unpack(data)
+        session.padResponses = False
+
+        response = protocol.LargeFrameResponse()
+        response.frameSize = max(protocol.PACKET_SIZE, min(request.frameSize, protocol.MAX_LARGE_FRAME_SIZE))
+        await self.write(session, response.pack())
+
+    #Handle session mode request (version 6) - keep the connection open after CRC requests, until the client closes it
+    async def handleSessionModeRequest(self, session, requestHeader):
+        await self.readPayload(session, requestHeader)
+        if requestHeader.version < protocol.SESSION_VERSION:
+            raise Exception(f"Session mode requires version {protocol.SESSION_VERSION}, got {requestHeader.version}!")
+
+        session.sessionMode = True
+        response = protocol.SessionModeResponse()
+        await self.write(session, response.pack())
+
+    #Replace unconfirmed and interrupted uploads of the stored files of a batch with them, and save them. Runs in the executor
+    def replaceWithBatch(self, session, client, storedFiles):
+        for tempPath, fileName, contentHash, codec in storedFiles:
+            pending = session.pendingUploads.pop((client.ID, fileName), None)
+            if pending is not None:
+                self.storage.remove(pending[0])
+            self.uploads.discard(client, fileName)
+        saveBatch(self.storage, self.database, client, storedFiles)
+
+    #Handle send batch request (version 6). All files are received before any of them is promoted, so an interrupted batch
+    #changes nothing. The files with a valid CRC are then saved together, and the status of each file is returned
+    async def handleSendBatchRequest(self, session, requestHeader):
+        if requestHeader.version < protocol.SESSION_VERSION:
+            raise Exception(f"Batch uploads require version {protocol.SESSION_VERSION}, got {requestHeader.version}!")
+
+        request = protocol.SendBatchRequest()
+        request.unpack(await session.read(request.SIZE))
+
+        client = await self.run(self.database.getClientById, requestHeader.clientID)
+        if client is None:
+            raise Exception(f"User with id {requestHeader.clientID} doesn't exist!")
+
+        await self.run(self.database.updateClientLastSeen, client)
+
+        if client.AES is None:
+            raise Exception(f"User with id {requestHeader.clientID} doesn't have AES key yet!")
+
+        checkUploadLimits(client, requestHeader.payloadSize, self.maxContentSize, self.rateLimiter, request.fileCount)
+
+        response = protocol.BatchReceivedResponse()
+        response.clientID = client.ID
+        storedFiles = []
+        #Bytes of the payload left to read - the files can't go past it, so they are within the checked limits
+        payloadLeft = requestHeader.payloadSize - request.SIZE
+        try:
+            for i in range(request.fileCount):
+                fileHeader = protocol.BatchFileHeader()
+                payloadLeft -= fileHeader.SIZE
+                if payloadLeft < 0:
+                    raise Exception("Request payload is shorter than its content!")
+                fileHeader.unpack(await session.read(fileHeader.SIZE))
+                payloadLeft -= fileHeader.contentSize
+                if payloadLeft < 0:
+                    raise Exception("Request payload is shorter than its content!")
+                content = await session.read(fileHeader.contentSize)
+                status, checksum, stored = await self.run(storeBatchFile, self.storage, client, fileHeader, content)
+                response.files.append((fileHeader.fileName, status, checksum))
+                if stored is not None:
+                    storedFiles.append(stored)
+        except Exception:
+            for stored in storedFiles:
+                await self.run(self.storage.remove, stored[0])
+            raise
+
+        await self.run(self.replaceWithBatch, session, client, storedFiles)
+
+        await self.write(session, response.pack())
+        logging.info("Successful batch upload for client: %s, Files: %d, Saved: %d", client.Name, request.fileCount, len(storedFiles))
+
+    #Flush pending storage and DB updates. Should be called on shutdown
+    def close(self):
+        self.multiStreamUploads.close()
+        self.storage.close()
+        self.database.close()
@@ -0,0 +1,97 @@
+import asyncRequestHandler
+import logging
+import metrics
+import serverLogging
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+DATABASE_FILE = "server.db"
+CLIENT_FILES_FILDER = "files"
+QUEUE_SIZE = 100
+#Maximum number of open connections. Connections above it are closed as soon as they are accepted
+MAX_CONNECTIONS = 10000
+#Seconds a read or write may wait for the client (including the first request of a connection) before the connection
+#is closed (0 - no timeout)
+SOCKET_TIMEOUT = 120
+#Maximal size of an upload - larger uploads are rejected before their content is read, and multi-stream uploads before
+#their file is preallocated (0 - no limit)
+MAX_CONTENT_SIZE = 2 * 1024 * 1024 * 1024
+#Upload rate limits per client (rateLimit.ClientRateLimiter): uploads and bytes per second (0 - no limit), and their bursts
+RATE_LIMIT_OPTIONS = {"uploadsPerSecond": 50, "uploadBurst": 200, "bytesPerSecond": 64 * 1024 * 1024, "byteBurst": 256 * 1024 * 1024}
+#Number of threads used for blocking work (crypto, CRC, disk and DB writes). Connections themselves don't take a thread
+MAX_WORKERS = 32
+#Number of threads calculating CRC of large uploads in parallel with receiving them (0 to calculate inline)
+CRC_WORKERS = 4
+#Database options. With lazyLoad the server starts without loading the whole DB, and caches up to cacheSize entries
+DATABASE_OPTIONS = {"lazyLoad": False, "cacheSize": 100000, "warmUp": True}
+#Seconds during which a client presenting the same public key again gets its current AES key (0 - always a new key)
+KEY_REUSE_TTL = 0
+#Storage options. Uploads are promoted to their final path with an atomic rename on CRC confirmation (promoteOnVerify),
+#fsyncPolicy is one of storage.FSYNC_NONE, FSYNC_FILE, FSYNC_FULL, FSYNC_BATCHED.
+#With dedupe, identical content is stored once (client files are hard links to a content addressed store).
+#compression chooses the storage codec (storageCodec.CODEC_*) of uploads - by client name, else by file extension, else default
+STORAGE_OPTIONS = {"fsyncPolicy": "batched", "promoteOnVerify": True, "dedupe": False,
+                   "compression": {"default": "none", "extensions": {}, "clients": {}}}
+#Seconds during which an interrupted upload is kept so the client can resume it (0 - interrupted uploads are discarded)
+RESUME_TTL = 24 * 60 * 60
+#Maximal number of responses to pipelined requests (protocol version 7) waiting to be written on a connection
+RESPONSE_WINDOW = 16
+#Seconds after which a multi-stream upload (protocol version 8) without activity is removed
+MULTI_STREAM_TTL = 60 * 60
+#Maximal number of multi-stream uploads in progress per client - their files are preallocated when they start, up to
+#MAX_CONTENT_SIZE each (0 - no limit)
+MAX_MULTI_STREAM_UPLOADS = 4
+#Pad responses to 1024 bytes (protocol.PACKET_SIZE), the framing current clients expect. Disable only when all clients
+#read responses by their payload size
+PAD_RESPONSES = True
+#Metrics (metrics.py) are served in the Prometheus text format at http://localhost:port/metrics (port 0 - disabled),
+#and/or written to dumpFile every dumpInterval seconds
+METRICS_OPTIONS = {"port": 0, "dumpFile": None, "dumpInterval": 60}
+#Logging (serverLogging.py): records are written by a background thread to file (stdout if None). Errors from the same
+#place in the code are limited to errorsPerMinute, and records are dropped if more than queueSize are waiting
+LOG_OPTIONS = {"level": "INFO", "file": None, "queueSize": 10000, "errorsPerMinute": 10}
+
+#Asyncio front end, alternative to server.startServer. Idle connections only cost a coroutine, so it scales to many connections
+async def serve(host, port, maxWorkers):
+    executor = ThreadPoolExecutor(max_workers=maxWorkers)
+    crcExecutor = ThreadPoolExecutor(max_workers=CRC_WORKERS) if CRC_WORKERS > 0 else None
+    handler = asyncRequestHandler.AsyncHandler(DATABASE_FILE, CLIENT_FILES_FILDER, executor, crcExecutor, DATABASE_OPTIONS, KEY_REUSE_TTL, STORAGE_OPTIONS,
+                                               RESUME_TTL, RESPONSE_WINDOW, MULTI_STREAM_TTL,
+                                               PAD_RESPONSES, MAX_CONTENT_SIZE, RATE_LIMIT_OPTIONS, SOCKET_TIMEOUT,
+                                               MAX_MULTI_STREAM_UPLOADS)
+    connections = 0
+
+    #Handle a connection, unless there are MAX_CONNECTIONS already
+    async def admit(reader, writer):
+        nonlocal connections
+        if connections >= MAX_CONNECTIONS:
+            writer.close()
+            metrics.connectionRejected("limit")
+            return
+        connections += 1
+        try:
+            await handler.handle(reader, writer)
+        finally:
+            connections -= 1
+
+    server = await asyncio.start_server(admit, host, port, backlog=QUEUE_SIZE)
+    logging.info("Server (asyncio) is listening for connections on port %d...", port)
+    exporter = metrics.MetricsExporter(**METRICS_OPTIONS)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        exporter.close()
+        #Flush write-behind storage and DB updates
+        handler.close()
+
+
+def startServer(host, port, maxWorkers=MAX_WORKERS):
+    serverLogging.start(**LOG_OPTIONS)
+    try:
+        asyncio.run(serve(host, port, maxWorkers))
+    except Exception as e:
+        logging.error("Server start error: %s", e)
+    finally:
+        serverLogging.stop()
@@ -0,0 +1,70 @@
+#Benchmark of the upload storage stage with each storage codec against the raw path (CODEC_NONE):
+#plaintext -> CRC -> (compress) -> temp file -> fsync, like handleSendFileRequest after decryption.
+#Usage: python benchmarkCompression.py [size in MiB (default 64)]
+import os
+import sys
+import tempfile
+import time
+import crc
+import storage
+import storageCodec
+
+CHUNK_SIZE = 256 * 1024
+BENCHMARK_CLIENT_ID = bytes(16)
+
+#Compressible data (repeated log-like lines) and incompressible data (random bytes)
+def generateData(size):
+    line = b"2024-01-01 12:00:00 INFO request handled for client 0123456789abcdef in 12 ms\n"
+    text = bytearray()
+    i = 0
+    while len(text) < size:
+        text += line.replace(b"12 ms", str(i % 1000).encode() + b" ms")
+        i += 1
+    return {"text": bytes(text[:size]), "random": os.urandom(size)}
+
+#Store data with codec like an upload. Returns seconds and the number of bytes on disk
+def storeUpload(fileStorage, data, codec):
+    start = time.perf_counter()
+    file, tempPath = fileStorage.createTempFile(BENCHMARK_CLIENT_ID, "bench.bin", codec)
+    cksum = crc.createChecksum(len(data))
+    view = memoryview(data)
+    for offset in range(0, len(data), CHUNK_SIZE):
+        chunk = view[offset:offset + CHUNK_SIZE]
+        cksum.update(chunk)
+        file.write(chunk)
+    fileStorage.syncFile(file)
+    file.close()
+    seconds = time.perf_counter() - start
+    storedSize = os.path.getsize(tempPath)
+    verify(tempPath, data, codec)
+    os.remove(tempPath)
+    return seconds, storedSize
+
+#Make sure the stored file decompresses to the original data
+def verify(path, data, codec):
+    with open(path, "rb") as file:
+        stored = file.read()
+    if codec != storageCodec.CODEC_NONE:
+        stored = storageCodec.createDecompressor(codec).decompress(stored)
+    if stored != data:
+        raise Exception(f"Stored content of codec {codec} doesn't match the original!")
+
+def main():
+    size = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 64 * 1024 * 1024
+    codecs = [codec for codec in storageCodec.CODECS if storageCodec.isAvailable(codec)]
+    with tempfile.TemporaryDirectory() as folder:
+        fileStorage = storage.Storage(folder, fsyncPolicy=storage.FSYNC_FILE)
+        for kind, data in generateData(size).items():
+            print(f"{kind} data, {size // (1024 * 1024)} MiB:")
+            rawSeconds = None
+            for codec in codecs:
+                seconds, storedSize = storeUpload(fileStorage, data, codec)
+                if rawSeconds is None:
+                    rawSeconds = seconds
+                print(f"  {codec:5} {size / seconds / (1024 * 1024):8.1f} MiB/s ({rawSeconds / seconds:5.2f}x raw), "
+                      f"written {storedSize / (1024 * 1024):8.1f} MiB ({storedSize / size:6.1%})")
+        fileStorage.close()
+
+
+if __name__ == '__main__':
+    main()
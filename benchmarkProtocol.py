@@ -0,0 +1,92 @@
+#Microbenchmark of protocol message parsing and packing: the cost per request type (creating the message and unpacking
+#it from a received buffer) and per response type (creating the message and packing it, with the correlation ID and
+#padding buffers of a pipelined response).
+#Usage: python benchmarkProtocol.py [iterations (default 200000)]
+import struct
+import sys
+import timeit
+import protocol
+
+CLIENT_ID = bytes(range(16))
+UPLOAD_ID = bytes(range(16, 32))
+FILE_NAME = b"benchmark.bin".ljust(protocol.FILE_NAME_SIZE, b"\0")
+
+#Received buffers of each request type - memoryviews over a larger buffer, like the payload of a received packet
+def createRequests():
+    def received(data):
+        return memoryview(bytearray(data) + bytearray(protocol.PACKET_SIZE))
+    return {
+        "RequestHeader": (protocol.RequestHeader, received(CLIENT_ID + struct.pack("<BHL", 3, 1103, 275))),
+        "RequestHeader (pipelined)": (protocol.RequestHeader, received(CLIENT_ID + struct.pack("<BHLL", 7, 1103, 275, 1))),
+        "RegistrationRequest": (protocol.RegistrationRequest, received(b"benchmark".ljust(protocol.NAME_SIZE, b"\0"))),
+        "PublicKeyRequest": (protocol.PublicKeyRequest, received(b"benchmark".ljust(protocol.NAME_SIZE, b"\0") + bytes(protocol.PUBLIC_KEY_SIZE))),
+        "SendFileRequest": (protocol.SendFileRequest, received(CLIENT_ID + struct.pack("<L", 1024) + FILE_NAME)),
+        "ResumeFileRequest": (protocol.ResumeFileRequest, received(CLIENT_ID + struct.pack("<L", 1024) + FILE_NAME + struct.pack("<L", 512))),
+        "CRCRequest": (protocol.CRCRequest, received(CLIENT_ID + FILE_NAME)),
+        "SendBatchRequest": (protocol.SendBatchRequest, received(CLIENT_ID + struct.pack("<L", 100))),
+        "BatchFileHeader": (protocol.BatchFileHeader, received(struct.pack("<L", 1024) + FILE_NAME + struct.pack("<L", 1))),
+        "OpenStreamsRequest": (protocol.OpenStreamsRequest, received(CLIENT_ID + struct.pack("<QL", 1 << 30, 1 << 24) + FILE_NAME)),
+        "SendSegmentRequest": (protocol.SendSegmentRequest, received(CLIENT_ID + UPLOAD_ID + struct.pack("<LL", 1, 1024) + bytes(16) + FILE_NAME)),
+        "CloseStreamsRequest": (protocol.CloseStreamsRequest, received(CLIENT_ID + UPLOAD_ID + FILE_NAME)),
+        "LargeFrameRequest": (protocol.LargeFrameRequest, received(struct.pack("<L", 256 * 1024))),
+    }
+
+def parse(cls, data):
+    request = cls()
+    request.unpack(data)
+    return request
+
+#Functions creating and packing each response type
+def createResponses():
+    def fileReceived():
+        response = protocol.FileReceivedResponse()
+        response.clientID = CLIENT_ID
+        response.contentSize = 1024
+        response.fileName = "benchmark.bin\0"
+        response.checksum = 12345
+        return response.pack()
+
+    def aesKey():
+        response = protocol.AESKeyResponse()
+        response.clientID = CLIENT_ID
+        response.AESKey = bytes(128)
+        return response.pack()
+
+    def segmentReceived():
+        response = protocol.SegmentReceivedResponse()
+        response.clientID = CLIENT_ID
+        response.uploadID = UPLOAD_ID
+        response.segmentIndex = 1
+        response.checksum = 12345
+        return response.pack()
+
+    def batchReceived():
+        response = protocol.BatchReceivedResponse()
+        response.clientID = CLIENT_ID
+        response.files = [(f"file{i}.bin", 0, i) for i in range(100)]
+        return response.pack()
+
+    return {
+        "MessageReceivedResponse": lambda: protocol.MessageReceivedResponse().pack(),
+        "FileReceivedResponse": fileReceived,
+        "FileReceivedResponse (pipelined)": lambda: protocol.getResponseBuffers(fileReceived(), 1),
+        "AESKeyResponse": aesKey,
+        "SegmentReceivedResponse": segmentReceived,
+        "BatchReceivedResponse (100 files)": batchReceived,
+    }
+
+def report(name, iterations, seconds):
+    print(f"  {name:36} {seconds / iterations * 1e9:8.0f} ns")
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    print(f"Parse ({iterations} iterations):")
+    for name, (cls, data) in createRequests().items():
+        report(name, iterations, timeit.timeit(lambda: parse(cls, data), number=iterations))
+    print(f"Pack ({iterations} iterations):")
+    for name, pack in createResponses().items():
+        report(name, iterations, timeit.timeit(pack, number=iterations))
+
+
+if __name__ == '__main__':
+    main()
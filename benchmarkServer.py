@@ -0,0 +1,262 @@
+#End to end benchmark of the server: synthetic clients speaking the version 3 protocol (registration, RSA key exchange,
+#SEND_FILE encrypted with AES-CBC, CRC confirmation) run concurrently against a server started on localhost in a child
+#process (in a temp folder, so it has its own DB and files). Scenarios:
+#  small    - small-file storm: every client uploads many small files, each on its own connection
+#  huge     - a single huge file
+#  register - registration burst: every client registers (and exchanges keys) many times
+#Reports throughput, p50/p99 latency per request code (from sending the request until its response is received), and
+#the server CPU time per GB uploaded (Linux only - read from /proc). Only the timed phase of a scenario is measured -
+#clients are registered and their files encrypted before it starts.
+#Usage: python benchmarkServer.py [--scenario small|huge|register|all] [--clients N] [--files N] [--file-size BYTES]
+#                                 [--huge-size MiB] [--registrations N] [--async]
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.PublicKey import RSA
+from Crypto.Util.Padding import pad
+import crc
+import protocol
+
+SERVER_START_TIMEOUT = 10
+CLIENT_VERSION = protocol.SERVER_VERSION
+
+#Run the server in the child process, in folder
+def runServer(folder, port, useAsync):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(folder)
+    #Server output (a line per request) would drown the report, and stopping the server can interrupt any request
+    sys.stdout = sys.stderr = open(os.devnull, "w")
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if useAsync:
+        import asyncServer
+        asyncServer.startServer("localhost", port)
+    else:
+        import server
+        server.startServer("localhost", port)
+
+#Server running in a child process, for the duration of a scenario
+class ServerProcess:
+    def __init__(self, useAsync):
+        self.folder = tempfile.TemporaryDirectory()
+        with socket.socket() as sock:
+            sock.bind(("localhost", 0))
+            self.port = sock.getsockname()[1]
+        self.process = multiprocessing.Process(target=runServer, args=(self.folder.name, self.port, useAsync))
+
+    def start(self):
+        self.process.start()
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(("localhost", self.port)).close()
+                return
+            except OSError:
+                if time.monotonic() > deadline or not self.process.is_alive():
+                    raise Exception("Server didn't start!")
+                time.sleep(0.05)
+
+    #User and system CPU seconds of the server so far (None where /proc is not available)
+    def getCPUTime(self):
+        try:
+            with open(f"/proc/{self.process.pid}/stat") as stat:
+                fields = stat.read().rpartition(")")[2].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (OSError, ValueError):
+            return None
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+        self.folder.cleanup()
+
+#Synthetic version 3 client. Latencies of its requests are collected per request code
+class BenchmarkClient:
+    def __init__(self, port, name, rsaKey):
+        self.port = port
+        self.name = name
+        self.rsaKey = rsaKey
+        self.clientID = bytes(protocol.CLIENT_ID_SIZE)
+        self.AESKey = None
+        self.latencies = defaultdict(list)
+
+    def connect(self):
+        sock = socket.create_connection(("localhost", self.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def receive(self, sock, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise Exception("Connection closed by the server!")
+            data += chunk
+        return data
+
+    #Send a request (payload and content) and receive its response. Returns the response payload
+    def request(self, sock, code, payload, expectedCode, content=b""):
+        start = time.perf_counter()
+        sock.sendall(protocol.REQUEST_HEADER.pack(self.clientID, CLIENT_VERSION, code, len(payload) + len(content)) + payload)
+        if content:
+            sock.sendall(content)
+        response = self.receive(sock, protocol.PACKET_SIZE)
+        self.latencies[code].append(time.perf_counter() - start)
+        version, responseCode, payloadSize = protocol.RESPONSE_HEADER.unpack_from(response)
+        if responseCode != expectedCode:
+            raise Exception(f"Request {code} got response {responseCode} instead of {expectedCode}!")
+        return response[protocol.RESPONSE_HEADER.size:protocol.RESPONSE_HEADER.size + payloadSize]
+
+    #Register and exchange keys, on one connection
+    def register(self):
+        name = self.name.encode("utf-8").ljust(protocol.NAME_SIZE, b"\0")
+        with self.connect() as sock:
+            self.clientID = bytes(self.request(sock, protocol.RequestCode.REQUEST_REGISTRATION.value, name,
+                                               protocol.ResponseCode.RESPONSE_REGISTRATION_SUCCESS.value)[:protocol.CLIENT_ID_SIZE])
+            publicKey = self.rsaKey.publickey().export_key("DER")
+            response = self.request(sock, protocol.RequestCode.REQUEST_PUBLIC_KEY.value, name + publicKey,
+                                    protocol.ResponseCode.RESPONSE_AES_KEY.value)
+            self.AESKey = PKCS1_OAEP.new(self.rsaKey).decrypt(bytes(response[protocol.CLIENT_ID_SIZE:]))
+
+    #Encrypt file content like the client does - AES-CBC with a zero IV
+    def encrypt(self, content):
+        return AES.new(self.AESKey, AES.MODE_CBC, bytes(AES.block_size)).encrypt(pad(content, AES.block_size))
+
+    #Upload an encrypted file and confirm its CRC, on one connection (the server closes it after the confirmation)
+    def upload(self, fileName, encrypted, checksum):
+        name = fileName.encode("utf-8").ljust(protocol.FILE_NAME_SIZE, b"\0")
+        with self.connect() as sock:
+            response = self.request(sock, protocol.RequestCode.REQUEST_SEND_FILE.value,
+                                    self.clientID + struct.pack("<L", len(encrypted)) + name,
+                                    protocol.ResponseCode.RESPONSE_FILE_RECEIVED.value, encrypted)
+            received = struct.unpack_from("<L", response, protocol.CLIENT_ID_SIZE + protocol.CONTENT_SIZE_SIZE + protocol.FILE_NAME_SIZE)[0]
+            if received != checksum:
+                raise Exception(f"Server CRC of {fileName} is {received} instead of {checksum}!")
+            self.request(sock, protocol.RequestCode.REQUEST_VALID_CRC.value, self.clientID + name,
+                         protocol.ResponseCode.RESPONSE_MESSAGE_RECEIVED.value)
+
+def getChecksum(content):
+    cksum = crc.Checksum()
+    cksum.update(content)
+    return cksum.digest()
+
+#Run func(client) for every client on its own thread. Raises the first client error
+def runClients(clients, func):
+    errors = []
+    def run(client):
+        try:
+            func(client)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def createClients(port, count, prefix):
+    #RSA keys are slow to generate, and the server doesn't care if clients share one
+    rsaKey = RSA.generate(1024, e=17)
+    return [BenchmarkClient(port, f"{prefix}{i}_{os.urandom(4).hex()}", rsaKey) for i in range(count)]
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def report(name, clients, seconds, cpuSeconds, operations, uploadedBytes):
+    print(f"{name}: {len(clients)} client(s), {seconds:.2f} s")
+    print(f"  throughput: {operations / seconds:10.1f} ops/s", end="")
+    if uploadedBytes:
+        print(f", {uploadedBytes / seconds / (1024 * 1024):8.1f} MiB/s", end="")
+    print()
+    if cpuSeconds is not None:
+        print(f"  server CPU: {cpuSeconds:.2f} s", end="")
+        if uploadedBytes:
+            print(f", {cpuSeconds / (uploadedBytes / 1e9):.2f} s/GB", end="")
+        print()
+    latencies = defaultdict(list)
+    for client in clients:
+        for code, values in client.latencies.items():
+            latencies[code] += values
+    for code in sorted(latencies):
+        values = latencies[code]
+        print(f"  {protocol.RequestCode(code).name:26} {len(values):7} requests, p50 {percentile(values, 0.5) * 1000:8.2f} ms, "
+              f"p99 {percentile(values, 0.99) * 1000:8.2f} ms")
+
+#Run the timed phase of a scenario against server, and report it
+def measure(name, server, clients, func, operations, uploadedBytes):
+    for client in clients:
+        client.latencies.clear()
+    cpuStart = server.getCPUTime()
+    start = time.perf_counter()
+    runClients(clients, func)
+    seconds = time.perf_counter() - start
+    cpuEnd = server.getCPUTime()
+    report(name, clients, seconds, cpuEnd - cpuStart if cpuStart is not None and cpuEnd is not None else None, operations, uploadedBytes)
+
+def smallFileStorm(server, args):
+    clients = createClients(server.port, args.clients, "small")
+    runClients(clients, BenchmarkClient.register)
+    files = {}
+    for client in clients:
+        contents = [os.urandom(args.file_size) for i in range(args.files)]
+        files[client] = [(f"small{i}.bin", client.encrypt(content), getChecksum(content)) for i, content in enumerate(contents)]
+    def uploadFiles(client):
+        for fileName, encrypted, checksum in files[client]:
+            client.upload(fileName, encrypted, checksum)
+    measure("Small-file storm", server, clients, uploadFiles, args.clients * args.files, args.clients * args.files * args.file_size)
+
+def hugeFile(server, args):
+    clients = createClients(server.port, 1, "huge")
+    runClients(clients, BenchmarkClient.register)
+    size = args.huge_size * 1024 * 1024
+    content = os.urandom(size)
+    encrypted = clients[0].encrypt(content)
+    checksum = getChecksum(content)
+    del content
+    measure("Huge file", server, clients, lambda client: client.upload("huge.bin", encrypted, checksum), 1, size)
+
+def registrationBurst(server, args):
+    clients = createClients(server.port, args.clients, "register")
+    def registerAll(client):
+        for i in range(args.registrations):
+            client.name = f"{client.name.rpartition('_')[0]}_{os.urandom(4).hex()}"
+            client.register()
+    measure("Registration burst", server, clients, registerAll, args.clients * args.registrations, 0)
+
+SCENARIOS = {"small": smallFileStorm, "huge": hugeFile, "register": registrationBurst}
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end benchmark of the backup server")
+    parser.add_argument("--scenario", choices=list(SCENARIOS) + ["all"], default="all")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--files", type=int, default=50, help="files per client in the small-file storm")
+    parser.add_argument("--file-size", type=int, default=4096, help="size of the small files in bytes")
+    parser.add_argument("--huge-size", type=int, default=256, help="size of the huge file in MiB")
+    parser.add_argument("--registrations", type=int, default=10, help="registrations per client in the registration burst")
+    parser.add_argument("--async", dest="useAsync", action="store_true", help="benchmark the asyncio server")
+    args = parser.parse_args()
+
+    scenarios = SCENARIOS if args.scenario == "all" else {args.scenario: SCENARIOS[args.scenario]}
+    for scenario in scenarios.values():
+        #Each scenario gets a new server, so it starts from an empty DB
+        server = ServerProcess(args.useAsync)
+        server.start()
+        try:
+            scenario(server, args)
+        finally:
+            server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,14 @@
 #Some solution I found on the internet for calculating same value luke cksum on linux.
 #Seems to work from my testing, but I don't really know how to verify that since its very complicated..
+#
+#The table loop is kept as a fallback. The default engine runs the same CRC through zlib.crc32 (native speed):
+#cksum uses the non reflected CRC-32 polynomial, while zlib computes the reflected one, so the bits of every
+#input byte and of the CRC register are reversed before and after calling zlib. The result is bit identical.
+
+try:
+    import zlib
+except ImportError:
+    zlib = None
 
 crctab = [
     0x00000000,
@@ -262,18 +271,83 @@ crctab = [
 
 UNSIGNED = lambda n: n & 0xFFFFFFFF
 
+POLY = 0x104C11DB7
+
+#Bit reversal of every byte value, used with bytes.translate
+REVERSED_BYTES = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
+#Reverse the bits of a 32 bit value
+def reverse32(n):
+    return int.from_bytes(n.to_bytes(4, "big").translate(REVERSED_BYTES), "little")
+
+#Table driven update (pure python fallback)
+def updateTable(crc, buf):
+    for c in buf:
+        crc = crctab[(crc >> 24) ^ c] ^ ((crc << 8) & 0xFFFFFFFF)
+    return crc
+
+#zlib update. zlib applies ~ before and after, so it is undone on both sides
+def updateZlib(crc, buf):
+    if not isinstance(buf, (bytes, bytearray)):
+        buf = bytes(buf)
+    reflected = zlib.crc32(buf.translate(REVERSED_BYTES), reverse32(crc) ^ 0xFFFFFFFF) ^ 0xFFFFFFFF
+    return reverse32(reflected)
+
+ENGINE = "zlib" if zlib is not None else "table"
+ENGINES = {"table": updateTable}
+if zlib is not None:
+    ENGINES["zlib"] = updateZlib
+
+#Multiply two polynomials modulo POLY
+def multiplyMod(a, b):
+    result = 0
+    while b:
+        if b & 1:
+            result ^= a
+        b >>= 1
+        a <<= 1
+        if a & 0x100000000:
+            a ^= POLY
+    return result
+
+#x^(8 * length) modulo POLY - shifting a CRC register over length zero bytes
+def shiftFactor(length):
+    result = 1
+    base = 0x100 #x^8
+    while length:
+        if length & 1:
+            result = multiplyMod(result, base)
+        base = multiplyMod(base, base)
+        length >>= 1
+    return result
+
+#Combine CRC registers (before digest) of two consecutive chunks into the register of both chunks together.
+#length2 is the length of the second chunk in bytes
+def combine(crc1, crc2, length2):
+    return multiplyMod(crc1, shiftFactor(length2)) ^ crc2
+
 class Checksum:
-    def __init__(self):
+    def __init__(self, engine=None):
         self.nchars = 0
         self.crc = 0
+        self.updateCrc = ENGINES[engine or ENGINE]
 
     def update(self, buf):
-        crc = self.crc
-        for c in buf:
-            crc = crctab[(crc >> 24) ^ c] ^ ((crc << 8) & 0xFFFFFFFF)
-        self.crc = crc
+        self.crc = self.updateCrc(self.crc, buf)
         self.nchars += len(buf)
 
+    #Append the state of a checksum calculated over the data that follows this checksum data
+    def combine(self, other):
+        self.crc = combine(self.crc, other.crc, other.nchars)
+        self.nchars += other.nchars
+
+    #CRC register and length of the data so far. A checksum continues from that point after setState
+    def getState(self):
+        return self.crc, self.nchars
+
+    def setState(self, state):
+        self.crc, self.nchars = state
+
     def digest(self):
         crc = self.crc
         n = self.nchars
@@ -281,4 +355,68 @@ class Checksum:
             c = n & 0xFF
             crc = crctab[(crc >> 24) ^ c] ^ ((crc << 8) & 0xFFFFFFFF)
             n >>= 8
-        return UNSIGNED(~crc)
\ No newline at end of file
+        return UNSIGNED(~crc)
+
+#Calculate CRC register and length of a single chunk. Module level so it can also run in a process pool
+def checksumChunk(buf):
+    checksum = Checksum()
+    checksum.update(buf)
+    return checksum.crc, checksum.nchars
+
+#Checksum with the same API as Checksum, which calculates the CRC of chunks in an executor (thread or process pool)
+#and combines the partial results in order. Updates are collected into chunks of chunkSize bytes before submitting,
+#and at most maxPending chunks are in flight, which bounds memory use.
+class ParallelChecksum:
+    def __init__(self, executor, chunkSize=1024 * 1024, maxPending=8):
+        self.executor = executor
+        self.chunkSize = chunkSize
+        self.maxPending = maxPending
+        self.buffer = bytearray()
+        self.pending = []
+        self.result = Checksum()
+
+    def update(self, buf):
+        self.buffer += buf
+        if len(self.buffer) >= self.chunkSize:
+            self.submit()
+
+    def submit(self):
+        self.pending.append(self.executor.submit(checksumChunk, bytes(self.buffer)))
+        self.buffer.clear()
+        while len(self.pending) > self.maxPending:
+            self.collect(self.pending.pop(0))
+
+    #Append the result of a finished chunk to the result
+    def collect(self, future):
+        crc, nchars = future.result()
+        self.result.crc = combine(self.result.crc, crc, nchars)
+        self.result.nchars += nchars
+
+    #Wait for all chunks and append them to the result
+    def collectAll(self):
+        if self.buffer:
+            self.submit()
+        for future in self.pending:
+            self.collect(future)
+        self.pending = []
+
+    def getState(self):
+        self.collectAll()
+        return self.result.getState()
+
+    def setState(self, state):
+        self.collectAll()
+        self.result.setState(state)
+
+    def digest(self):
+        self.collectAll()
+        return self.result.digest()
+
+#Content at least this big is checksummed in parallel (when an executor is available)
+PARALLEL_MIN_SIZE = 4 * 1024 * 1024
+
+#Create checksum for content of the given size. Large content is checksummed in parallel if an executor is given
+def createChecksum(size, executor=None):
+    if executor is not None and size >= PARALLEL_MIN_SIZE:
+        return ParallelChecksum(executor)
+    return Checksum()
\ No newline at end of file
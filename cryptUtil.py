@@ -1,5 +1,7 @@
 import protocol
 import os
+import threading
+from collections import OrderedDict
 from Crypto.Cipher import AES
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_OAEP
@@ -10,16 +12,47 @@ import base64
 def generateAESKey():
     return os.urandom(protocol.AES_KEY_SIZE)
 
+#Bounded LRU cache of RSA (PKCS1_OAEP) ciphers keyed by the public key bytes, so a key is only imported once
+#while it is in the cache. hits and misses count cache lookups
+class PublicKeyCache:
+    def __init__(self, maxSize=1024):
+        self.maxSize = maxSize
+        self.ciphers = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def getCipher(self, publicKey):
+        publicKey = bytes(publicKey)
+        with self.lock:
+            cipher = self.ciphers.get(publicKey)
+            if cipher is not None:
+                self.ciphers.move_to_end(publicKey)
+                self.hits += 1
+                return cipher
+            self.misses += 1
+
+        cipher = PKCS1_OAEP.new(RSA.importKey(publicKey))
+        with self.lock:
+            self.ciphers[publicKey] = cipher
+            while len(self.ciphers) > self.maxSize:
+                self.ciphers.popitem(last=False)
+        return cipher
+
+publicKeyCache = PublicKeyCache()
+
 #Returns content encrypted using RSA with publicKey
 def encryptWithPublicKey(content, publicKey):
-    key = RSA.importKey(publicKey)
-    cipher = PKCS1_OAEP.new(key)
-    return cipher.encrypt(content)
+    return publicKeyCache.getCipher(publicKey).encrypt(content)
 
+#CBC decryption of a stream of content. lastBlock is the last ciphertext block decrypted so far (the CBC chaining state):
+#decryption of the rest of the content can be continued later by a decryptor created with iv=lastBlock
 class AESDecrypt:
-    def __init__(self, AESKey):
-        iv = b'\0' * AES.block_size  # Default zero
+    def __init__(self, AESKey, iv=None):
+        if iv is None:
+            iv = b'\0' * AES.block_size  # Default zero
         self.cipher = AES.new(AESKey, AES.MODE_CBC, iv)
+        self.lastBlock = iv
 
     #Get number of bytes to decrypt, from total bytes (must be a multiple of block size)
     def getBytesToDecrypt(self, totalBytes):
@@ -27,7 +60,29 @@ class AESDecrypt:
 
     #Decrypt data in buffer, with optional unpadding (should be true for the last block of the data)
     def decrypt(self, buffer, shouldUnpad = False):
+        if len(buffer) >= AES.block_size:
+            self.lastBlock = bytes(buffer[-AES.block_size:])
         decrypted = self.cipher.decrypt(buffer)
         if shouldUnpad:
             decrypted = unpad(decrypted, AES.block_size)
-        return decrypted
\ No newline at end of file
+        return decrypted
+
+    #Decrypt data in buffer into a preallocated output buffer (at least as big as buffer), without allocating memory.
+    #Returns the number of decrypted bytes written to output - after unpadding, if shouldUnpad is true
+    def decryptInto(self, buffer, output, shouldUnpad = False):
+        size = len(buffer)
+        if size >= AES.block_size:
+            self.lastBlock = bytes(buffer[size - AES.block_size:size])
+        self.cipher.decrypt(buffer, output=output[:size])
+        if shouldUnpad:
+            size = getUnpaddedSize(output, size)
+        return size
+
+#Get the size of PKCS7 padded data in buffer (of given size) after removing the padding
+def getUnpaddedSize(buffer, size):
+    if size == 0 or size % AES.block_size:
+        raise ValueError("Input data is not padded")
+    padding = buffer[size - 1]
+    if padding < 1 or padding > AES.block_size or buffer[size - padding:size] != bytes([padding]) * padding:
+        raise ValueError("Padding is incorrect.")
+    return size - padding
\ No newline at end of file
@@ -1,6 +1,10 @@
 import logging
 import sqlite3
+import threading
+import time
+import metrics
 import protocol
+from collections import OrderedDict
 from datetime import datetime
 
 #Data model for client
@@ -11,42 +15,149 @@ class Client:
         self.PublicKey = publicKey
         self.LastSeen = lastSeen
         self.AES = AESKey
+        #Time (time.monotonic) the keys were set while the server is running. Not stored in the DB
+        self.KeysTime = None
 
     def __repr__(self):
-        return f"{self.ID}, {self.Name}, {self.LastSeen}\n--PublicKey: {self.PublicKey}\n--AESKey: {self.AES}"
+        #Keys are never formatted, so they can't end up in logs
+        return f"{self.ID.hex()}, {self.Name}, {self.LastSeen}, keys: {'yes' if self.AES is not None else 'no'}"
 
 #Data model for file
 class File:
-    def __init__(self, clientId, fileName, pathName, verified):
+    def __init__(self, clientId, fileName, pathName, verified, contentHash=None, codec=None):
         self.ID = clientId
         self.FileName = fileName
         self.PathName = pathName
         self.Verified = verified
+        #Hash of the content in the deduplicated store (None if the file is not in the store)
+        self.Hash = contentHash
+        #Storage codec the file is stored with (storageCodec.CODEC_*, None for files stored before codecs existed - raw)
+        self.Codec = codec
 
     def __repr__(self):
         return f"{self.ID}, {self.FileName}, {self.PathName}, {self.Verified}"
 
+#Data model for an interrupted upload, kept so it can be resumed. The temp file holds decryptedSize bytes of plaintext,
+#decrypted from the first offset bytes of the encrypted content (of contentSize bytes). lastBlock (the last ciphertext
+#block before offset) and crc (the CRC register of the plaintext) are the decryption and checksum state at that point.
+#Time is when the upload was interrupted (time.time())
+class Upload:
+    def __init__(self, clientId, fileName, tempPath, contentSize, offset, decryptedSize, lastBlock, crc, uploadTime):
+        self.ID = clientId
+        self.FileName = fileName
+        self.TempPath = tempPath
+        self.ContentSize = contentSize
+        self.Offset = offset
+        self.DecryptedSize = decryptedSize
+        self.LastBlock = lastBlock
+        self.CRC = crc
+        self.Time = uploadTime
+
+    def __repr__(self):
+        return f"{self.ID}, {self.FileName}, {self.Offset}/{self.ContentSize}"
+
+# Create Client from a DB row. Remove null terminator from client name
+def clientFromRow(row):
+    return Client(row[0], row[1].partition('\0')[0], row[2], row[3], row[4])
+
+#Create File from a DB row. Remove null terminator from file name and path name
+def fileFromRow(row):
+    return File(row[0], row[1].partition('\0')[0], row[2].partition('\0')[0], row[3], row[4], row[5])
+
+def uploadFromRow(row):
+    return Upload(*row)
+
+#Memory cache dict. If maxSize is set, the least recently used entries are evicted when it is full
+class Cache:
+    def __init__(self, maxSize=None):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None and self.maxSize is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.evict()
+
+    #Add value if key is not in the cache yet. Returns the cached value
+    def setDefault(self, key, value):
+        with self.lock:
+            value = self.entries.setdefault(key, value)
+            self.evict()
+            return value
+
+    #Remove key, only if it is mapped to value
+    def remove(self, key, value):
+        with self.lock:
+            if self.entries.get(key) is value:
+                del self.entries[key]
+
+    def evict(self):
+        if self.maxSize is not None:
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
 
 #Database handler (SQLite persistent storage with in-memory cache)
 #SQLite DB is loaded into memory on load
 #Updates and inserts are done both on SQLite and memory cache, selects are performed directly from memory
+#The memory cache is indexed with dicts - clients by ID and by name, files by (client ID, file name)
+#With lazyLoad, nothing is loaded on startup, so the server starts serving immediately. The memory cache is then
+#a bounded LRU cache of cacheSize entries, filled on demand from SQLite (and from a background warm-up if warmUp is set)
+#The memory cache is shared by all connections, so updates to it are guarded by a lock
+#A single SQLite connection (WAL journal) is kept open for the lifetime of the server and shared by all threads.
+#LastSeen updates are write-behind: they are collected and committed together in one transaction, every
+#lastSeenFlushInterval seconds or once lastSeenBatchSize clients are pending, and on close()
+#Interrupted uploads are few, so they are always fully loaded, indexed by (client ID, file name)
 class Database:
     CLIENTS_TABLE = 'clients'
     FILES_TABLE = 'files'
+    OBJECTS_TABLE = 'objects'
+    UPLOADS_TABLE = 'uploads'
 
-    def __init__(self, name):
+    #synchronous - SQLite synchronous setting (OFF, NORMAL or FULL). NORMAL is safe with WAL, but the last
+    #transactions may be lost on power failure
+    def __init__(self, name, synchronous="NORMAL", lastSeenFlushInterval=1.0, lastSeenBatchSize=100, lazyLoad=False, cacheSize=100000, warmUp=False):
         self.name = name
-        self.clients = []
-        self.files = []
+        self.lazyLoad = lazyLoad
+        maxSize = cacheSize if lazyLoad else None
+        self.clients = Cache(maxSize)
+        self.clientsByName = Cache(maxSize)
+        self.files = Cache(maxSize)
+        self.uploads = {}
+        self.lock = threading.RLock()
+        self.connLock = threading.RLock()
+        self.synchronous = synchronous
+        self.lastSeenFlushInterval = lastSeenFlushInterval
+        self.lastSeenBatchSize = lastSeenBatchSize
+        self.pendingLastSeen = {}
+        self.closed = threading.Event()
+        self.conn = self.connect()
         self.initialize()
+        if lazyLoad and warmUp:
+            threading.Thread(target=self.warmUp, daemon=True).start()
+        self.flushThread = threading.Thread(target=self.flushLoop, daemon=True)
+        self.flushThread.start()
 
     def connect(self):
-        conn = sqlite3.connect(self.name)
+        conn = sqlite3.connect(self.name, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
         return conn
 
     #Initialize SQLite DB (if doesn't exist), and load DB into memory cache if it already exists
     def initialize(self):
-        conn = self.connect()
+        conn = self.conn
 
         #Create tables in DB if don't exist
         conn.executescript(f"""
@@ -64,92 +175,283 @@ class Database:
                  PathName CHAR({protocol.PATH_NAME_SIZE}) NOT NULL,
                  Verified BOOLEAN NOT NULL
                );
+
+               CREATE TABLE IF NOT EXISTS {Database.OBJECTS_TABLE}(
+                 Hash CHAR(64) NOT NULL PRIMARY KEY,
+                 RefCount INTEGER NOT NULL
+               );
+
+               CREATE TABLE IF NOT EXISTS {Database.UPLOADS_TABLE}(
+                 ID CHAR({protocol.CLIENT_ID_SIZE}) NOT NULL,
+                 FileName CHAR({protocol.FILE_NAME_SIZE}) NOT NULL,
+                 TempPath CHAR({protocol.PATH_NAME_SIZE}) NOT NULL,
+                 ContentSize INTEGER NOT NULL,
+                 Offset INTEGER NOT NULL,
+                 DecryptedSize INTEGER NOT NULL,
+                 LastBlock CHAR({protocol.AES_KEY_SIZE}) NOT NULL,
+                 CRC INTEGER NOT NULL,
+                 Time REAL NOT NULL,
+                 PRIMARY KEY (ID, FileName)
+               );
+
+               CREATE INDEX IF NOT EXISTS {Database.CLIENTS_TABLE}_name ON {Database.CLIENTS_TABLE}(Name);
                """)
+
+        #Unique (ID, FileName) index for saveFile upserts. DBs created before the index existed may contain duplicates
+        #of a file (shouldn't happen, but then the index can't be created), so only the last entry of each is kept.
+        #This migration runs once - while the index doesn't exist
+        index = f"{Database.FILES_TABLE}_id_filename"
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", [index]).fetchone() is None:
+            conn.execute(f"DELETE FROM {Database.FILES_TABLE} WHERE rowid NOT IN (SELECT MAX(rowid) FROM {Database.FILES_TABLE} GROUP BY ID, FileName)")
+            conn.execute(f"CREATE UNIQUE INDEX {index} ON {Database.FILES_TABLE}(ID, FileName)")
+
+        #Content hash of files in the deduplicated store. Added to DBs created before it existed
+        columns = [column[1] for column in conn.execute(f"PRAGMA table_info({Database.FILES_TABLE})")]
+        if "Hash" not in columns:
+            conn.execute(f"ALTER TABLE {Database.FILES_TABLE} ADD COLUMN Hash CHAR(64)")
+        #Storage codec of files. Added to DBs created before it existed
+        if "Codec" not in columns:
+            conn.execute(f"ALTER TABLE {Database.FILES_TABLE} ADD COLUMN Codec CHAR(8)")
         conn.commit()
 
+        for row in conn.execute(f"SELECT * FROM {Database.UPLOADS_TABLE}"):
+            upload = uploadFromRow(row)
+            self.uploads[(upload.ID, upload.FileName)] = upload
+
+        if self.lazyLoad:
+            logging.info("DB is loaded lazily into memory cache")
+            return
+
         #Load DB into memory cache
+        start = time.perf_counter()
         cur = conn.cursor()
         cur.execute(f"SELECT * FROM {Database.CLIENTS_TABLE}")
-        results = cur.fetchall()
-        for client in results:
-            # Remove null terminator from client name
-            c = Client(client[0], client[1].partition('\0')[0], client[2], client[3], client[4])
-            self.clients.append(c)
-            print(f"Loaded client from DB: {c}\n")
+        for row in cur:
+            self.addClient(clientFromRow(row))
 
         cur.execute(f"SELECT * FROM {Database.FILES_TABLE}")
-        results = cur.fetchall()
-        for file in results:
-            #Remove null terminator from file name and path name
-            f = File(file[0], file[1].partition('\0')[0], file[2].partition('\0')[0], file[3])
-            self.files.append(f)
-            print(f"Loaded file from DB: {f}\n")
-
-        conn.close()
+        for row in cur:
+            f = fileFromRow(row)
+            self.files.put((f.ID, f.FileName), f)
+        logging.info("Loaded %d clients and %d files from DB in %.2f seconds", len(self.clients), len(self.files), time.perf_counter() - start)
 
-    def execute(self, query, args):
-        conn = self.connect()
+    #Load the most recently seen clients and their files into the memory cache, on a separate connection.
+    #Runs in the background while the server is already serving
+    def warmUp(self):
+        start = time.perf_counter()
+        conn = sqlite3.connect(self.name)
         try:
-            cur = conn.cursor()
-            cur.execute(query, args)
-            conn.commit()
+            limit = self.clients.maxSize
+            clients = [clientFromRow(row) for row in conn.execute(f"SELECT * FROM {Database.CLIENTS_TABLE} ORDER BY LastSeen DESC LIMIT ?", [limit])]
+            for client in clients:
+                self.addClient(client)
+            files = conn.execute(f"""SELECT f.* FROM {Database.FILES_TABLE} f JOIN
+                                     (SELECT ID FROM {Database.CLIENTS_TABLE} ORDER BY LastSeen DESC LIMIT ?) c ON f.ID = c.ID
+                                     LIMIT ?""", [limit, self.files.maxSize])
+            for row in files:
+                f = fileFromRow(row)
+                self.files.setDefault((f.ID, f.FileName), f)
+            logging.info("DB cache warm-up loaded %d clients and %d files in %.2f seconds", len(clients), len(self.files), time.perf_counter() - start)
         except Exception as e:
-            logging.exception(f'Exception while updating the DB: {e}')
-        conn.close()
+            logging.exception('Exception while warming up DB cache: %s', e)
+        finally:
+            conn.close()
+
+    #Load single row from SQLite (on memory cache miss when loading lazily)
+    def selectOne(self, query, args):
+        with self.connLock:
+            start = time.perf_counter()
+            row = self.conn.execute(query, args).fetchone()
+            metrics.recordQuery("select", time.perf_counter() - start)
+            return row
+
+    def execute(self, query, args):
+        self.executeTransaction([(query, args)])
+
+    #Execute several (query, args) statements in a single transaction
+    def executeTransaction(self, statements):
+        with self.connLock:
+            try:
+                start = time.perf_counter()
+                for query, args in statements:
+                    self.conn.execute(query, args)
+                self.conn.commit()
+                metrics.recordQuery("transaction", time.perf_counter() - start)
+            except Exception as e:
+                self.conn.rollback()
+                logging.exception('Exception while updating the DB: %s', e)
+
+    #Commit all pending LastSeen updates in a single transaction
+    def flushLastSeen(self):
+        with self.lock:
+            pending = self.pendingLastSeen
+            self.pendingLastSeen = {}
+        if not pending:
+            return
+        with self.connLock:
+            try:
+                start = time.perf_counter()
+                self.conn.executemany(f"UPDATE {Database.CLIENTS_TABLE} SET LastSeen = ? WHERE ID = ?", [(lastSeen, clientId) for clientId, lastSeen in pending.items()])
+                self.conn.commit()
+                metrics.recordQuery("flushLastSeen", time.perf_counter() - start)
+            except Exception as e:
+                self.conn.rollback()
+                logging.exception('Exception while updating LastSeen in the DB: %s', e)
+
+    #Background thread flushing LastSeen updates every lastSeenFlushInterval seconds
+    def flushLoop(self):
+        while not self.closed.wait(self.lastSeenFlushInterval):
+            self.flushLastSeen()
+
+    #Flush pending updates and close the SQLite connection. Should be called on shutdown
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.flushLastSeen()
+        with self.connLock:
+            self.conn.close()
+
+    #Add client to the memory cache indexes (unless already cached). Returns the cached client
+    def addClient(self, client):
+        client = self.clients.setDefault(client.ID, client)
+        self.clientsByName.setDefault(client.Name, client)
+        return client
 
     #Store new client in the system. LastSeen is set to current time
     def storeClient(self, client):
-        self.clients.append(client)
+        with self.lock:
+            self.addClient(client)
         # Add null terminator to client name (as specified in requirements)
         self.execute(f"INSERT INTO {Database.CLIENTS_TABLE} (ID, Name, LastSeen) VALUES (?, ?, CURRENT_TIMESTAMP)", [client.ID, client.Name + "\0"])
 
-    #Update LastSeen of client to the current timestamp
+    #Update LastSeen of client to the current timestamp. The DB update is write-behind (see flushLastSeen)
     def updateClientLastSeen(self, client):
         client.LastSeen = str(datetime.now())
-        self.execute(f"UPDATE {Database.CLIENTS_TABLE} SET LastSeen = CURRENT_TIMESTAMP WHERE ID = ?", [client.ID])
+        with self.lock:
+            #Same format as SQLite CURRENT_TIMESTAMP (UTC)
+            self.pendingLastSeen[client.ID] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+            flush = len(self.pendingLastSeen) >= self.lastSeenBatchSize
+        if flush:
+            self.flushLastSeen()
 
     #Get Client by username
     def getClientByUsername(self, username):
-        for client in self.clients:
-            if client.Name == username:
-                return client
-        return None
+        client = self.clientsByName.get(username)
+        if client is None and self.lazyLoad:
+            row = self.selectOne(f"SELECT * FROM {Database.CLIENTS_TABLE} WHERE Name = ? LIMIT 1", [username + "\0"])
+            if row is not None:
+                client = self.addClient(clientFromRow(row))
+        return client
 
     #Get Client by client ID
     def getClientById(self, clientId):
-        for client in self.clients:
-            if client.ID == clientId:
-                return client
-        return None
+        client = self.clients.get(clientId)
+        if client is None and self.lazyLoad:
+            row = self.selectOne(f"SELECT * FROM {Database.CLIENTS_TABLE} WHERE ID = ?", [clientId])
+            if row is not None:
+                client = self.addClient(clientFromRow(row))
+        return client
 
     #Set Client RSA public key and AES key
     def setClientKeys(self, client, publicKey, AESKey):
         client.PublicKey = publicKey
         client.AES = AESKey
+        client.KeysTime = time.monotonic()
+        #When loading lazily, client may have been evicted and reloaded as a different object meanwhile
+        cached = self.clients.get(client.ID)
+        if cached is not None and cached is not client:
+            cached.PublicKey = publicKey
+            cached.AES = AESKey
+            cached.KeysTime = client.KeysTime
         self.execute(f"UPDATE {Database.CLIENTS_TABLE} SET PublicKey = ?, AES = ? WHERE ID = ?", [publicKey, AESKey, client.ID])
 
     #Store new file in the system. If an entry with the same filename and client already exists - it replaces it
-    def saveFile(self, client, filePath, fileName):
-        file = self.getFile(client, fileName)
-        if file is not None:
-            self.removeFile(file)
-        self.files.append(File(client.ID, fileName, filePath, False))
-        # Add null terminator to file name and path name (as specified in requirements)
-        self.execute(f"INSERT INTO {Database.FILES_TABLE} VALUES (?, ?, ?, ?)", [client.ID, fileName + "\0", filePath + "\0", False])
+    #contentHash is the hash of the file content in the deduplicated store (if used). The reference count of the
+    #content is increased, and the reference to the content of the replaced file (if any) is released.
+    #codec is the storage codec the file is stored with
+    def saveFile(self, client, filePath, fileName, contentHash=None, codec=None, verified=False):
+        self.saveFiles(client, [(filePath, fileName, contentHash, codec)], verified)
+
+    #Store several files of client, like saveFile, in a single transaction. files is a list of
+    #(file path, file name, content hash, codec)
+    def saveFiles(self, client, files, verified=False):
+        with self.lock:
+            statements = []
+            for filePath, fileName, contentHash, codec in files:
+                previous = self.getFile(client, fileName)
+                self.files.put((client.ID, fileName), File(client.ID, fileName, filePath, verified, contentHash, codec))
+                # Add null terminator to file name and path name (as specified in requirements)
+                statements.append((f"""INSERT INTO {Database.FILES_TABLE} (ID, FileName, PathName, Verified, Hash, Codec) VALUES (?, ?, ?, ?, ?, ?)
+                                       ON CONFLICT (ID, FileName) DO UPDATE SET PathName = excluded.PathName, Verified = excluded.Verified,
+                                       Hash = excluded.Hash, Codec = excluded.Codec""",
+                                   [client.ID, fileName + "\0", filePath + "\0", verified, contentHash, codec]))
+                if contentHash is not None:
+                    statements.append((f"INSERT INTO {Database.OBJECTS_TABLE} VALUES (?, 1) ON CONFLICT (Hash) DO UPDATE SET RefCount = RefCount + 1", [contentHash]))
+                if previous is not None and previous.Hash is not None:
+                    statements.append(self.releaseObjectStatement(previous.Hash))
+            self.executeTransaction(statements)
 
     #Get file by client and filename
     def getFile(self, client, fileName):
-        for file in self.files:
-            if file.ID == client.ID and file.FileName == fileName:
-                return file
-        return None
+        file = self.files.get((client.ID, fileName))
+        if file is None and self.lazyLoad:
+            row = self.selectOne(f"SELECT * FROM {Database.FILES_TABLE} WHERE ID = ? AND FileName = ?", [client.ID, fileName + "\0"])
+            if row is not None:
+                file = self.files.setDefault((client.ID, fileName), fileFromRow(row))
+        return file
 
     #Update file CRC verified
     def verifyFile(self, file):
         file.Verified = True
         self.execute(f"UPDATE {Database.FILES_TABLE} SET Verified = true WHERE ID = ? AND FileName = ?", [file.ID, file.FileName + "\0"])
 
-    #Remove a file from the system
+    #Remove a file from the system (and release its reference to content in the deduplicated store)
     def removeFile(self, file):
-        self.files.remove(file)
-        self.execute(f"DELETE FROM {Database.FILES_TABLE} WHERE ID = ? AND FileName = ?", [file.ID, file.FileName + "\0"])
\ No newline at end of file
+        with self.lock:
+            self.files.remove((file.ID, file.FileName), file)
+            statements = [(f"DELETE FROM {Database.FILES_TABLE} WHERE ID = ? AND FileName = ?", [file.ID, file.FileName + "\0"])]
+            if file.Hash is not None:
+                statements.append(self.releaseObjectStatement(file.Hash))
+            self.executeTransaction(statements)
+
+    def releaseObjectStatement(self, contentHash):
+        return (f"UPDATE {Database.OBJECTS_TABLE} SET RefCount = RefCount - 1 WHERE Hash = ?", [contentHash])
+
+    #Get interrupted upload by client and filename
+    def getUpload(self, client, fileName):
+        return self.uploads.get((client.ID, fileName))
+
+    #All interrupted uploads
+    def getUploads(self):
+        with self.lock:
+            return list(self.uploads.values())
+
+    #Store interrupted upload. Replaces an upload of the same file by the same client
+    def saveUpload(self, upload):
+        with self.lock:
+            self.uploads[(upload.ID, upload.FileName)] = upload
+            self.execute(f"INSERT OR REPLACE INTO {Database.UPLOADS_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         [upload.ID, upload.FileName, upload.TempPath, upload.ContentSize, upload.Offset, upload.DecryptedSize,
+                          upload.LastBlock, upload.CRC, upload.Time])
+
+    #Remove interrupted upload by client ID and filename. Returns the removed upload (None if there was none)
+    def takeUpload(self, clientId, fileName):
+        with self.lock:
+            upload = self.uploads.pop((clientId, fileName), None)
+            if upload is not None:
+                self.execute(f"DELETE FROM {Database.UPLOADS_TABLE} WHERE ID = ? AND FileName = ?", [clientId, fileName])
+            return upload
+
+    #Remove content without references from the objects table. Returns the hashes of the removed content
+    def takeUnreferencedObjects(self):
+        with self.connLock:
+            try:
+                hashes = [row[0] for row in self.conn.execute(f"SELECT Hash FROM {Database.OBJECTS_TABLE} WHERE RefCount <= 0")]
+                self.conn.executemany(f"DELETE FROM {Database.OBJECTS_TABLE} WHERE Hash = ? AND RefCount <= 0", [(h,) for h in hashes])
+                self.conn.commit()
+                return hashes
+            except Exception as e:
+                self.conn.rollback()
+                logging.exception('Exception while removing unreferenced objects from the DB: %s', e)
+                return []
\ No newline at end of file
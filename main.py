@@ -1,4 +1,7 @@
 import server
+import asyncServer
+import sys
+import signal
 from pathlib import Path
 
 PORT_INFO_FILE = "port.info"
@@ -21,7 +24,13 @@ def getPort():
 
 def main():
     port = getPort()
-    server.startServer('localhost', port)
+    #Exit normally on SIGTERM, so the server can flush pending DB updates
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    #Use the asyncio server when started with --async (both servers are wire compatible)
+    if "--async" in sys.argv[1:]:
+        asyncServer.startServer('localhost', port)
+    else:
+        server.startServer('localhost', port)
 
 
 if __name__ == '__main__':
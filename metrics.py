@@ -0,0 +1,213 @@
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS = {
+    "backup_connections_active": ("gauge", "Connections being handled"),
+    "backup_connections_total": ("counter", "Connections accepted"),
+    "backup_connections_rejected_total": ("counter", "Connections closed without being handled, by reason"),
+    "backup_requests_total": ("counter", "Requests handled, by request code"),
+    "backup_request_errors_total": ("counter", "Requests which failed, by request code"),
+    "backup_request_duration_seconds": ("histogram", "Time to handle a request, by request code"),
+    "backup_uploads_total": ("counter", "Uploads received"),
+    "backup_uploads_rejected_total": ("counter", "Uploads rejected before their content was read, by reason"),
+    "backup_upload_bytes_total": ("counter", "Encrypted bytes of uploads received"),
+    "backup_upload_decrypted_bytes_total": ("counter", "Plaintext bytes of uploads written"),
+    "backup_upload_stage_seconds_total": ("counter", "Time spent in each stage of uploads"),
+    "backup_db_query_duration_seconds": ("histogram", "Time of DB queries and transactions, by operation"),
+}
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+#Metric values, by name and labels (a tuple of (label, value) pairs). Updates take a single lock, and are cheap enough
+#to be done per request and per upload (but not per packet - per packet times are summed by the caller first)
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+
+    def add(self, name, value=1, labels=()):
+        key = (name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    #All metrics in the Prometheus text format
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+            histograms = {key: (list(histogram.counts), histogram.sum, histogram.count) for key, histogram in self.histograms.items()}
+        lines = []
+        for name, (kind, description) in METRICS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind != "histogram":
+                for (valueName, labels), value in sorted(values.items()):
+                    if valueName == name:
+                        lines.append(f"{name}{formatLabels(labels)} {value}")
+                continue
+            for (valueName, labels), (counts, total, count) in sorted(histograms.items()):
+                if valueName != name:
+                    continue
+                cumulative = 0
+                for bound, bucketCount in zip(LATENCY_BUCKETS, counts):
+                    cumulative += bucketCount
+                    lines.append(f"{name}_bucket{formatLabels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_bucket{formatLabels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{formatLabels(labels)} {total}")
+                lines.append(f"{name}_count{formatLabels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}"
+
+#Metrics of this process
+registry = Registry()
+
+def connectionOpened():
+    registry.add("backup_connections_total")
+    registry.add("backup_connections_active")
+
+def connectionClosed():
+    registry.add("backup_connections_active", -1)
+
+def connectionRejected(reason):
+    registry.add("backup_connections_rejected_total", 1, (("reason", reason),))
+
+def uploadRejected(reason):
+    registry.add("backup_uploads_rejected_total", 1, (("reason", reason),))
+
+def recordRequest(code, seconds, failed=False):
+    labels = (("code", code),)
+    registry.add("backup_requests_total", 1, labels)
+    if failed:
+        registry.add("backup_request_errors_total", 1, labels)
+    registry.observe("backup_request_duration_seconds", seconds, labels)
+
+def recordStage(stage, seconds):
+    registry.add("backup_upload_stage_seconds_total", seconds, (("stage", stage),))
+
+def recordQuery(operation, seconds):
+    registry.observe("backup_db_query_duration_seconds", seconds, (("operation", operation),))
+
+#Time spent in the stages of an upload (receiving, decryption, CRC calculation, disk writes), summed by the code receiving
+#it and recorded once, when it is received. The sync (fsync) and commit (promotion and DB update) stages are recorded on
+#their own. With a parallel checksum the crc stage is the time spent submitting blocks, and with an UploadPipeline the
+#stages run on their own threads, so each is the time spent by its thread
+class UploadTimes:
+    __slots__ = ("recv", "decrypt", "crc", "write")
+
+    def __init__(self):
+        self.recv = 0.0
+        self.decrypt = 0.0
+        self.crc = 0.0
+        self.write = 0.0
+
+    def record(self, encryptedSize, decryptedSize):
+        registry.add("backup_uploads_total")
+        registry.add("backup_upload_bytes_total", encryptedSize)
+        registry.add("backup_upload_decrypted_bytes_total", decryptedSize)
+        recordStage("recv", self.recv)
+        recordStage("decrypt", self.decrypt)
+        recordStage("crc", self.crc)
+        recordStage("write", self.write)
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    #Admin requests toggling the profiler of the server (if it has one)
+    def do_POST(self):
+        profiler = self.server.profiler
+        if profiler is None or self.path not in ("/profiler/start", "/profiler/stop"):
+            self.send_error(404)
+            return
+        if self.path == "/profiler/start":
+            profiler.start()
+        else:
+            profiler.stop()
+        body = b"profiling\n" if profiler.enabled else b"stopped\n"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+#Exposes the metrics at http://localhost:port/metrics (port 0 disables it), and/or writes them to dumpFile every
+#dumpInterval seconds (and on close). With a profiler (profiler.Profiler), it can be started and stopped with
+#POST /profiler/start and /profiler/stop
+class MetricsExporter:
+    def __init__(self, port=0, dumpFile=None, dumpInterval=60.0, profiler=None):
+        self.dumpFile = dumpFile
+        self.dumpInterval = dumpInterval
+        self.closed = threading.Event()
+        self.server = None
+        if port:
+            self.server = ThreadingHTTPServer(("localhost", port), MetricsRequestHandler)
+            self.server.daemon_threads = True
+            self.server.profiler = profiler
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            logging.info("Metrics are available at http://localhost:%d/metrics", port)
+        if dumpFile:
+            threading.Thread(target=self.dumpLoop, daemon=True).start()
+
+    #Write the metrics to the dump file. It is replaced atomically, so readers never see a partial dump
+    def dump(self):
+        tempPath = self.dumpFile + ".tmp"
+        with open(tempPath, "w") as file:
+            file.write(registry.render())
+        os.replace(tempPath, self.dumpFile)
+
+    def dumpLoop(self):
+        while not self.closed.wait(self.dumpInterval):
+            try:
+                self.dump()
+            except Exception as e:
+                logging.exception("Exception while dumping metrics to %s: %s", self.dumpFile, e)
+
+    def close(self):
+        self.closed.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.dumpFile:
+            self.dump()
@@ -0,0 +1,188 @@
+import logging
+import os
+import threading
+import time
+import uuid
+import crc
+import protocol
+import uploadPipeline
+from Crypto.Cipher import AES
+
+#Writes the plaintext of a segment at its offset in the upload file with positional writes, so segments received on
+#several connections are written at the same time without sharing a file position. Chunks are buffered, and written in
+#blocks of WRITE_BUFFER_SIZE (the rest is written by flush). Content beyond the end of the segment is refused (it would
+#overwrite the next segment)
+class SegmentWriter:
+    def __init__(self, fd, offset, size):
+        self.fd = fd
+        self.offset = offset
+        self.end = offset + size
+        self.buffer = bytearray()
+
+    def write(self, data):
+        if self.offset + len(self.buffer) + len(data) > self.end:
+            raise Exception("Segment content is bigger than the segment!")
+        self.buffer += data
+        if len(self.buffer) >= uploadPipeline.WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        view = memoryview(self.buffer)
+        while len(view) > 0:
+            written = os.pwrite(self.fd, view, self.offset)
+            self.offset += written
+            view = view[written:]
+        view.release()
+        self.buffer.clear()
+
+#A file uploaded as segments on several connections at once (protocol version 8). Segment i holds the plaintext from
+#offset i * segmentSize, and is encrypted on its own (with its own IV). The file is preallocated, each segment is written
+#at its offset as it is decrypted, and the CRC of the file is combined from the CRCs of the segments
+class MultiStreamUpload:
+    def __init__(self, uploadId, clientId, fileName, fileSize, segmentSize, file, tempPath):
+        self.uploadId = uploadId
+        self.clientId = clientId
+        self.fileName = fileName
+        self.fileSize = fileSize
+        self.segmentSize = segmentSize
+        self.segmentCount = max(1, -(-fileSize // segmentSize))
+        self.file = file
+        self.tempPath = tempPath
+        #(crc, nchars) of each received segment, None until it is received
+        self.checksums = [None] * self.segmentCount
+        #index -> writer of each segment being received
+        self.receiving = {}
+        self.encryptedSize = 0
+        self.lock = threading.Lock()
+        self.lastActivity = time.monotonic()
+
+    #Plaintext size of segment index (the last one can be smaller)
+    def getSegmentSize(self, index):
+        return min(self.segmentSize, self.fileSize - index * self.segmentSize)
+
+    #Start receiving segment index. Returns the writer of its plaintext
+    def startSegment(self, index):
+        with self.lock:
+            if index >= self.segmentCount:
+                raise Exception(f"File {self.fileName} has only {self.segmentCount} segments!")
+            if self.checksums[index] is not None or index in self.receiving:
+                raise Exception(f"Segment {index} of file {self.fileName} was already received!")
+            writer = self.receiving[index] = SegmentWriter(self.file.fileno(), index * self.segmentSize, self.getSegmentSize(index))
+            self.lastActivity = time.monotonic()
+        return writer
+
+    #Finish receiving segment index, with the checksum of its plaintext (the rest of its plaintext is written). Without a
+    #checksum (receiving failed) the segment can be sent again
+    def finishSegment(self, index, cksum=None, encryptedSize=0):
+        state = cksum.getState() if cksum is not None else None
+        try:
+            if state is not None:
+                self.receiving[index].flush()
+        except Exception:
+            with self.lock:
+                self.receiving.pop(index, None)
+            raise
+        with self.lock:
+            self.receiving.pop(index, None)
+            self.lastActivity = time.monotonic()
+            if state is None:
+                return
+            if state[1] != self.getSegmentSize(index):
+                raise Exception(f"Segment {index} of file {self.fileName} has {state[1]} bytes instead of {self.getSegmentSize(index)}!")
+            self.checksums[index] = state
+            self.encryptedSize += encryptedSize
+
+    def isComplete(self):
+        return not self.receiving and all(state is not None for state in self.checksums)
+
+    #Checksum of the whole file, combined from the checksums of the segments
+    def getChecksum(self):
+        cksum = crc.Checksum()
+        for state in self.checksums:
+            segment = crc.Checksum()
+            segment.setState(state)
+            cksum.combine(segment)
+        return cksum
+
+#Multi-stream uploads in progress, shared by all connections. Uploads without activity for ttl seconds are removed.
+#The file of an upload is preallocated when it starts, so files bigger than maxFileSize are refused, and a client may have
+#at most maxUploadsPerClient uploads in progress (0 - no limit)
+class MultiStreamUploads:
+    def __init__(self, storage, ttl=60 * 60, maxFileSize=0, maxUploadsPerClient=0):
+        self.storage = storage
+        self.ttl = ttl
+        self.maxFileSize = maxFileSize
+        self.maxUploadsPerClient = maxUploadsPerClient
+        self.uploads = {}
+        #client ID -> number of its uploads (including ones whose file is being preallocated)
+        self.clientUploads = {}
+        self.lock = threading.Lock()
+
+    #Start a multi-stream upload of fileName by client, in a preallocated temp file
+    def open(self, client, fileName, fileSize, segmentSize):
+        if self.maxFileSize > 0 and fileSize > self.maxFileSize:
+            raise Exception(f"Multi-stream upload of {fileSize} bytes by {client.Name} is bigger than the maximum {self.maxFileSize}!")
+        #Each segment is padded to whole AES blocks, and the encrypted size of the file is returned in a 32 bit field
+        if fileSize + max(1, -(-fileSize // segmentSize)) * AES.block_size > protocol.MAX_CONTENT_SIZE:
+            raise Exception(f"Multi-stream upload of {fileSize} bytes by {client.Name} is too big for its encrypted size to be returned!")
+        self.removeExpired()
+        with self.lock:
+            uploads = self.clientUploads.get(client.ID, 0)
+            if self.maxUploadsPerClient > 0 and uploads >= self.maxUploadsPerClient:
+                raise Exception(f"Client {client.Name} already has {uploads} multi-stream uploads in progress!")
+            self.clientUploads[client.ID] = uploads + 1
+        try:
+            file, tempPath = self.storage.createPreallocatedFile(client.ID, fileName, fileSize)
+        except Exception:
+            with self.lock:
+                self.release(client.ID)
+            raise
+        upload = MultiStreamUpload(uuid.uuid4().bytes, client.ID, fileName, fileSize, segmentSize, file, tempPath)
+        with self.lock:
+            self.uploads[upload.uploadId] = upload
+        return upload
+
+    #Remove an upload of clientId from its count. Called with the lock held
+    def release(self, clientId):
+        uploads = self.clientUploads.pop(clientId) - 1
+        if uploads > 0:
+            self.clientUploads[clientId] = uploads
+
+    def get(self, client, uploadId, fileName):
+        upload = self.uploads.get(uploadId)
+        if upload is None or upload.clientId != client.ID or upload.fileName != fileName:
+            raise Exception(f"There is no multi-stream upload of file {fileName} for client {client.Name}!")
+        return upload
+
+    #Take a complete upload, so no more segments can be sent. Its file is left open (the caller closes it)
+    def take(self, client, uploadId, fileName):
+        with self.lock:
+            upload = self.get(client, uploadId, fileName)
+            if not upload.isComplete():
+                raise Exception(f"Multi-stream upload of file {fileName} for client {client.Name} is missing segments!")
+            del self.uploads[uploadId]
+            self.release(upload.clientId)
+        return upload
+
+    #Remove uploads without activity for ttl seconds (the client gave up on them)
+    def removeExpired(self):
+        now = time.monotonic()
+        with self.lock:
+            expired = [upload for upload in self.uploads.values() if not upload.receiving and now - upload.lastActivity > self.ttl]
+            for upload in expired:
+                del self.uploads[upload.uploadId]
+                self.release(upload.clientId)
+        for upload in expired:
+            logging.info("Multi-stream upload of file %s expired", upload.fileName)
+            upload.file.close()
+            self.storage.remove(upload.tempPath)
+
+    #Remove all uploads (on shutdown)
+    def close(self):
+        with self.lock:
+            uploads = list(self.uploads.values())
+            self.uploads.clear()
+            self.clientUploads.clear()
+        for upload in uploads:
+            upload.file.close()
+            self.storage.remove(upload.tempPath)
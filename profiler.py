@@ -0,0 +1,112 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+
+#Number of functions listed (by cumulative time) in the text summary of each request code
+SUMMARY_FUNCTIONS = 40
+
+#Opt-in profiler of request handlers. While enabled, a sample (sampleRate) of connections is profiled with cProfile, and
+#the stats of their requests are aggregated per request code. When profiling is disabled, the stats are written to
+#dumpFolder - profile_<code>.prof (loadable with pstats) and profile_<code>.txt (the top functions by cumulative time).
+#Only one connection is profiled at a time, which bounds the overhead (and cProfile can't profile threads concurrently in
+#newer Pythons). When it is off, the cost is a single check per connection.
+#cProfile only profiles the thread of the connection - work done by the CRC executor and the upload pipeline threads is
+#seen as time waiting for them
+class Profiler:
+    def __init__(self, sampleRate=0.1, dumpFolder="profiles", enabled=False):
+        self.sampleRate = sampleRate
+        self.dumpFolder = dumpFolder
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.busy = threading.Lock()
+        self.stats = {}
+        self.startTime = None
+        if enabled:
+            self.start()
+
+    def start(self):
+        with self.lock:
+            if self.enabled:
+                return
+            self.stats = {}
+            self.startTime = time.time()
+            self.enabled = True
+        logging.info("Profiling %.0f%% of connections", self.sampleRate * 100)
+
+    #Stop profiling and dump the collected stats. Connections being profiled stop adding to them
+    def stop(self):
+        with self.lock:
+            if not self.enabled:
+                return
+            self.enabled = False
+            stats = self.stats
+            self.stats = {}
+        self.dump(stats)
+
+    def toggle(self):
+        if self.enabled:
+            self.stop()
+        else:
+            self.start()
+
+    #Profile of a new connection, or None if it is not sampled
+    def sampleConnection(self):
+        if not self.enabled or random.random() >= self.sampleRate:
+            return None
+        if not self.busy.acquire(blocking=False):
+            return None
+        return ConnectionProfile(self)
+
+    def add(self, code, profile):
+        with self.lock:
+            if not self.enabled:
+                return
+            stats = self.stats.get(code)
+            if stats is None:
+                self.stats[code] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+
+    def dump(self, stats):
+        if not stats:
+            logging.info("Profiling stopped, no requests were profiled")
+            return
+        os.makedirs(self.dumpFolder, exist_ok=True)
+        for code, codeStats in stats.items():
+            path = os.path.join(self.dumpFolder, f"profile_{code}")
+            try:
+                codeStats.dump_stats(path + ".prof")
+                summary = io.StringIO()
+                codeStats.stream = summary
+                codeStats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(SUMMARY_FUNCTIONS)
+                with open(path + ".txt", "w") as file:
+                    file.write(f"Request code {code}, profiled since {time.ctime(self.startTime)}\n")
+                    file.write(summary.getvalue())
+            except Exception as e:
+                logging.exception("Exception while dumping profile of request code %d: %s", code, e)
+        logging.info("Profiling stopped, stats of %d request code(s) written to %s", len(stats), self.dumpFolder)
+
+    def close(self):
+        self.stop()
+
+#Profiling of one sampled connection - each request is profiled on its own, so its stats go to its request code
+class ConnectionProfile:
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def run(self, code, func, *args):
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return func(*args)
+        finally:
+            profile.disable()
+            self.profiler.add(code, profile)
+
+    def close(self):
+        self.profiler.busy.release()
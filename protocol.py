@@ -5,6 +5,43 @@ SERVER_VERSION = 3
 
 PACKET_SIZE = 1024
 
+#Version 4 adds large frame mode: after a REQUEST_LARGE_FRAME request is answered with RESPONSE_LARGE_FRAME, the server
+#reads file content in frames of the negotiated size, and responses on that connection are no longer padded to PACKET_SIZE.
+#Version 3 clients never send this request, and keep working unchanged.
+LARGE_FRAME_VERSION = 4
+DEFAULT_LARGE_FRAME_SIZE = 256 * 1024
+MAX_LARGE_FRAME_SIZE = 1024 * 1024
+
+#Version 5 adds resumable uploads: REQUEST_UPLOAD_OFFSET returns how much of an interrupted upload of a file the server
+#kept (RESPONSE_UPLOAD_OFFSET), and REQUEST_RESUME_FILE sends the rest of the encrypted content from that offset.
+#The resumed upload is answered with RESPONSE_FILE_RECEIVED and confirmed with the CRC requests, like any other upload
+RESUME_VERSION = 5
+
+#Version 6 adds session mode and batch uploads. After REQUEST_SESSION_MODE is answered with RESPONSE_SESSION_MODE, the
+#connection stays open after the CRC requests, for any number of uploads, until the client closes it.
+#REQUEST_SEND_BATCH carries many small files, each encrypted on its own (like the content of REQUEST_SEND_FILE) together
+#with its CRC calculated by the client. The server checks the CRC of every file, stores the valid ones as verified, and
+#answers with RESPONSE_BATCH_RECEIVED - the status and server CRC of each file. No CRC requests follow a batch
+SESSION_VERSION = 6
+MAX_BATCH_FILES = 10000
+#Maximal encrypted content size of a file in a batch (batch files are received into memory)
+MAX_BATCH_FILE_SIZE = 1024 * 1024
+
+#Version 7 adds pipelining: the request header ends with a correlation ID, which the server returns right after the
+#response header of the response to the request. Clients can send requests without waiting for the responses to the
+#previous ones - requests are handled in order, and responses are sent in the same order. Once a connection sends a
+#version 7 request, all requests on it have to be sent exactly as long as their header says (no padding).
+#Headers of earlier versions are unchanged
+PIPELINE_VERSION = 7
+
+#Version 8 adds multi-stream uploads: a file is split into segments of the same plaintext size (except the last one),
+#each encrypted on its own with its own IV, which can be sent on several connections at once. REQUEST_OPEN_STREAMS starts
+#the upload (RESPONSE_STREAMS_OPENED returns its upload ID), each segment is sent with REQUEST_SEND_SEGMENT
+#(RESPONSE_SEGMENT_RECEIVED), and REQUEST_CLOSE_STREAMS completes the upload when all segments were received. It is
+#answered with RESPONSE_FILE_RECEIVED (with the CRC of the whole file) and confirmed with the CRC requests, like any upload
+MULTI_STREAM_VERSION = 8
+MAX_SEGMENTS = 1024
+
 CLIENT_ID_SIZE = 16
 NAME_SIZE = 255
 PUBLIC_KEY_SIZE = 160
@@ -14,6 +51,18 @@ CODE_SIZE = 2
 PAYLOAD_SIZE_SIZE = 4
 CONTENT_SIZE_SIZE = 4
 CHECKSUM_SIZE = 4
+FRAME_SIZE_SIZE = 4
+OFFSET_SIZE = 4
+FILE_COUNT_SIZE = 4
+BATCH_STATUS_SIZE = 1
+CORRELATION_ID_SIZE = 4
+FILE_SIZE_SIZE = 8
+SEGMENT_SIZE_SIZE = 4
+SEGMENT_INDEX_SIZE = 4
+UPLOAD_ID_SIZE = 16
+IV_SIZE = 16
+#Maximal (encrypted) content size of a file in RESPONSE_FILE_RECEIVED
+MAX_CONTENT_SIZE = (1 << (8 * CONTENT_SIZE_SIZE)) - 1
 
 
 FILE_NAME_SIZE = 255
@@ -27,6 +76,14 @@ class RequestCode(Enum):
     REQUEST_VALID_CRC = 1104
     REQUEST_INVALID_CRC = 1105
     REQUEST_LAST_INVALID_CRC = 1106
+    REQUEST_LARGE_FRAME = 1107
+    REQUEST_UPLOAD_OFFSET = 1108
+    REQUEST_RESUME_FILE = 1109
+    REQUEST_SESSION_MODE = 1110
+    REQUEST_SEND_BATCH = 1111
+    REQUEST_OPEN_STREAMS = 1112
+    REQUEST_SEND_SEGMENT = 1113
+    REQUEST_CLOSE_STREAMS = 1114
 
 
 # Response Codes
@@ -36,109 +93,327 @@ class ResponseCode(Enum):
     RESPONSE_AES_KEY = 2102
     RESPONSE_FILE_RECEIVED = 2103
     RESPONSE_MESSAGE_RECEIVED = 2104
-
-#Header for all reqeusts
+    RESPONSE_LARGE_FRAME = 2105
+    RESPONSE_UPLOAD_OFFSET = 2106
+    RESPONSE_SESSION_MODE = 2107
+    RESPONSE_BATCH_RECEIVED = 2108
+    RESPONSE_STREAMS_OPENED = 2109
+    RESPONSE_SEGMENT_RECEIVED = 2110
+
+#Status of each file in RESPONSE_BATCH_RECEIVED
+class BatchFileStatus(Enum):
+    BATCH_FILE_SAVED = 0
+    BATCH_FILE_INVALID_CRC = 1
+    BATCH_FILE_FAILED = 2
+
+#Precompiled codecs of all messages, so formats are parsed once. Response codecs start with the response header fields
+REQUEST_HEADER = struct.Struct(f"<{CLIENT_ID_SIZE}sBHL")
+CORRELATION_ID = struct.Struct("<L")
+REGISTRATION_REQUEST = struct.Struct(f"<{NAME_SIZE}s")
+PUBLIC_KEY_REQUEST = struct.Struct(f"<{NAME_SIZE}s{PUBLIC_KEY_SIZE}s")
+SEND_FILE_REQUEST = struct.Struct(f"<{CLIENT_ID_SIZE}sL{FILE_NAME_SIZE}s")
+RESUME_FILE_REQUEST = struct.Struct(f"<{CLIENT_ID_SIZE}sL{FILE_NAME_SIZE}sL")
+CRC_REQUEST = struct.Struct(f"<{CLIENT_ID_SIZE}s{FILE_NAME_SIZE}s")
+SEND_BATCH_REQUEST = struct.Struct(f"<{CLIENT_ID_SIZE}sL")
+BATCH_FILE_HEADER = struct.Struct(f"<L{FILE_NAME_SIZE}sL")
+OPEN_STREAMS_REQUEST = struct.Struct(f"<{CLIENT_ID_SIZE}sQL{FILE_NAME_SIZE}s")
+SEND_SEGMENT_REQUEST = struct.Struct(f"<{CLIENT_ID_SIZE}s{UPLOAD_ID_SIZE}sLL{IV_SIZE}s{FILE_NAME_SIZE}s")
+CLOSE_STREAMS_REQUEST = struct.Struct(f"<{CLIENT_ID_SIZE}s{UPLOAD_ID_SIZE}s{FILE_NAME_SIZE}s")
+LARGE_FRAME_REQUEST = struct.Struct("<L")
+RESPONSE_HEADER = struct.Struct("<BHL")
+REGISTRATION_SUCCESS_RESPONSE = struct.Struct(f"<BHL{CLIENT_ID_SIZE}s")
+AES_KEY_RESPONSE = struct.Struct(f"<BHL{CLIENT_ID_SIZE}s")
+FILE_RECEIVED_RESPONSE = struct.Struct(f"<BHL{CLIENT_ID_SIZE}sL{FILE_NAME_SIZE}sL")
+LARGE_FRAME_RESPONSE = struct.Struct("<BHLL")
+UPLOAD_OFFSET_RESPONSE = struct.Struct(f"<BHL{CLIENT_ID_SIZE}sL{FILE_NAME_SIZE}sL")
+BATCH_RECEIVED_RESPONSE = struct.Struct(f"<BHL{CLIENT_ID_SIZE}sL")
+BATCH_RECEIVED_FILE = struct.Struct(f"<{FILE_NAME_SIZE}sBL")
+STREAMS_OPENED_RESPONSE = struct.Struct(f"<BHL{CLIENT_ID_SIZE}s{UPLOAD_ID_SIZE}sL")
+SEGMENT_RECEIVED_RESPONSE = struct.Struct(f"<BHL{CLIENT_ID_SIZE}s{UPLOAD_ID_SIZE}sLL")
+
+#Size of the request header of a version. The version is at VERSION_OFFSET, so it can be read from the start of the header
+VERSION_OFFSET = CLIENT_ID_SIZE
+def getRequestHeaderSize(version):
+    size = REQUEST_HEADER.size
+    if version >= PIPELINE_VERSION:
+        size += CORRELATION_ID.size
+    return size
+
+#Trim a name field after the nul terminating character
+def decodeName(name):
+    return str(name.partition(b'\0')[0].decode('utf-8'))
+
+#Requests are parsed with unpack_from, so data can be any buffer (bytes, bytearray or memoryview) which starts with the
+#message - it is never sliced or copied. Message classes have __slots__, so creating one per request is cheap
+
+#Header for all reqeusts. correlationId is None before version 7
 class RequestHeader:
+    __slots__ = ("clientID", "version", "code", "payloadSize", "correlationId", "SIZE")
 
     def __init__(self):
         self.clientID = b""
         self.version = 0
         self.code = 0
         self.payloadSize = 0
-        self.SIZE = CLIENT_ID_SIZE + VERSION_SIZE + CODE_SIZE + PAYLOAD_SIZE_SIZE
+        self.correlationId = None
+        self.SIZE = REQUEST_HEADER.size
 
     def unpack(self, data):
         try:
-            self.clientID, self.version, self.code, self.payloadSize = struct.unpack(f"<{CLIENT_ID_SIZE}sBHL", data[:self.SIZE])
-            if self.payloadSize < 0:
-                raise Exception("Payload size cannot be negative!")
+            self.clientID, self.version, self.code, self.payloadSize = REQUEST_HEADER.unpack_from(data)
+            if self.version >= PIPELINE_VERSION:
+                self.correlationId = CORRELATION_ID.unpack_from(data, REQUEST_HEADER.size)[0]
+                self.SIZE = REQUEST_HEADER.size + CORRELATION_ID.size
         except Exception as e:
             raise Exception(f"Error parsing request header: {e}")
 
 
 class RegistrationRequest:
+    __slots__ = ("name",)
+    SIZE = REGISTRATION_REQUEST.size
 
     def __init__(self):
         self.name = b""
-        self.SIZE = NAME_SIZE
 
     def unpack(self, data):
         try:
-            # trim the byte array after the nul terminating character.
-            self.name = str(struct.unpack(f"<{NAME_SIZE}s", data[:NAME_SIZE])[0].partition(b'\0')[0].decode("utf-8"))
-        except:
+            self.name = decodeName(REGISTRATION_REQUEST.unpack_from(data)[0])
+        except Exception as e:
             raise Exception(f"Error parsing registration request: {e}")
 
 class PublicKeyRequest:
+    __slots__ = ("name", "publicKey")
+    SIZE = PUBLIC_KEY_REQUEST.size
 
     def __init__(self):
         self.name = b""
         self.publicKey = b""
-        self.SIZE = NAME_SIZE + PUBLIC_KEY_SIZE
 
     def unpack(self, data):
         try:
-            # trim the byte array after the nul terminating character.
-            self.name = str(struct.unpack(f"<{NAME_SIZE}s", data[:NAME_SIZE])[0].partition(b'\0')[0].decode('utf-8'))
-            self.publicKey = struct.unpack(f"<{PUBLIC_KEY_SIZE}s", data[NAME_SIZE:self.SIZE])[0]
-        except:
+            name, self.publicKey = PUBLIC_KEY_REQUEST.unpack_from(data)
+            self.name = decodeName(name)
+        except Exception as e:
             raise Exception(f"Error parsing public key request: {e}")
 
 #Send file request payload - without the content itself
 class SendFileRequest:
+    __slots__ = ("clientID", "contentSize", "fileName")
+    SIZE = SEND_FILE_REQUEST.size
+
     def __init__(self):
         self.clientID = b""
         self.contentSize = 0
         self.fileName = b""
-        self.SIZE = CLIENT_ID_SIZE + CONTENT_SIZE_SIZE + FILE_NAME_SIZE
 
     def unpack(self, data):
         try:
-            fileNameOffset = CLIENT_ID_SIZE + CONTENT_SIZE_SIZE
-            self.clientID, self.contentSize = struct.unpack(f"<{CLIENT_ID_SIZE}sL", data[:fileNameOffset])
-            if self.contentSize < 0:
-                raise Exception("Content size cannot be negative!")
-            self.fileName = str(struct.unpack(f"<{FILE_NAME_SIZE}s", data[fileNameOffset:self.SIZE])[0].partition(b'\0')[0].decode('utf-8'))
+            self.clientID, self.contentSize, fileName = SEND_FILE_REQUEST.unpack_from(data)
+            self.fileName = decodeName(fileName)
         except Exception as e:
             raise Exception(f"Error parsing send file request: {e}")
 
 
 #All three of the CRC requests:   REQUEST_VALID_CRC = 1104, REQUEST_INVALID_CRC = 1105, REQUEST_LAST_INVALID_CRC = 1106
 class CRCRequest:
+    __slots__ = ("clientID", "fileName")
+    SIZE = CRC_REQUEST.size
+
     def __init__(self):
         self.clientID = b""
         self.fileName = b""
-        self.SIZE = CLIENT_ID_SIZE + FILE_NAME_SIZE
 
     def unpack(self, data):
         try:
-            self.clientID = struct.unpack(f"<{CLIENT_ID_SIZE}s", data[:CLIENT_ID_SIZE])[0]
+            self.clientID, fileName = CRC_REQUEST.unpack_from(data)
+            self.fileName = decodeName(fileName)
+        except Exception as e:
+            raise Exception(f"Error parsing CRC request: {e}")
+
 
-            # trim the byte array after the nul terminating character.
-            self.fileName = str(struct.unpack(f"<{FILE_NAME_SIZE}s", data[CLIENT_ID_SIZE:self.SIZE])[0].partition(b'\0')[0].decode('utf-8'))
 
+
+
+#Resume file request payload (version 5) - like send file request, with the offset in the encrypted content the rest
+#of the content is sent from. contentSize is the size of the whole encrypted content
+class ResumeFileRequest(SendFileRequest):
+    __slots__ = ("offset",)
+    SIZE = RESUME_FILE_REQUEST.size
+
+    def __init__(self):
+        super().__init__()
+        self.offset = 0
+
+    def unpack(self, data):
+        try:
+            self.clientID, self.contentSize, fileName, self.offset = RESUME_FILE_REQUEST.unpack_from(data)
+            self.fileName = decodeName(fileName)
+            if self.offset >= self.contentSize:
+                raise Exception("Offset must be less than content size!")
         except Exception as e:
-            raise Exception(f"Error parsing CRC request: {e}")
+            raise Exception(f"Error parsing resume file request: {e}")
+
 
+#Upload offset request (version 5) - same payload as the CRC requests
+class UploadOffsetRequest(CRCRequest):
+    __slots__ = ()
 
 
+#Send batch request payload (version 6) - without the files. fileCount files follow, each a BatchFileHeader and the
+#encrypted content
+class SendBatchRequest:
+    __slots__ = ("clientID", "fileCount")
+    SIZE = SEND_BATCH_REQUEST.size
+
+    def __init__(self):
+        self.clientID = b""
+        self.fileCount = 0
+
+    def unpack(self, data):
+        try:
+            self.clientID, self.fileCount = SEND_BATCH_REQUEST.unpack_from(data)
+            if self.fileCount > MAX_BATCH_FILES:
+                raise Exception(f"Batch can't have more than {MAX_BATCH_FILES} files!")
+        except Exception as e:
+            raise Exception(f"Error parsing send batch request: {e}")
+
+
+#Header of a file in a batch - followed by contentSize bytes of encrypted content. checksum is the CRC of the content
+#before encryption, calculated by the client
+class BatchFileHeader:
+    __slots__ = ("contentSize", "fileName", "checksum")
+    SIZE = BATCH_FILE_HEADER.size
+
+    def __init__(self):
+        self.contentSize = 0
+        self.fileName = ""
+        self.checksum = 0
+
+    def unpack(self, data):
+        try:
+            self.contentSize, fileName, self.checksum = BATCH_FILE_HEADER.unpack_from(data)
+            if self.contentSize > MAX_BATCH_FILE_SIZE:
+                raise Exception(f"Content size of a batch file can't be more than {MAX_BATCH_FILE_SIZE}!")
+            self.fileName = decodeName(fileName)
+        except Exception as e:
+            raise Exception(f"Error parsing batch file header: {e}")
 
 
+#Open streams request payload (version 8) - plaintext size of the file, and plaintext size of its segments
+class OpenStreamsRequest:
+    __slots__ = ("clientID", "fileSize", "segmentSize", "fileName")
+    SIZE = OPEN_STREAMS_REQUEST.size
+
+    def __init__(self):
+        self.clientID = b""
+        self.fileSize = 0
+        self.segmentSize = 0
+        self.fileName = ""
+
+    def unpack(self, data):
+        try:
+            self.clientID, self.fileSize, self.segmentSize, fileName = OPEN_STREAMS_REQUEST.unpack_from(data)
+            if self.segmentSize == 0 or self.fileSize > self.segmentSize * MAX_SEGMENTS:
+                raise Exception(f"File must be split into 1 to {MAX_SEGMENTS} segments!")
+            self.fileName = decodeName(fileName)
+        except Exception as e:
+            raise Exception(f"Error parsing open streams request: {e}")
+
+
+#Send segment request payload (version 8) - without the content itself. contentSize is the size of the encrypted
+#content of the segment, which follows
+class SendSegmentRequest:
+    __slots__ = ("clientID", "uploadID", "segmentIndex", "contentSize", "iv", "fileName")
+    SIZE = SEND_SEGMENT_REQUEST.size
+
+    def __init__(self):
+        self.clientID = b""
+        self.uploadID = b""
+        self.segmentIndex = 0
+        self.contentSize = 0
+        self.iv = b""
+        self.fileName = ""
+
+    def unpack(self, data):
+        try:
+            self.clientID, self.uploadID, self.segmentIndex, self.contentSize, self.iv, fileName = SEND_SEGMENT_REQUEST.unpack_from(data)
+            self.fileName = decodeName(fileName)
+        except Exception as e:
+            raise Exception(f"Error parsing send segment request: {e}")
+
+
+#Close streams request payload (version 8)
+class CloseStreamsRequest:
+    __slots__ = ("clientID", "uploadID", "fileName")
+    SIZE = CLOSE_STREAMS_REQUEST.size
+
+    def __init__(self):
+        self.clientID = b""
+        self.uploadID = b""
+        self.fileName = ""
+
+    def unpack(self, data):
+        try:
+            self.clientID, self.uploadID, fileName = CLOSE_STREAMS_REQUEST.unpack_from(data)
+            self.fileName = decodeName(fileName)
+        except Exception as e:
+            raise Exception(f"Error parsing close streams request: {e}")
+
+
+#Large frame mode request (version 4) - the frame size the client wants to use
+class LargeFrameRequest:
+    __slots__ = ("frameSize",)
+    SIZE = LARGE_FRAME_REQUEST.size
+
+    def __init__(self):
+        self.frameSize = 0
+
+    def unpack(self, data):
+        try:
+            self.frameSize = LARGE_FRAME_REQUEST.unpack_from(data)[0]
+        except Exception as e:
+            raise Exception(f"Error parsing large frame request: {e}")
+
+
+#Zeros responses are padded with
+PADDING = memoryview(bytes(PACKET_SIZE))
+
+#Buffers to write for a packed response, without copying it: the correlation ID of a pipelined request (version 7) goes
+#after the response header, and with pad the response is padded to a multiple of PACKET_SIZE
+def getResponseBuffers(response, correlationId=None, pad=True):
+    view = memoryview(response)
+    if correlationId is None:
+        buffers = [view]
+        size = len(view)
+    else:
+        buffers = [view[:RESPONSE_HEADER.size], CORRELATION_ID.pack(correlationId), view[RESPONSE_HEADER.size:]]
+        size = len(view) + CORRELATION_ID.size
+    if pad and size % PACKET_SIZE:
+        buffers.append(PADDING[:PACKET_SIZE - size % PACKET_SIZE])
+    return buffers
+
+#Responses are packed with a single call of their codec, which includes the header fields. File names are encoded and
+#padded with zeros by the codec
+
 #Header for all responses
 class ResponseHeader:
-    def __init__(self, code):
-        self.version = SERVER_VERSION
+    __slots__ = ("version", "code", "payloadSize")
+    SIZE = RESPONSE_HEADER.size
+
+    def __init__(self, code, version=SERVER_VERSION):
+        self.version = version
         self.code = code
         self.payloadSize = 0
-        self.SIZE = VERSION_SIZE + CODE_SIZE + PAYLOAD_SIZE_SIZE
 
     def pack(self):
         try:
-            return struct.pack(f"<BHL", self.version, self.code, self.payloadSize)
+            return RESPONSE_HEADER.pack(self.version, self.code, self.payloadSize)
         except Exception as e:
             raise Exception(f"Error packing response header: {e}")
 
 class RegistrationSuccessResponse():
+    __slots__ = ("header", "clientID")
+
     def __init__(self):
         self.header = ResponseHeader(ResponseCode.RESPONSE_REGISTRATION_SUCCESS.value)
         self.header.payloadSize = CLIENT_ID_SIZE
@@ -146,13 +421,14 @@ class RegistrationSuccessResponse():
 
     def pack(self):
         try:
-            data = self.header.pack()
-            data += struct.pack(f"<{CLIENT_ID_SIZE}s", self.clientID)
-            return data
+            header = self.header
+            return REGISTRATION_SUCCESS_RESPONSE.pack(header.version, header.code, header.payloadSize, self.clientID)
         except Exception as e:
             raise Exception(f"Error packing registration success response: {e}")
 
 class RegistrationFailedResponse:
+    __slots__ = ("header",)
+
     def __init__(self):
         self.header = ResponseHeader(ResponseCode.RESPONSE_REGISTRATION_FAILED.value)
         self.header.payloadSize = 0
@@ -164,6 +440,8 @@ class RegistrationFailedResponse:
             raise Exception(f"Error packing registration failed response: {e}")
 
 class AESKeyResponse:
+    __slots__ = ("header", "clientID", "AESKey")
+
     def __init__(self):
         self.header = ResponseHeader(ResponseCode.RESPONSE_AES_KEY.value)
         self.clientID = b""
@@ -172,15 +450,15 @@ class AESKeyResponse:
     def pack(self):
         try:
             #The size of the encrypted AESKey is changing, and so has to be calculated after AESKey is set - during packing
-            self.header.payloadSize = CLIENT_ID_SIZE + len(self.AESKey)
-            data = self.header.pack()
-            data += struct.pack(f"<{CLIENT_ID_SIZE}s", self.clientID)
-            data += struct.pack(f"<{len(self.AESKey)}s", self.AESKey)
-            return data
+            header = self.header
+            header.payloadSize = CLIENT_ID_SIZE + len(self.AESKey)
+            return AES_KEY_RESPONSE.pack(header.version, header.code, header.payloadSize, self.clientID) + bytes(self.AESKey)
         except Exception as e:
             raise Exception(f"Error packing AES key response: {e}")
 
 class FileReceivedResponse:
+    __slots__ = ("header", "clientID", "contentSize", "fileName", "checksum")
+
     def __init__(self):
         self.header = ResponseHeader(ResponseCode.RESPONSE_FILE_RECEIVED.value)
         self.header.payloadSize = CLIENT_ID_SIZE + CONTENT_SIZE_SIZE + FILE_NAME_SIZE + CHECKSUM_SIZE
@@ -191,23 +469,16 @@ class FileReceivedResponse:
 
     def pack(self):
         try:
-            data = self.header.pack()
-            data += struct.pack(f"<{CLIENT_ID_SIZE}s", self.clientID)
-            data += struct.pack(f"<L", self.contentSize)
-
-            encoded = self.fileName.encode('utf-8')
-            fileNameByteArray = bytearray(encoded)
-            if len(fileNameByteArray) < FILE_NAME_SIZE:
-                fileNameByteArray += bytearray(FILE_NAME_SIZE - len(fileNameByteArray))
-
-            data += struct.pack(f"<{FILE_NAME_SIZE}s", fileNameByteArray)
-            data += struct.pack(f"<L", self.checksum)
-            return data
+            header = self.header
+            return FILE_RECEIVED_RESPONSE.pack(header.version, header.code, header.payloadSize, self.clientID, self.contentSize,
+                                               self.fileName.encode('utf-8'), self.checksum)
         except Exception as e:
-            raise Exception(f"Error packing AES key response: {e}")
+            raise Exception(f"Error packing file received response: {e}")
 
 #Message received ressponse - returned in reponse to valid\invalid CRC requests
 class MessageReceivedResponse:
+    __slots__ = ("header",)
+
     def __init__(self):
         self.header = ResponseHeader(ResponseCode.RESPONSE_MESSAGE_RECEIVED.value)
         self.header.payloadSize = 0
@@ -217,3 +488,118 @@ class MessageReceivedResponse:
             return self.header.pack()
         except Exception as e:
             raise Exception(f"Error packing message received response: {e}")
+
+#Large frame mode response (version 4) - the frame size the server accepted
+class LargeFrameResponse:
+    __slots__ = ("header", "frameSize")
+
+    def __init__(self):
+        self.header = ResponseHeader(ResponseCode.RESPONSE_LARGE_FRAME.value, LARGE_FRAME_VERSION)
+        self.header.payloadSize = FRAME_SIZE_SIZE
+        self.frameSize = 0
+
+    def pack(self):
+        try:
+            header = self.header
+            return LARGE_FRAME_RESPONSE.pack(header.version, header.code, header.payloadSize, self.frameSize)
+        except Exception as e:
+            raise Exception(f"Error packing large frame response: {e}")
+
+#Upload offset response (version 5) - size of the encrypted content of the interrupted upload of the file, and the offset
+#in it the upload can be resumed from (both 0 if there is no upload to resume)
+class UploadOffsetResponse:
+    __slots__ = ("header", "clientID", "contentSize", "fileName", "offset")
+
+    def __init__(self):
+        self.header = ResponseHeader(ResponseCode.RESPONSE_UPLOAD_OFFSET.value, RESUME_VERSION)
+        self.header.payloadSize = CLIENT_ID_SIZE + CONTENT_SIZE_SIZE + FILE_NAME_SIZE + OFFSET_SIZE
+        self.clientID = b""
+        self.contentSize = 0
+        self.fileName = ""
+        self.offset = 0
+
+    def pack(self):
+        try:
+            header = self.header
+            return UPLOAD_OFFSET_RESPONSE.pack(header.version, header.code, header.payloadSize, self.clientID, self.contentSize,
+                                               self.fileName.encode('utf-8'), self.offset)
+        except Exception as e:
+            raise Exception(f"Error packing upload offset response: {e}")
+
+#Session mode response (version 6) - the connection stays open after CRC requests from now on
+class SessionModeResponse:
+    __slots__ = ("header",)
+
+    def __init__(self):
+        self.header = ResponseHeader(ResponseCode.RESPONSE_SESSION_MODE.value, SESSION_VERSION)
+        self.header.payloadSize = 0
+
+    def pack(self):
+        try:
+            return self.header.pack()
+        except Exception as e:
+            raise Exception(f"Error packing session mode response: {e}")
+
+#Batch received response (version 6) - status (BatchFileStatus) and checksum calculated by the server of each file in
+#the batch, in the order of the request. files is a list of (file name, status, checksum).
+#The response is packed into a single preallocated buffer
+class BatchReceivedResponse:
+    __slots__ = ("header", "clientID", "files")
+    FILE_SIZE = BATCH_RECEIVED_FILE.size
+
+    def __init__(self):
+        self.header = ResponseHeader(ResponseCode.RESPONSE_BATCH_RECEIVED.value, SESSION_VERSION)
+        self.clientID = b""
+        self.files = []
+
+    def pack(self):
+        try:
+            header = self.header
+            header.payloadSize = CLIENT_ID_SIZE + FILE_COUNT_SIZE + len(self.files) * BatchReceivedResponse.FILE_SIZE
+            data = bytearray(RESPONSE_HEADER.size + header.payloadSize)
+            BATCH_RECEIVED_RESPONSE.pack_into(data, 0, header.version, header.code, header.payloadSize, self.clientID, len(self.files))
+            offset = BATCH_RECEIVED_RESPONSE.size
+            for fileName, status, checksum in self.files:
+                BATCH_RECEIVED_FILE.pack_into(data, offset, fileName.encode('utf-8'), status, checksum)
+                offset += BATCH_RECEIVED_FILE.size
+            return data
+        except Exception as e:
+            raise Exception(f"Error packing batch received response: {e}")
+
+#Streams opened response (version 8) - ID of the new multi-stream upload, and the number of segments to send
+class StreamsOpenedResponse:
+    __slots__ = ("header", "clientID", "uploadID", "segmentCount")
+
+    def __init__(self):
+        self.header = ResponseHeader(ResponseCode.RESPONSE_STREAMS_OPENED.value, MULTI_STREAM_VERSION)
+        self.header.payloadSize = CLIENT_ID_SIZE + UPLOAD_ID_SIZE + SEGMENT_INDEX_SIZE
+        self.clientID = b""
+        self.uploadID = b""
+        self.segmentCount = 0
+
+    def pack(self):
+        try:
+            header = self.header
+            return STREAMS_OPENED_RESPONSE.pack(header.version, header.code, header.payloadSize, self.clientID, self.uploadID, self.segmentCount)
+        except Exception as e:
+            raise Exception(f"Error packing streams opened response: {e}")
+
+#Segment received response (version 8) - CRC of the plaintext of the segment
+class SegmentReceivedResponse:
+    __slots__ = ("header", "clientID", "uploadID", "segmentIndex", "checksum")
+
+    def __init__(self):
+        self.header = ResponseHeader(ResponseCode.RESPONSE_SEGMENT_RECEIVED.value, MULTI_STREAM_VERSION)
+        self.header.payloadSize = CLIENT_ID_SIZE + UPLOAD_ID_SIZE + SEGMENT_INDEX_SIZE + CHECKSUM_SIZE
+        self.clientID = b""
+        self.uploadID = b""
+        self.segmentIndex = 0
+        self.checksum = 0
+
+    def pack(self):
+        try:
+            header = self.header
+            return SEGMENT_RECEIVED_RESPONSE.pack(header.version, header.code, header.payloadSize, self.clientID, self.uploadID,
+                                                  self.segmentIndex, self.checksum)
+        except Exception as e:
+            raise Exception(f"Error packing segment received response: {e}")
\ No newline at end of file
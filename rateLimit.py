@@ -0,0 +1,69 @@
+import threading
+import time
+
+#Token bucket refilled with rate tokens per second, up to capacity. A request is allowed when the bucket has the tokens
+#it needs (a request bigger than capacity needs a full bucket), and takes them all - the bucket may go below zero, so a
+#large upload is allowed, and the client then waits until it is paid back
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "time")
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.time = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+
+    def has(self, amount):
+        return self.tokens >= min(amount, self.capacity)
+
+    def isFull(self, now):
+        return self.tokens + (now - self.time) * self.rate >= self.capacity
+
+#Upload rate limits per client ID - uploads per second and bytes per second, each a token bucket (a rate of 0 disables
+#its limit). Buckets of idle clients are full, and are removed when there are more than maxClients
+class ClientRateLimiter:
+    def __init__(self, uploadsPerSecond=0, uploadBurst=10, bytesPerSecond=0, byteBurst=64 * 1024 * 1024, maxClients=100000):
+        self.uploadsPerSecond = uploadsPerSecond
+        self.uploadBurst = uploadBurst
+        self.bytesPerSecond = bytesPerSecond
+        self.byteBurst = byteBurst
+        self.maxClients = maxClients
+        self.enabled = uploadsPerSecond > 0 or bytesPerSecond > 0
+        self.lock = threading.Lock()
+        #client ID -> (uploads bucket, bytes bucket)
+        self.clients = {}
+
+    #Check if client can upload size bytes in uploads files now, and take them from its buckets if it can
+    def allowUpload(self, clientId, size, uploads=1):
+        if not self.enabled:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            buckets = self.clients.get(clientId)
+            if buckets is None:
+                if len(self.clients) >= self.maxClients:
+                    self.removeIdle(now)
+                buckets = self.clients[clientId] = (TokenBucket(self.uploadsPerSecond, self.uploadBurst, now),
+                                                    TokenBucket(self.bytesPerSecond, self.byteBurst, now))
+            uploadBucket, byteBucket = buckets
+            uploadBucket.refill(now)
+            byteBucket.refill(now)
+            if self.uploadsPerSecond > 0 and not uploadBucket.has(uploads):
+                return False
+            if self.bytesPerSecond > 0 and not byteBucket.has(size):
+                return False
+            if self.uploadsPerSecond > 0:
+                uploadBucket.tokens -= uploads
+            if self.bytesPerSecond > 0:
+                byteBucket.tokens -= size
+            return True
+
+    #Remove clients whose buckets are full - they would get the same buckets when they upload again
+    def removeIdle(self, now):
+        for clientId in [clientId for clientId, (uploadBucket, byteBucket) in self.clients.items()
+                         if uploadBucket.isFull(now) and byteBucket.isFull(now)]:
+            del self.clients[clientId]
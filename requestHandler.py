@@ -3,11 +3,19 @@ import protocol
 import crc
 import cryptUtil
 import database
+import uploadPipeline
+import storage
+import storageCodec
+import resumableUploads
+import multiStreamUploads
+import metrics
+import profiler
+import rateLimit
 import uuid
-import struct
-import os
-from pathlib import Path
-from datetime import datetime
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 #Validate file name to prevent path traversal
 def isValidFileName(fileName):
@@ -15,82 +23,335 @@ def isValidFileName(fileName):
         return False
     return True
 
+#Check an upload of size bytes (in uploads files) by client can be accepted - it is not bigger than maxContentSize
+#(0 - no limit), and the client is within its rate limits (rateLimit.ClientRateLimiter). Uploads are checked before any
+#of their content is read or stored, and rejected ones close the connection
+def checkUploadLimits(client, size, maxContentSize, rateLimiter, uploads=1):
+    if maxContentSize > 0 and size > maxContentSize:
+        metrics.uploadRejected("size")
+        raise Exception(f"Upload of {size} bytes by {client.Name} is bigger than the maximum {maxContentSize}!")
+    if not rateLimiter.allowUpload(client.ID, size, uploads):
+        metrics.uploadRejected("rate")
+        raise Exception(f"Client {client.Name} exceeded its upload rate limit!")
+
+#Maximal size of the next receive of upload content. Pipelined requests (version 7) are framed by their payload size, so
+#only the content left is read - the next request may follow it. Otherwise content is sent in whole frames (PACKET_SIZE,
+#or the large frame size), the last one padded, so a whole frame is read and the caller discards the bytes past the content
+def getReceiveSize(session, contentLeft):
+    if session.pipelined:
+        return min(session.frameSize, contentLeft)
+    return session.frameSize
+
+#Check if the current AES key of client can be sent again instead of generating a new one - if the same public key
+#is presented again within ttl seconds from the key exchange (ttl 0 disables reuse)
+def canReuseKeys(client, publicKey, ttl):
+    if ttl <= 0 or client.AES is None or client.KeysTime is None or client.PublicKey != publicKey:
+        return False
+    return time.monotonic() - client.KeysTime < ttl
+
+#Decrypt a file of a batch and check its CRC. A file with a valid CRC is written to a temp file.
+#Returns (status, checksum calculated by the server, (temp path, file name, content hash, codec) or None)
+def storeBatchFile(fileStorage, client, fileHeader, content):
+    if not isValidFileName(fileHeader.fileName):
+        return protocol.BatchFileStatus.BATCH_FILE_FAILED.value, 0, None
+    try:
+        decrypted = cryptUtil.AESDecrypt(client.AES).decrypt(content, True)
+    except ValueError:
+        return protocol.BatchFileStatus.BATCH_FILE_FAILED.value, 0, None
+    cksum = fileStorage.createChecksum(crc.Checksum())
+    cksum.update(decrypted)
+    checksum = cksum.digest()
+    #A file with an invalid CRC is never written
+    if checksum != fileHeader.checksum:
+        return protocol.BatchFileStatus.BATCH_FILE_INVALID_CRC.value, checksum, None
+
+    codec = fileStorage.getCodec(client, fileHeader.fileName)
+    file, tempPath = fileStorage.createTempFile(client.ID, fileHeader.fileName, codec)
+    try:
+        try:
+            file.write(decrypted)
+            fileStorage.syncFile(file)
+        finally:
+            file.close()
+    except Exception:
+        fileStorage.remove(tempPath)
+        raise
+    return protocol.BatchFileStatus.BATCH_FILE_SAVED.value, checksum, (tempPath, fileHeader.fileName, fileStorage.getContentHash(cksum, codec), codec)
+
+#Promote the stored files of a batch (from storeBatchFile) to their final paths, and save them as verified in a single
+#DB transaction
+def saveBatch(fileStorage, fileDatabase, client, storedFiles):
+    files = []
+    for tempPath, fileName, contentHash, codec in storedFiles:
+        filePath = fileStorage.getFilePath(client.ID, fileName)
+        fileStorage.promote(tempPath, filePath, contentHash)
+        files.append((filePath, fileName, contentHash, codec))
+    fileDatabase.saveFiles(client, files, True)
+
+#Write all buffers to conn, with scatter-gather sends where the socket supports them. Partial sends are continued,
+#and errors are raised
+def sendBuffers(conn, buffers):
+    if not hasattr(conn, "sendmsg"):
+        for buffer in buffers:
+            conn.sendall(buffer)
+        return
+    buffers = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    while buffers:
+        sent = conn.sendmsg(buffers)
+        while sent:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                del buffers[0]
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+
+#Reads a request payload which doesn't fit in the first packet - the rest of the first packet (data), and then from the
+#connection. Never reads past the end of the payload
+class PayloadReader:
+    def __init__(self, conn, data, payloadSize):
+        self.conn = conn
+        self.buffer = bytearray(data[:payloadSize])
+        self.left = payloadSize - len(self.buffer)
+
+    #Read exactly size bytes
+    def read(self, size):
+        while len(self.buffer) < size:
+            if self.left == 0:
+                raise Exception("Request payload is shorter than its content!")
+            data = self.conn.recv(min(self.left, max(size - len(self.buffer), uploadPipeline.PIPELINE_BUFFER_SIZE)))
+            if not data:
+                raise Exception("Connection closed before the request payload was fully received!")
+            self.buffer += data
+            self.left -= len(data)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+#Per-connection state. A new session is created for each connection, so a single Handler can serve many connections at once
+class Session:
+    def __init__(self, conn, padResponses=True):
+        self.conn = conn
+        #done is used to indicate wether to expect any more requests on this connection, or not.
+        #If no more requests are expected we can stop handling the connection and exit
+        self.done = False
+        #Size of file content reads. Larger than PACKET_SIZE after large frame mode is negotiated
+        self.frameSize = protocol.PACKET_SIZE
+        #Responses are padded to PACKET_SIZE, unless large frame mode is negotiated (or padding is disabled)
+        self.padResponses = padResponses
+        #In session mode the connection stays open after the CRC requests
+        self.sessionMode = False
+        #Received bytes of the next requests (of pipelined requests which were sent back to back)
+        self.readBuffer = bytearray()
+        #Once a pipelined (version 7) request is received, requests are read exactly and responses are written by
+        #a writer thread (responses, a queue of up to the response window), so the next requests are handled meanwhile
+        self.pipelined = False
+        self.correlationId = None
+        self.responses = None
+        self.writer = None
+        self.writeError = None
+        self.receiveBuffers = None
+        #Uploads waiting for CRC confirmation before they are promoted to their final path -
+        #(client ID, file name): (temp path, content hash, codec)
+        self.pendingUploads = {}
+
+    #Read from the connection until at least size bytes are in the read buffer - never more than that
+    def fill(self, size):
+        while len(self.readBuffer) < size:
+            data = self.conn.recv(size - len(self.readBuffer))
+            if not data:
+                raise Exception("Connection closed in the middle of a request!")
+            self.readBuffer += data
+
+    #Upload receive and decrypt buffers, reused for all uploads of this connection.
+    #Each holds a frame plus bytes left over from the previous frame (less than an AES block)
+    def getReceiveBuffers(self):
+        size = self.frameSize + protocol.PACKET_SIZE
+        if self.receiveBuffers is None or len(self.receiveBuffers[0]) != size:
+            self.receiveBuffers = (memoryview(bytearray(size)), memoryview(bytearray(size)))
+        return self.receiveBuffers
+
 #Handles a connection
 class Handler:
-    def __init__(self, databaseFile, clientFilesFolder):
-        self.database = database.Database(databaseFile)
-        self.clientFilesFolder = clientFilesFolder
+    #crcWorkers - number of threads used to calculate CRC of large files in parallel (0 to calculate inline)
+    #databaseOptions - keyword arguments for database.Database
+    #keyReuseTTL - seconds during which a client presenting the same public key again gets its current AES key (0 to disable)
+    #pipelineUploads - receive large files through an UploadPipeline, so decryption and disk writes don't block receiving
+    #storageOptions - keyword arguments for storage.Storage
+    #resumeTTL - seconds during which an interrupted upload can be resumed (0 to disable resumable uploads)
+    #responseWindow - maximal number of responses to pipelined requests waiting to be written on a connection. When it is
+    #reached, the next requests are not handled until responses are written
+    #multiStreamTTL - seconds after which a multi-stream upload without activity is removed
+    #padResponses - pad responses to PACKET_SIZE (the framing clients expect) until large frame mode is negotiated.
+    #Without it, responses are written without padding and clients read them by their payload size
+    #profilerOptions - keyword arguments for profiler.Profiler
+    #maxContentSize - maximal size of an upload (0 for no limit)
+    #rateLimitOptions - keyword arguments for rateLimit.ClientRateLimiter
+    #maxMultiStreamUploads - maximal number of multi-stream uploads in progress per client (0 for no limit)
+    def __init__(self, databaseFile, clientFilesFolder, crcWorkers=0, databaseOptions=None, keyReuseTTL=0, pipelineUploads=False, storageOptions=None,
+                 resumeTTL=0, responseWindow=16, multiStreamTTL=60 * 60, padResponses=True, profilerOptions=None, maxContentSize=0,
+                 rateLimitOptions=None, maxMultiStreamUploads=0):
+        self.database = database.Database(databaseFile, **(databaseOptions or {}))
+        self.keyReuseTTL = keyReuseTTL
+        self.pipelineUploads = pipelineUploads
+        self.responseWindow = responseWindow
+        self.padResponses = padResponses
+        self.maxContentSize = maxContentSize
+        self.rateLimiter = rateLimit.ClientRateLimiter(**(rateLimitOptions or {}))
+        self.storage = storage.Storage(clientFilesFolder, **(storageOptions or {}))
+        self.uploads = resumableUploads.ResumableUploads(self.database, self.storage, resumeTTL)
+        self.uploads.removeExpired()
+        self.storage.cleanup(self.uploads.getTempPaths())
+        self.multiStreamUploads = multiStreamUploads.MultiStreamUploads(self.storage, multiStreamTTL, maxContentSize, maxMultiStreamUploads)
+        self.storage.startGarbageCollector(self.database)
+        self.crcExecutor = ThreadPoolExecutor(max_workers=crcWorkers) if crcWorkers > 0 else None
+        self.profiler = profiler.Profiler(**(profilerOptions or {}))
         self.handlers = {
             protocol.RequestCode.REQUEST_REGISTRATION.value: self.handleRegistrationRequest,
             protocol.RequestCode.REQUEST_PUBLIC_KEY.value: self.handlePublicKeyRequest,
             protocol.RequestCode.REQUEST_SEND_FILE.value: self.handleSendFileRequest,
             protocol.RequestCode.REQUEST_VALID_CRC.value: self.handleValidCRCRequest,
             protocol.RequestCode.REQUEST_INVALID_CRC.value: self.handleInvalidCRCRequest,
-            protocol.RequestCode.REQUEST_LAST_INVALID_CRC.value: self.handleLastInvalidCRCRequest
+            protocol.RequestCode.REQUEST_LAST_INVALID_CRC.value: self.handleLastInvalidCRCRequest,
+            protocol.RequestCode.REQUEST_LARGE_FRAME.value: self.handleLargeFrameRequest,
+            protocol.RequestCode.REQUEST_UPLOAD_OFFSET.value: self.handleUploadOffsetRequest,
+            protocol.RequestCode.REQUEST_RESUME_FILE.value: self.handleResumeFileRequest,
+            protocol.RequestCode.REQUEST_SESSION_MODE.value: self.handleSessionModeRequest,
+            protocol.RequestCode.REQUEST_SEND_BATCH.value: self.handleSendBatchRequest,
+            protocol.RequestCode.REQUEST_OPEN_STREAMS.value: self.handleOpenStreamsRequest,
+            protocol.RequestCode.REQUEST_SEND_SEGMENT.value: self.handleSendSegmentRequest,
+            protocol.RequestCode.REQUEST_CLOSE_STREAMS.value: self.handleCloseStreamsRequest
         }
 
-    def write(self, conn, data):
-        size = len(data)
-        sent = 0
-        while sent < size:
-            leftover = size - sent
-            if leftover > protocol.PACKET_SIZE:
-                leftover = protocol.PACKET_SIZE
-            toSend = data[sent:sent + leftover]
-            if len(toSend) < protocol.PACKET_SIZE:
-                toSend += bytearray(protocol.PACKET_SIZE - len(toSend))
-            try:
-                conn.send(toSend)
-                sent += len(toSend)
-            except Exception as e:
-                print(f"Exception while sending response to {conn}: {e}")
+    #Write response to the current request. A response to a pipelined request gets its correlation ID, and is queued for
+    #the writer thread (waiting while the response window is full). The response, its correlation ID and padding are
+    #written with a single scatter-gather send, without copying them into one buffer
+    def write(self, session, data):
+        buffers = protocol.getResponseBuffers(data, session.correlationId, session.padResponses)
+        if session.responses is None:
+            sendBuffers(session.conn, buffers)
+            return
+        if session.writeError is not None:
+            raise session.writeError
+        session.responses.put(buffers)
+
+    #Writer thread of a pipelined session - writes queued responses in order. After a failed write the rest are dropped,
+    #and the error is raised to the handler on its next write
+    def writeResponses(self, session):
+        while True:
+            response = session.responses.get()
+            if response is None:
+                break
+            if session.writeError is None:
+                try:
+                    sendBuffers(session.conn, response)
+                except Exception as e:
+                    session.writeError = e
+
+    def startPipelining(self, session):
+        session.pipelined = True
+        session.responses = queue.Queue(self.responseWindow)
+        session.writer = threading.Thread(target=self.writeResponses, args=(session,), daemon=True)
+        session.writer.start()
+
+    #Wait until all queued responses are written
+    def stopPipelining(self, session):
+        if session.writer is not None:
+            session.responses.put(None)
+            session.writer.join()
+
+    #Receive the next request. Returns its header and the payload received with it - all of the payload if it fits in
+    #a packet with the header (more content is read by the request handler), or (None, None) if the connection is closed.
+    #Requests are received in PACKET_SIZE reads, and up to version 6 a packet belongs to a single request. Pipelined
+    #requests are read exactly, and bytes of the next requests are kept in the session read buffer
+    def receiveRequest(self, session):
+        buffer = session.readBuffer
+        if not buffer:
+            data = session.conn.recv(protocol.PACKET_SIZE)
+            if not data:
+                return None, None
+            buffer += data
+        session.fill(protocol.VERSION_OFFSET + protocol.VERSION_SIZE)
+        session.fill(protocol.getRequestHeaderSize(buffer[protocol.VERSION_OFFSET]))
+
+        requestHeader = protocol.RequestHeader()
+        requestHeader.unpack(buffer)
+        if requestHeader.version >= protocol.PIPELINE_VERSION and not session.pipelined:
+            self.startPipelining(session)
+        session.correlationId = requestHeader.correlationId
+
+        if session.pipelined:
+            size = requestHeader.SIZE + min(requestHeader.payloadSize, protocol.PACKET_SIZE - requestHeader.SIZE)
+            session.fill(size)
+        else:
+            size = len(buffer)
+        data = bytes(buffer[requestHeader.SIZE:size])
+        del buffer[:size]
+        return requestHeader, data
 
     def handle(self, conn):
-        #done is used to indicate wether to expect any more requests on this connection, or not.
-        #If no more requests are expected we can stop handling the connection and exit
-        self.done = False
+        session = Session(conn, self.padResponses)
+        metrics.connectionOpened()
+        profile = self.profiler.sampleConnection()
         try:
-            while not self.done:
-                data = conn.recv(protocol.PACKET_SIZE)
-                if data:
-                    #Parse request header and call the appropriate method to handle the request
-                    requestHeader = protocol.RequestHeader()
-                    requestHeader.unpack(data)
+            while not session.done:
+                requestHeader, data = self.receiveRequest(session)
+                if requestHeader is not None:
+                    #Call the appropriate method to handle the request
                     if requestHeader.code in self.handlers.keys():
-                        self.handlers[requestHeader.code](conn, requestHeader, data[requestHeader.SIZE:])
+                        start = time.perf_counter()
+                        failed = True
+                        try:
+                            if profile is None:
+                                self.handlers[requestHeader.code](session, requestHeader, data)
+                            else:
+                                profile.run(requestHeader.code, self.handlers[requestHeader.code], session, requestHeader, data)
+                            failed = False
+                        finally:
+                            metrics.recordRequest(requestHeader.code, time.perf_counter() - start, failed)
                     else:
                         raise Exception(f"Request code {requestHeader.code} doesn't exist!")
                 else:
-                    self.done = True
+                    session.done = True
         except Exception as e:
-            print(f"Exception in handle request: {e}")
+            #The traceback only at DEBUG level - clients disconnecting mid-request are common
+            logging.error("Exception in handle request: %s", e, exc_info=logging.getLogger().isEnabledFor(logging.DEBUG))
             return
+        finally:
+            metrics.connectionClosed()
+            if profile is not None:
+                profile.close()
+            self.stopPipelining(session)
+            #Uploads that were never confirmed are discarded
+            for tempPath, contentHash, codec in session.pendingUploads.values():
+                self.storage.remove(tempPath)
             # Not sure what to do here. There are no details in the assignment what to do in case of any error (other than registration error).
             # Here I do nothing, but I could send some generic error code like the next two lines:
             # responseHeader = protocol.ResponseHeader(protocol.ResponseCode.RESPONSE_ERROR.value)
-            # self.write(conn, responseHeader.pack())
+            # self.write(session, responseHeader.pack())
 
     #Handle registration request
-    def handleRegistrationRequest(self, conn, requestHeader, data):
+    def handleRegistrationRequest(self, session, requestHeader, data):
         request = protocol.RegistrationRequest()
         request.unpack(data)
 
-        #Check username is available
-        if self.database.getClientByUsername(request.name) is not None:
-            response = protocol.RegistrationFailedResponse()
-            self.write(conn, response.pack())
-            return
+        #Check username is available. Check and store under the DB lock so two connections can't register the same name
+        with self.database.lock:
+            if self.database.getClientByUsername(request.name) is not None:
+                response = protocol.RegistrationFailedResponse()
+                self.write(session, response.pack())
+                return
 
-        client = database.Client(uuid.uuid4().bytes, request.name, None, None, None)
-        self.database.storeClient(client)
+            client = database.Client(uuid.uuid4().bytes, request.name, None, None, None)
+            self.database.storeClient(client)
 
         response = protocol.RegistrationSuccessResponse()
         response.clientID = client.ID
-        self.write(conn, response.pack())
-        print(f"Successful regustration of: \n{client}\n")
+        self.write(session, response.pack())
+        logging.info("Successful registration of client: %s", client.Name)
 
     #Handle key exchange request
-    def handlePublicKeyRequest(self, conn, requestHeader, data):
+    def handlePublicKeyRequest(self, session, requestHeader, data):
         client = self.database.getClientById(requestHeader.clientID)
         if client is None:
             raise Exception(f"User with id {requestHeader.clientID} doesn't exist!")
@@ -100,20 +361,24 @@ class Handler:
         request = protocol.PublicKeyRequest()
         request.unpack(data)
 
-        #Generate new AES Key for client
-        AESKey = cryptUtil.generateAESKey()
-        self.database.setClientKeys(client, request.publicKey, AESKey)
+        #Generate new AES Key for client, unless the current one can be reused (saves the DB write)
+        if canReuseKeys(client, request.publicKey, self.keyReuseTTL):
+            AESKey = client.AES
+        else:
+            AESKey = cryptUtil.generateAESKey()
+            self.database.setClientKeys(client, request.publicKey, AESKey)
+            self.uploads.discardClient(client)
 
         #Encrypt AES Key with RSA using public key supplied by user, and send encrypted AES Key back to the client
         encryptedKey = cryptUtil.encryptWithPublicKey(AESKey, client.PublicKey)
         response = protocol.AESKeyResponse()
         response.clientID = client.ID
         response.AESKey = encryptedKey
-        self.write(conn, response.pack())
-        print(f"Successful regustration of encryption keys for client: \n{client}\n")
+        self.write(session, response.pack())
+        logging.info("Successful registration of encryption keys for client: %s", client.Name)
 
     #Handle new file request
-    def handleSendFileRequest(self, conn, requestHeader, data):
+    def handleSendFileRequest(self, session, requestHeader, data):
         client = self.database.getClientById(requestHeader.clientID)
         if client is None:
             raise Exception(f"User with id {requestHeader.clientID} doesn't exist!")
@@ -130,60 +395,307 @@ class Handler:
         if not isValidFileName(request.fileName):
             raise Exception(f"Filename {request.fileName} is invalid!")
 
-        #Create the file on the server
-        path = self.clientFilesFolder + "/" + client.ID.hex()
-        Path(path).mkdir(parents=True, exist_ok=True)
-        filePath =  path + "/" + request.fileName
-        file = open(filePath, "wb+")
-
-        #Read encrypted data. isLastBlock is used to know when we should unpad decrypted data
-        isLastBlock = False
-        bytesRead = len(data) - request.SIZE
-        if bytesRead >= request.contentSize:
-            bytesRead = request.contentSize
-            isLastBlock = True
-
-        #Read, decrypt and update CRC calulation with each incoming packet
-        cksum = crc.Checksum()
+        checkUploadLimits(client, request.contentSize, self.maxContentSize, self.rateLimiter)
+
+        #A new upload of the file replaces its interrupted upload
+        self.uploads.discard(client, request.fileName)
+
+        #Create the file on the server. The upload is written to a temp file, so the previous version stays intact until it is replaced.
+        #It is compressed while it is written if the storage codec of the file isn't CODEC_NONE
+        codec = self.storage.getCodec(client, request.fileName)
+        file, tempPath = self.storage.createTempFile(client.ID, request.fileName, codec)
+
+        cksum = self.storage.createChecksum(crc.createChecksum(request.contentSize, self.crcExecutor))
         decryptor = cryptUtil.AESDecrypt(client.AES)
+        self.receiveUpload(session, client, request, data, codec, file, tempPath, decryptor, cksum, resumableUploads.UploadProgress())
 
-        bytesToDecrypt = decryptor.getBytesToDecrypt(bytesRead)
-        decrypted = decryptor.decrypt(data[request.SIZE:request.SIZE + bytesToDecrypt], isLastBlock)
-        cksum.update(decrypted)
-        file.write(decrypted)
-        leftOverBytes = data[request.SIZE + bytesToDecrypt:]
-        totalDecryptedSize = len(decrypted)
-
-        while bytesRead < request.contentSize:
-            newData = conn.recv(protocol.PACKET_SIZE)
-            dataSize = len(newData)
-            if (request.contentSize - bytesRead) <= dataSize:
-                dataSize = request.contentSize - bytesRead
-                isLastBlock = True
-            leftOverBytes += newData[:dataSize]
-            bytesToDecrypt = decryptor.getBytesToDecrypt(len(leftOverBytes))
-            decrypted = decryptor.decrypt(leftOverBytes[:bytesToDecrypt], isLastBlock)
-            cksum.update(decrypted)
-            totalDecryptedSize += len(decrypted)
-            file.write(decrypted)
-            leftOverBytes = leftOverBytes[bytesToDecrypt:]
-            bytesRead += dataSize
+    #Handle resume file request (version 5) - the rest of the content of an interrupted upload
+    def handleResumeFileRequest(self, session, requestHeader, data):
+        if requestHeader.version < protocol.RESUME_VERSION:
+            raise Exception(f"Resuming uploads requires version {protocol.RESUME_VERSION}, got {requestHeader.version}!")
+
+        client = self.database.getClientById(requestHeader.clientID)
+        if client is None:
+            raise Exception(f"User with id {requestHeader.clientID} doesn't exist!")
 
-        file.close()
+        self.database.updateClientLastSeen(client)
 
-        self.database.saveFile(client, filePath, request.fileName)
+        if client.AES is None:
+            raise Exception(f"User with id {requestHeader.clientID} doesn't have AES key yet!")
+
+        request = protocol.ResumeFileRequest()
+        request.unpack(data)
+
+        if not isValidFileName(request.fileName):
+            raise Exception(f"Filename {request.fileName} is invalid!")
+
+        checkUploadLimits(client, request.contentSize - request.offset, self.maxContentSize, self.rateLimiter)
+
+        #Continue writing the temp file, decryption and CRC calculation from where the upload was interrupted
+        file, tempPath, decryptor, cksum, progress = self.uploads.resume(client, request, self.crcExecutor)
+        self.receiveUpload(session, client, request, data, storageCodec.CODEC_NONE, file, tempPath, decryptor, cksum, progress)
+
+    #Handle upload offset request (version 5) - how much of an interrupted upload can be skipped when it is resumed
+    def handleUploadOffsetRequest(self, session, requestHeader, data):
+        if requestHeader.version < protocol.RESUME_VERSION:
+            raise Exception(f"Resuming uploads requires version {protocol.RESUME_VERSION}, got {requestHeader.version}!")
+
+        client = self.database.getClientById(requestHeader.clientID)
+        if client is None:
+            raise Exception(f"User with id {requestHeader.clientID} doesn't exist!")
+
+        request = protocol.UploadOffsetRequest()
+        request.unpack(data)
+
+        response = protocol.UploadOffsetResponse()
+        response.clientID = client.ID
+        response.fileName = request.fileName
+        response.contentSize, response.offset = self.uploads.getOffset(client, request.fileName)
+        self.write(session, response.pack())
+
+    #Receive upload content (from progress.offset), decrypt it, update CRC calculation and write it to the temp file,
+    #then promote the upload (now or on CRC confirmation) and respond with the CRC. An interrupted upload is kept to be
+    #resumed later, if possible
+    def receiveUpload(self, session, client, request, data, codec, file, tempPath, decryptor, cksum, progress):
+        try:
+            if self.pipelineUploads and request.contentSize - progress.offset >= uploadPipeline.PIPELINE_MIN_SIZE:
+                bytesRead = self.receiveFilePipelined(session, request, data, decryptor, cksum, file, progress)
+            else:
+                bytesRead = self.receiveFile(session, request, data, decryptor, cksum, file, progress)
+            start = time.perf_counter()
+            self.storage.syncFile(file)
+            metrics.recordStage("sync", time.perf_counter() - start)
+        except Exception:
+            self.uploads.interrupt(client, request, codec, file, tempPath, progress, decryptor, cksum)
+            raise
+        finally:
+            file.close()
+
+        self.completeUpload(session, client, request.fileName, tempPath, cksum, codec, bytesRead, progress.decryptedSize)
+
+    #Promote a received upload (now or on CRC confirmation) and respond with its CRC
+    def completeUpload(self, session, client, fileName, tempPath, cksum, codec, contentSize, decryptedSize):
+        #Promote the upload now, or when the client confirms the CRC
+        contentHash = self.storage.getContentHash(cksum, codec)
+        if self.storage.promoteOnVerify:
+            previous = session.pendingUploads.pop((client.ID, fileName), None)
+            if previous is not None:
+                self.storage.remove(previous[0])
+            session.pendingUploads[(client.ID, fileName)] = (tempPath, contentHash, codec)
+        else:
+            self.promoteUpload(client, tempPath, fileName, contentHash, codec)
 
         #Send response to client
         response = protocol.FileReceivedResponse()
         response.clientID = client.ID
-        response.contentSize = bytesRead
-        response.fileName = request.fileName + "\0" #Protocol requires to return filename as it was received from client - with null terminator
+        response.contentSize = contentSize
+        response.fileName = fileName + "\0" #Protocol requires to return filename as it was received from client - with null terminator
         response.checksum =  cksum.digest()
-        self.write(conn, response.pack())
-        print(f"Successful file upload for client: \n{client}\nName: {request.fileName}, Content size(Encrypted): {bytesRead}, Content size(Decrypted): {totalDecryptedSize}, Checksum: {response.checksum}\n")
+        self.write(session, response.pack())
+        logging.info("Successful file upload for client: %s, Name: %s, Content size(Encrypted): %d, Content size(Decrypted): %d, Checksum: %d, Codec: %s",
+                     client.Name, fileName, contentSize, decryptedSize, response.checksum, codec)
+
+    #Get the client of a multi-stream upload request (version 8), which must have an AES key
+    def getMultiStreamClient(self, requestHeader):
+        if requestHeader.version < protocol.MULTI_STREAM_VERSION:
+            raise Exception(f"Multi-stream uploads require version {protocol.MULTI_STREAM_VERSION}, got {requestHeader.version}!")
+
+        client = self.database.getClientById(requestHeader.clientID)
+        if client is None:
+            raise Exception(f"User with id {requestHeader.clientID} doesn't exist!")
+
+        self.database.updateClientLastSeen(client)
+
+        if client.AES is None:
+            raise Exception(f"User with id {requestHeader.clientID} doesn't have AES key yet!")
+        return client
+
+    #Handle open streams request (version 8) - start a multi-stream upload, whose segments may be sent on any connection
+    def handleOpenStreamsRequest(self, session, requestHeader, data):
+        client = self.getMultiStreamClient(requestHeader)
+
+        request = protocol.OpenStreamsRequest()
+        request.unpack(data)
+
+        if not isValidFileName(request.fileName):
+            raise Exception(f"Filename {request.fileName} is invalid!")
+
+        checkUploadLimits(client, request.fileSize, self.maxContentSize, self.rateLimiter)
+
+        upload = self.multiStreamUploads.open(client, request.fileName, request.fileSize, request.segmentSize)
+
+        response = protocol.StreamsOpenedResponse()
+        response.clientID = client.ID
+        response.uploadID = upload.uploadId
+        response.segmentCount = upload.segmentCount
+        self.write(session, response.pack())
+        logging.info("Multi-stream upload of file %s for client %s opened: %d bytes in %d segments", request.fileName, client.Name, request.fileSize, upload.segmentCount)
+
+    #Handle send segment request (version 8) - receive a segment, encrypted with its own IV, and write it at its offset
+    def handleSendSegmentRequest(self, session, requestHeader, data):
+        client = self.getMultiStreamClient(requestHeader)
+
+        request = protocol.SendSegmentRequest()
+        request.unpack(data)
+
+        upload = self.multiStreamUploads.get(client, request.uploadID, request.fileName)
+        writer = upload.startSegment(request.segmentIndex)
+        cksum = crc.createChecksum(request.contentSize, self.crcExecutor)
+        decryptor = cryptUtil.AESDecrypt(client.AES, request.iv)
+        progress = resumableUploads.UploadProgress()
+        try:
+            if self.pipelineUploads and request.contentSize >= uploadPipeline.PIPELINE_MIN_SIZE:
+                self.receiveFilePipelined(session, request, data, decryptor, cksum, writer, progress)
+            else:
+                self.receiveFile(session, request, data, decryptor, cksum, writer, progress)
+        except Exception:
+            upload.finishSegment(request.segmentIndex)
+            raise
+        upload.finishSegment(request.segmentIndex, cksum, request.contentSize)
+
+        response = protocol.SegmentReceivedResponse()
+        response.clientID = client.ID
+        response.uploadID = upload.uploadId
+        response.segmentIndex = request.segmentIndex
+        response.checksum = cksum.digest()
+        self.write(session, response.pack())
+
+    #Handle close streams request (version 8) - complete a multi-stream upload whose segments were all received. Its CRC
+    #is combined from the CRCs of the segments, and it is confirmed with the CRC requests like any upload
+    def handleCloseStreamsRequest(self, session, requestHeader, data):
+        client = self.getMultiStreamClient(requestHeader)
+
+        request = protocol.CloseStreamsRequest()
+        request.unpack(data)
+
+        upload = self.multiStreamUploads.take(client, request.uploadID, request.fileName)
+        self.uploads.discard(client, request.fileName)
+        try:
+            cksum = self.storage.createChecksum(crc.Checksum())
+            self.storage.restoreChecksum(cksum, upload.getChecksum().getState(), upload.file, upload.fileSize)
+            self.storage.syncFile(upload.file)
+        except Exception:
+            self.storage.remove(upload.tempPath)
+            raise
+        finally:
+            upload.file.close()
+
+        self.completeUpload(session, client, request.fileName, upload.tempPath, cksum, storageCodec.CODEC_NONE, upload.encryptedSize, upload.fileSize)
+
+    #Move upload to its final path and store it in the DB
+    def promoteUpload(self, client, tempPath, fileName, contentHash=None, codec=storageCodec.CODEC_NONE, verified=False):
+        start = time.perf_counter()
+        filePath = self.storage.getFilePath(client.ID, fileName)
+        self.storage.promote(tempPath, filePath, contentHash)
+        self.database.saveFile(client, filePath, fileName, contentHash, codec, verified)
+        metrics.recordStage("commit", time.perf_counter() - start)
+
+    #Receive file content from progress.offset, decrypt it, update CRC calculation and write it to file, all on the current
+    #thread. progress is updated with every write. Returns the number of bytes read (including the skipped offset)
+    def receiveFile(self, session, request, data, decryptor, cksum, file, progress):
+        #Read, decrypt and update CRC calulation with each incoming packet.
+        #Packets are received into a preallocated buffer and decrypted into a second preallocated buffer, so no
+        #memory is allocated per packet. Bytes that don't complete an AES block are moved to the start of the buffer.
+        receivedView, decryptedView = session.getReceiveBuffers()
+        #Stage times are summed here, and recorded once the whole file is received
+        times = metrics.UploadTimes()
+        startOffset, startSize = progress.offset, progress.decryptedSize
+
+        bufferedBytes = min(len(data) - request.SIZE, request.contentSize - progress.offset)
+        receivedView[:bufferedBytes] = data[request.SIZE:request.SIZE + bufferedBytes]
+        bytesRead = progress.offset + bufferedBytes
+
+        while True:
+            #isLastBlock is used to know when we should unpad decrypted data
+            isLastBlock = bytesRead == request.contentSize
+            bytesToDecrypt = decryptor.getBytesToDecrypt(bufferedBytes)
+            if bytesToDecrypt or isLastBlock:
+                start = time.perf_counter()
+                decryptedSize = decryptor.decryptInto(receivedView[:bytesToDecrypt], decryptedView, isLastBlock)
+                decryptEnd = time.perf_counter()
+                cksum.update(decryptedView[:decryptedSize])
+                crcEnd = time.perf_counter()
+                file.write(decryptedView[:decryptedSize])
+                writeEnd = time.perf_counter()
+                times.decrypt += decryptEnd - start
+                times.crc += crcEnd - decryptEnd
+                times.write += writeEnd - crcEnd
+                progress.offset += bytesToDecrypt
+                progress.decryptedSize += decryptedSize
+                bufferedBytes -= bytesToDecrypt
+                receivedView[:bufferedBytes] = receivedView[bytesToDecrypt:bytesToDecrypt + bufferedBytes]
+            if isLastBlock:
+                break
+
+            start = time.perf_counter()
+            dataSize = session.conn.recv_into(receivedView[bufferedBytes:], getReceiveSize(session, request.contentSize - bytesRead))
+            times.recv += time.perf_counter() - start
+            if dataSize == 0:
+                raise Exception(f"Connection closed before file {request.fileName} was fully received!")
+            #Padding of the last frame is discarded
+            dataSize = min(dataSize, request.contentSize - bytesRead)
+            bytesRead += dataSize
+            bufferedBytes += dataSize
+
+        times.record(progress.offset - startOffset, progress.decryptedSize - startSize)
+        return bytesRead
+
+    #Receive file content through an UploadPipeline - decryption with CRC calculation and disk writes run on their own
+    #threads. Packets are received into pipeline buffers, and a buffer is submitted when it is full (or the content ended).
+    #If receiving fails, the whole AES blocks received so far are still written, so the upload can be resumed after them.
+    #progress is updated when the pipeline is done. Returns the number of bytes read (including the skipped offset)
+    def receiveFilePipelined(self, session, request, data, decryptor, cksum, file, progress):
+        #Buffer size must be a multiple of the AES block size, so only the last buffer has to be unpadded. Buffers have room
+        #for a frame past bufferSize, so a whole frame can always be received into them - the bytes past bufferSize are
+        #moved to the next buffer
+        bufferSize = decryptor.getBytesToDecrypt(max(uploadPipeline.PIPELINE_BUFFER_SIZE, session.frameSize))
+        times = metrics.UploadTimes()
+        pipeline = uploadPipeline.UploadPipeline(decryptor, cksum, file, bufferSize + session.frameSize, times)
+        buffer = None
+        bufferedBytes = 0
+        try:
+            buffer = pipeline.getBuffer()
+            view = memoryview(buffer)
+            bufferedBytes = min(len(data) - request.SIZE, request.contentSize - progress.offset)
+            view[:bufferedBytes] = data[request.SIZE:request.SIZE + bufferedBytes]
+            bytesRead = progress.offset + bufferedBytes
+
+            while True:
+                isLastBlock = bytesRead == request.contentSize
+                if isLastBlock:
+                    pipeline.submit(buffer, bufferedBytes, True)
+                    buffer = None
+                    break
+                if bufferedBytes >= bufferSize:
+                    #The next buffer gets the bytes past bufferSize before this one is submitted (and may be reused)
+                    nextBuffer = pipeline.getBuffer()
+                    nextView = memoryview(nextBuffer)
+                    nextView[:bufferedBytes - bufferSize] = view[bufferSize:bufferedBytes]
+                    pipeline.submit(buffer, bufferSize, False)
+                    buffer, view = nextBuffer, nextView
+                    bufferedBytes -= bufferSize
+
+                start = time.perf_counter()
+                dataSize = session.conn.recv_into(view[bufferedBytes:], getReceiveSize(session, request.contentSize - bytesRead))
+                times.recv += time.perf_counter() - start
+                if dataSize == 0:
+                    raise Exception(f"Connection closed before file {request.fileName} was fully received!")
+                #Padding of the last frame is discarded
+                dataSize = min(dataSize, request.contentSize - bytesRead)
+                bytesRead += dataSize
+                bufferedBytes += dataSize
+        finally:
+            if buffer is not None:
+                pipeline.submit(buffer, decryptor.getBytesToDecrypt(bufferedBytes), False)
+            pipeline.finish()
+            progress.offset += pipeline.encryptedSize
+            progress.decryptedSize += pipeline.decryptedSize
+
+        times.record(pipeline.encryptedSize, pipeline.decryptedSize)
+        return bytesRead
 
     #Handle CRC valid request
-    def handleValidCRCRequest(self, conn, requestHeader, data):
+    def handleValidCRCRequest(self, session, requestHeader, data):
         client = self.database.getClientById(requestHeader.clientID)
         if client is None:
             raise Exception(f"User with id {requestHeader.clientID} doesn't exist!")
@@ -193,22 +705,28 @@ class Handler:
         request = protocol.CRCRequest()
         request.unpack(data)
 
+        #An upload promoted now is stored as verified right away (a single DB write)
+        pending = session.pendingUploads.pop((client.ID, request.fileName), None)
+        if pending is not None:
+            self.promoteUpload(client, pending[0], request.fileName, pending[1], pending[2], True)
+
         file = self.database.getFile(client, request.fileName)
 
         if file is None:
             raise Exception(f"File {request.fileName} doesn't exist for client {client.Name}!")
 
-        self.database.verifyFile(file)
+        if not file.Verified:
+            self.database.verifyFile(file)
 
         # Respond with "Message Receievd". Protocol doesn't clearly define when this is required
         # In this case I chose to response with message received on any valid\invalid CRC request.
         response = protocol.MessageReceivedResponse()
-        self.write(conn, response.pack())
-        print(f"Successful validation of CRC of file: {file.FileName} for client {client.Name}\n")
-        self.done = True
+        self.write(session, response.pack())
+        logging.info("Successful validation of CRC of file: %s for client %s", file.FileName, client.Name)
+        session.done = not session.sessionMode
 
     # Handle CRC invalid request
-    def handleInvalidCRCRequest(self, conn, requestHeader, data):
+    def handleInvalidCRCRequest(self, session, requestHeader, data):
         client = self.database.getClientById(requestHeader.clientID)
         if client is None:
             raise Exception(f"User with id {requestHeader.clientID} doesn't exist!")
@@ -218,28 +736,108 @@ class Handler:
         request = protocol.CRCRequest()
         request.unpack(data)
 
-        file = self.database.getFile(client, request.fileName)
-
-        if file is None:
-            raise Exception(f"File {request.fileName} doesn't exist for client {client.Name}!")
-        if file.Verified:
-            raise Exception(f"File {request.fileName} for client {client.Name} is alrealy verified!")
+        #An upload that wasn't promoted yet is just discarded - the previous version of the file stays as it was
+        pending = session.pendingUploads.pop((client.ID, request.fileName), None)
+        if pending is not None:
+            self.storage.remove(pending[0])
+        else:
+            file = self.database.getFile(client, request.fileName)
 
-        path = self.clientFilesFolder + "/" + client.ID.hex()
-        filePath = path + "/" + request.fileName
-        if os.path.exists(filePath):
-            os.remove(filePath)
+            if file is None:
+                raise Exception(f"File {request.fileName} doesn't exist for client {client.Name}!")
+            if file.Verified:
+                raise Exception(f"File {request.fileName} for client {client.Name} is alrealy verified!")
 
-        self.database.removeFile(file)
+            self.storage.remove(self.storage.getFilePath(client.ID, request.fileName))
+            self.database.removeFile(file)
 
         #Respond with "Message Receievd". Protocol doesn't clearly define when this is required
         #In this case I chose to response with message received on any valid\invalid CRC request.
         response = protocol.MessageReceivedResponse()
-        self.write(conn, response.pack())
-        print(f"File: {file.FileName} of client {client.Name} removed due to invalid CRC\n")
+        self.write(session, response.pack())
+        logging.info("File: %s of client %s removed due to invalid CRC", request.fileName, client.Name)
 
     # Handle last CRC invalid request (No more attempts to send the file are expected)
-    def handleLastInvalidCRCRequest(self, conn, requestHeader, data):
-        self.handleInvalidCRCRequest(conn, requestHeader, data)
-        print("Last invalid CRC. No more attempts expected\n")
-        self.done = True
\ No newline at end of file
+    def handleLastInvalidCRCRequest(self, session, requestHeader, data):
+        self.handleInvalidCRCRequest(session, requestHeader, data)
+        logging.info("Last invalid CRC. No more attempts expected")
+        session.done = not session.sessionMode
+
+    #Handle large frame mode request (version 4). Client content is read in frames of the accepted size from now on,
+    #and responses are not padded anymore (starting with this response)
+    def handleLargeFrameRequest(self, session, requestHeader, data):
+        if requestHeader.version < protocol.LARGE_FRAME_VERSION:
+            raise Exception(f"Large frame mode requires version {protocol.LARGE_FRAME_VERSION}, got {requestHeader.version}!")
+
+        request = protocol.LargeFrameRequest()
+        request.unpack(data)
+
+        session.frameSize = max(protocol.PACKET_SIZE, min(request.frameSize, protocol.MAX_LARGE_FRAME_SIZE))
+        session.padResponses = False
+
+        response = protocol.LargeFrameResponse()
+        response.frameSize = session.frameSize
+        self.write(session, response.pack())
+
+    #Handle session mode request (version 6) - keep the connection open after CRC requests, until the client closes it
+    def handleSessionModeRequest(self, session, requestHeader, data):
+        if requestHeader.version < protocol.SESSION_VERSION:
+            raise Exception(f"Session mode requires version {protocol.SESSION_VERSION}, got {requestHeader.version}!")
+
+        session.sessionMode = True
+        response = protocol.SessionModeResponse()
+        self.write(session, response.pack())
+
+    #Handle send batch request (version 6). All files are received before any of them is promoted, so an interrupted batch
+    #changes nothing. The files with a valid CRC are then saved together, and the status of each file is returned
+    def handleSendBatchRequest(self, session, requestHeader, data):
+        if requestHeader.version < protocol.SESSION_VERSION:
+            raise Exception(f"Batch uploads require version {protocol.SESSION_VERSION}, got {requestHeader.version}!")
+
+        client = self.database.getClientById(requestHeader.clientID)
+        if client is None:
+            raise Exception(f"User with id {requestHeader.clientID} doesn't exist!")
+
+        self.database.updateClientLastSeen(client)
+
+        if client.AES is None:
+            raise Exception(f"User with id {requestHeader.clientID} doesn't have AES key yet!")
+
+        reader = PayloadReader(session.conn, data, requestHeader.payloadSize)
+        request = protocol.SendBatchRequest()
+        request.unpack(reader.read(request.SIZE))
+        checkUploadLimits(client, requestHeader.payloadSize, self.maxContentSize, self.rateLimiter, request.fileCount)
+
+        response = protocol.BatchReceivedResponse()
+        response.clientID = client.ID
+        storedFiles = []
+        try:
+            for i in range(request.fileCount):
+                fileHeader = protocol.BatchFileHeader()
+                fileHeader.unpack(reader.read(fileHeader.SIZE))
+                status, checksum, stored = storeBatchFile(self.storage, client, fileHeader, reader.read(fileHeader.contentSize))
+                response.files.append((fileHeader.fileName, status, checksum))
+                if stored is not None:
+                    storedFiles.append(stored)
+        except Exception:
+            for stored in storedFiles:
+                self.storage.remove(stored[0])
+            raise
+
+        #The batch replaces unconfirmed and interrupted uploads of its files
+        for tempPath, fileName, contentHash, codec in storedFiles:
+            pending = session.pendingUploads.pop((client.ID, fileName), None)
+            if pending is not None:
+                self.storage.remove(pending[0])
+            self.uploads.discard(client, fileName)
+        saveBatch(self.storage, self.database, client, storedFiles)
+
+        self.write(session, response.pack())
+        logging.info("Successful batch upload for client: %s, Files: %d, Saved: %d", client.Name, request.fileCount, len(storedFiles))
+
+    #Flush pending storage and DB updates. Should be called on shutdown
+    def close(self):
+        self.profiler.close()
+        self.multiStreamUploads.close()
+        self.storage.close()
+        self.database.close()
\ No newline at end of file
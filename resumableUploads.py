@@ -0,0 +1,96 @@
+import logging
+import os
+import time
+import crc
+import cryptUtil
+import database
+import storageCodec
+
+#Progress of an upload: the number of encrypted bytes which were decrypted and written (offset), and the number of
+#plaintext bytes written (decryptedSize)
+class UploadProgress:
+    def __init__(self, offset=0, decryptedSize=0):
+        self.offset = offset
+        self.decryptedSize = decryptedSize
+
+#Interrupted uploads, kept so clients can resume them (protocol version 5) instead of sending the file again.
+#When an upload is interrupted, the received part is kept in its temp file, and the decryption and CRC state after it
+#are saved in the DB. Only whole AES blocks which were decrypted and written count as received.
+#Uploads compressed with a storage codec can't be resumed (the compressor state can't be saved). Interrupted uploads
+#are removed when the same file is uploaded again, when the client gets a new AES key, and after ttl seconds
+#(0 disables resumable uploads)
+class ResumableUploads:
+    def __init__(self, database, storage, ttl=0):
+        self.database = database
+        self.storage = storage
+        self.ttl = ttl
+
+    #Temp files of interrupted uploads (to keep on storage cleanup)
+    def getTempPaths(self):
+        return {upload.TempPath for upload in self.database.getUploads()}
+
+    #Content size and offset of the interrupted upload of fileName by client ((0, 0) if there is none)
+    def getOffset(self, client, fileName):
+        upload = self.database.getUpload(client, fileName)
+        if upload is None or self.isExpired(upload):
+            return 0, 0
+        return upload.ContentSize, upload.Offset
+
+    def isExpired(self, upload):
+        return time.time() - upload.Time > self.ttl
+
+    #Save the state of an interrupted upload. The temp file is removed if the upload can't be resumed
+    def interrupt(self, client, request, codec, file, tempPath, progress, decryptor, cksum):
+        try:
+            if self.ttl > 0 and codec == storageCodec.CODEC_NONE and progress.offset > 0:
+                self.storage.syncFile(file)
+                self.database.saveUpload(database.Upload(client.ID, request.fileName, tempPath, request.contentSize, progress.offset,
+                                                         progress.decryptedSize, decryptor.lastBlock, cksum.getState()[0], time.time()))
+                logging.info("Upload of file %s for client %s interrupted after %d bytes", request.fileName, client.Name, progress.offset)
+                self.removeExpired()
+                return
+        except Exception as e:
+            logging.exception("Exception while saving interrupted upload of %s: %s", request.fileName, e)
+        self.storage.remove(tempPath)
+
+    #Take the interrupted upload a client resumes with request (so it can't be resumed twice at the same time).
+    #Returns the temp file (open for writing the rest of the content) and its path, and the decryptor, checksum and
+    #progress, restored to their state when the upload was interrupted
+    def resume(self, client, request, crcExecutor=None):
+        upload = self.database.getUpload(client, request.fileName)
+        if upload is None or self.isExpired(upload) or not os.path.exists(upload.TempPath):
+            raise Exception(f"There is no upload of file {request.fileName} for client {client.Name} to resume!")
+        if upload.ContentSize != request.contentSize or upload.Offset != request.offset:
+            raise Exception(f"Upload of file {request.fileName} for client {client.Name} can only be resumed from offset {upload.Offset} of {upload.ContentSize}!")
+        if self.database.takeUpload(client.ID, request.fileName) is not upload:
+            raise Exception(f"Upload of file {request.fileName} for client {client.Name} is already resumed!")
+
+        file = self.storage.openTempFile(upload.TempPath, upload.DecryptedSize)
+        try:
+            cksum = self.storage.createChecksum(crc.createChecksum(request.contentSize, crcExecutor))
+            self.storage.restoreChecksum(cksum, (upload.CRC, upload.DecryptedSize), file, upload.DecryptedSize)
+        except Exception:
+            file.close()
+            self.storage.remove(upload.TempPath)
+            raise
+        decryptor = cryptUtil.AESDecrypt(client.AES, upload.LastBlock)
+        return file, upload.TempPath, decryptor, cksum, UploadProgress(upload.Offset, upload.DecryptedSize)
+
+    #Remove the interrupted upload of fileName by client (when the file is uploaded again from the start)
+    def discard(self, client, fileName):
+        upload = self.database.takeUpload(client.ID, fileName)
+        if upload is not None:
+            self.storage.remove(upload.TempPath)
+
+    #Remove all interrupted uploads of client - when it gets a new AES key, the rest of the content can't be decrypted
+    #with the saved state anymore
+    def discardClient(self, client):
+        for upload in self.database.getUploads():
+            if upload.ID == client.ID:
+                self.discard(client, upload.FileName)
+
+    #Remove interrupted uploads older than ttl
+    def removeExpired(self):
+        for upload in self.database.getUploads():
+            if self.isExpired(upload) and self.database.takeUpload(upload.ID, upload.FileName) is upload:
+                self.storage.remove(upload.TempPath)
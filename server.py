@@ -1,44 +1,156 @@
+import logging
+import metrics
 import requestHandler
 import selectors
+import serverLogging
+import signal
 import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 
 DATABASE_FILE = "server.db"
 CLIENT_FILES_FILDER = "files"
 QUEUE_SIZE = 100
+#Maximum number of connections handled at the same time. Other ready connections wait for a free worker
+MAX_WORKERS = 32
+#Maximum number of open connections (handled or waiting for a worker). Connections above it are closed as soon as they are accepted
+MAX_CONNECTIONS = 1000
+#Seconds a connection may wait for its first request, and a read or write may wait for the client, before the connection
+#is closed (0 - no timeout)
+SOCKET_TIMEOUT = 120
+#Maximal size of an upload - larger uploads are rejected before their content is read, and multi-stream uploads before
+#their file is preallocated (0 - no limit)
+MAX_CONTENT_SIZE = 2 * 1024 * 1024 * 1024
+#Upload rate limits per client (rateLimit.ClientRateLimiter): uploads and bytes per second (0 - no limit), and their bursts
+RATE_LIMIT_OPTIONS = {"uploadsPerSecond": 50, "uploadBurst": 200, "bytesPerSecond": 64 * 1024 * 1024, "byteBurst": 256 * 1024 * 1024}
+#Number of threads calculating CRC of large uploads in parallel with receiving them (0 to calculate inline)
+CRC_WORKERS = 4
+#Database options. With lazyLoad the server starts without loading the whole DB, and caches up to cacheSize entries
+DATABASE_OPTIONS = {"lazyLoad": False, "cacheSize": 100000, "warmUp": True}
+#Seconds during which a client presenting the same public key again gets its current AES key (0 - always a new key)
+KEY_REUSE_TTL = 0
+#Storage options. Uploads are promoted to their final path with an atomic rename on CRC confirmation (promoteOnVerify),
+#fsyncPolicy is one of storage.FSYNC_NONE, FSYNC_FILE, FSYNC_FULL, FSYNC_BATCHED.
+#With dedupe, identical content is stored once (client files are hard links to a content addressed store).
+#compression chooses the storage codec (storageCodec.CODEC_*) of uploads - by client name, else by file extension, else default
+STORAGE_OPTIONS = {"fsyncPolicy": "batched", "promoteOnVerify": True, "dedupe": False,
+                   "compression": {"default": "none", "extensions": {}, "clients": {}}}
+#Seconds during which an interrupted upload is kept so the client can resume it (0 - interrupted uploads are discarded)
+RESUME_TTL = 24 * 60 * 60
+#Maximal number of responses to pipelined requests (protocol version 7) waiting to be written on a connection
+RESPONSE_WINDOW = 16
+#Seconds after which a multi-stream upload (protocol version 8) without activity is removed
+MULTI_STREAM_TTL = 60 * 60
+#Maximal number of multi-stream uploads in progress per client - their files are preallocated when they start, up to
+#MAX_CONTENT_SIZE each (0 - no limit)
+MAX_MULTI_STREAM_UPLOADS = 4
+#Pad responses to 1024 bytes (protocol.PACKET_SIZE), the framing current clients expect. Disable only when all clients
+#read responses by their payload size
+PAD_RESPONSES = True
+#Metrics (metrics.py) are served in the Prometheus text format at http://localhost:port/metrics (port 0 - disabled),
+#and/or written to dumpFile every dumpInterval seconds
+METRICS_OPTIONS = {"port": 0, "dumpFile": None, "dumpInterval": 60}
+#Profiling of request handlers (profiler.py): a sample (sampleRate) of connections is profiled, and stats per request code
+#are written to dumpFolder when profiling stops. It is toggled with SIGUSR1, or POST /profiler/start and /profiler/stop on
+#the metrics port
+PROFILER_OPTIONS = {"sampleRate": 0.1, "dumpFolder": "profiles", "enabled": False}
+#Logging (serverLogging.py): records are written by a background thread to file (stdout if None). Errors from the same
+#place in the code are limited to errorsPerMinute, and records are dropped if more than queueSize are waiting
+LOG_OPTIONS = {"level": "INFO", "file": None, "queueSize": 10000, "errorsPerMinute": 10}
+#Receive large files through a staged pipeline (receive / decrypt and CRC / disk write on separate threads)
+PIPELINE_UPLOADS = True
 
 sel = selectors.DefaultSelector()
-handler = requestHandler.Handler(DATABASE_FILE, CLIENT_FILES_FILDER)
+#Created by startServer - importing this module (main.py imports both servers) doesn't load the DB or start threads
+handler = None
+executor = None
+#Number of open connections, and the time (time.monotonic) accepted connections started waiting for their first request
+connections = 0
+connectionsLock = threading.Lock()
+waiting = {}
 
-#Accept new connection
+#Accept new connection, unless there are MAX_CONNECTIONS already
 def accept(sock, mask):
+    global connections
     conn, addr = sock.accept()
     #print('accepted', conn, 'from', addr)
-    conn.setblocking(True)
+    with connectionsLock:
+        if connections >= MAX_CONNECTIONS:
+            conn.close()
+            metrics.connectionRejected("limit")
+            return
+        connections += 1
+    conn.settimeout(SOCKET_TIMEOUT or None)
+    waiting[conn] = time.monotonic()
     sel.register(conn, selectors.EVENT_READ, read)
 
-#Handle connection
+#Connection has data to read - pass it to a worker so the selector loop is never blocked by a slow client
 def read(conn, mask):
-    handler.handle(conn)
     sel.unregister(conn)
-    conn.close()
+    del waiting[conn]
+    executor.submit(serve, conn)
 
+#Close connections which didn't send a request within SOCKET_TIMEOUT
+def closeIdle():
+    global connections
+    deadline = time.monotonic() - SOCKET_TIMEOUT
+    for conn in [conn for conn, start in waiting.items() if start < deadline]:
+        sel.unregister(conn)
+        del waiting[conn]
+        conn.close()
+        metrics.connectionRejected("idle")
+        with connectionsLock:
+            connections -= 1
 
-def startServer(host, port):
+#Handle connection (runs on a worker thread)
+def serve(conn):
+    global connections
     try:
+        handler.handle(conn)
+    finally:
+        conn.close()
+        with connectionsLock:
+            connections -= 1
+
+
+def startServer(host, port, maxWorkers=MAX_WORKERS):
+    global handler, executor
+    exporter = None
+    #Started before the handler, which logs while loading the DB
+    serverLogging.start(**LOG_OPTIONS)
+    try:
+        handler = requestHandler.Handler(DATABASE_FILE, CLIENT_FILES_FILDER, CRC_WORKERS, DATABASE_OPTIONS, KEY_REUSE_TTL, PIPELINE_UPLOADS, STORAGE_OPTIONS,
+                                         RESUME_TTL, RESPONSE_WINDOW, MULTI_STREAM_TTL,
+                                         PAD_RESPONSES, PROFILER_OPTIONS, MAX_CONTENT_SIZE,
+                                         RATE_LIMIT_OPTIONS, MAX_MULTI_STREAM_UPLOADS)
+        executor = ThreadPoolExecutor(max_workers=maxWorkers)
         sock = socket.socket()
         sock.bind((host, port))
         sock.listen(QUEUE_SIZE)
         sock.setblocking(False)
         sel.register(sock, selectors.EVENT_READ, accept)
-        print(f"Server is listening for connections on port {port}...")
+        logging.info("Server is listening for connections on port %d (max %d concurrent connections)...", port, maxWorkers)
+        exporter = metrics.MetricsExporter(profiler=handler.profiler, **METRICS_OPTIONS)
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: handler.profiler.toggle())
         while True:
             try:
-                events = sel.select()
+                events = sel.select(SOCKET_TIMEOUT or None)
                 for key, mask in events:
                     callback = key.data
                     callback(key.fileobj, mask)
+                if SOCKET_TIMEOUT:
+                    closeIdle()
             except Exception as e:
-                print(f"\nException in main loop: {e}\n")
+                logging.exception("Exception in main loop: %s", e)
     except Exception as e:
-        print(f"\nServer start error: {e}\n")
+        logging.error("Server start error: %s", e)
+    finally:
+        if exporter is not None:
+            exporter.close()
+        #Flush write-behind storage and DB updates
+        if handler is not None:
+            handler.close()
+        serverLogging.stop()
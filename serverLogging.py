@@ -0,0 +1,91 @@
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(message)s"
+
+#Handler putting records on the log queue, for the listener thread to write. Records are queued as they are - the
+#message (and traceback) is formatted by the listener, not by the thread logging it. When the queue is full, records
+#are dropped (and counted) instead of blocking the caller
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, logQueue):
+        super().__init__(logQueue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+#Rate limit of errors (and exceptions with their tracebacks): at most maxRecords per interval seconds from each place in
+#the code logging them. The number of suppressed records is logged when the next interval starts
+class ErrorRateLimitFilter(logging.Filter):
+    def __init__(self, maxRecords, interval=60.0):
+        super().__init__()
+        self.maxRecords = maxRecords
+        self.interval = interval
+        self.lock = threading.Lock()
+        #(pathname, lineno) -> [interval start, records in the interval, suppressed records]
+        self.sources = {}
+
+    def filter(self, record):
+        if record.levelno < logging.ERROR or self.maxRecords <= 0:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        suppressed = 0
+        with self.lock:
+            source = self.sources.get(key)
+            if source is None or now - source[0] >= self.interval:
+                if source is not None:
+                    suppressed = source[2]
+                source = self.sources[key] = [now, 0, 0]
+            source[1] += 1
+            if source[1] > self.maxRecords:
+                source[2] += 1
+                return False
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed in the last {self.interval:.0f} seconds)"
+        return True
+
+#Writer thread of the log queue, and the handler of the root logger feeding it
+class LogWriter:
+    def __init__(self, level="INFO", file=None, queueSize=10000, errorsPerMinute=10):
+        output = logging.FileHandler(file) if file else logging.StreamHandler(sys.stdout)
+        output.setFormatter(logging.Formatter(LOG_FORMAT))
+        self.handler = NonBlockingQueueHandler(queue.Queue(queueSize))
+        self.handler.addFilter(ErrorRateLimitFilter(errorsPerMinute))
+        self.listener = logging.handlers.QueueListener(self.handler.queue, output)
+        root = logging.getLogger()
+        root.setLevel(level)
+        root.addHandler(self.handler)
+        self.listener.start()
+
+    #Write the queued records and stop the writer thread
+    def close(self):
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+        if self.handler.dropped:
+            print(f"{self.handler.dropped} log records were dropped because the log queue was full")
+
+writer = None
+
+#Start logging of the server (only the first call starts it)
+def start(**options):
+    global writer
+    if writer is None:
+        writer = LogWriter(**options)
+    return writer
+
+def stop():
+    global writer
+    if writer is not None:
+        writer.close()
+        writer = None
@@ -0,0 +1,263 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from pathlib import Path
+import uploadPipeline
+import storageCodec
+
+#fsync policies:
+#none - no fsync (data is written back by the OS)
+#file - fsync uploaded files before they are renamed to their final path
+#full - like file, and fsync the client folder right after each rename
+#batched - like file, and fsync the folders with renames together every dirSyncInterval seconds
+FSYNC_NONE = "none"
+FSYNC_FILE = "file"
+FSYNC_FULL = "full"
+FSYNC_BATCHED = "batched"
+
+#Uploads are written to "."<file name>"."<random hex>".upload" in the client folder, and renamed when done
+TEMP_FILE_SUFFIX = ".upload"
+TEMP_FILE_PATTERN = re.compile(r"^\..+\.[0-9a-f]{32}\.upload$")
+
+#Folder of the deduplicated store (inside the client files folder, so files can be hard linked to it)
+OBJECTS_FOLDER = ".objects"
+
+#Checksum wrapper which also calculates the content hash (the deduplicated store key) in the same pass over the data
+class HashingChecksum:
+    def __init__(self, cksum):
+        self.cksum = cksum
+        self.hash = hashlib.sha256()
+
+    def update(self, buf):
+        self.cksum.update(buf)
+        self.hash.update(buf)
+
+    def digest(self):
+        return self.cksum.digest()
+
+    #State of the CRC only - a hash state can't be stored, so content is hashed again when the checksum is restored
+    def getState(self):
+        return self.cksum.getState()
+
+    def setState(self, state):
+        self.cksum.setState(state)
+
+    #Hash content which is already covered by the CRC state (without updating the CRC)
+    def hashFile(self, file, size):
+        file.seek(0)
+        while size > 0:
+            data = file.read(min(size, uploadPipeline.WRITE_BUFFER_SIZE))
+            if not data:
+                raise Exception(f"File {file.name} is shorter than the hashed size!")
+            self.hash.update(data)
+            size -= len(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+#Client files storage on disk: files/<client id hex>/<file name>
+#Uploads are staged in a temp file in the client folder and promoted to the final path with an atomic rename, so a failed
+#or interrupted upload never truncates the previous version of the file. With promoteOnVerify, the rename happens only
+#when the client confirms the CRC (otherwise as soon as the upload completes)
+#With dedupe, file content is stored once in a content addressed store (files/.objects/<hash prefix>/<sha256 hash>), and
+#client files are hard links to it. Reference counts are kept in the DB objects table, and content without references
+#is removed by a background garbage collector
+#compression - keyword arguments for storageCodec.CompressionPolicy. Files are compressed while they are written (after
+#the CRC is calculated from the plaintext), with the codec chosen by the policy
+class Storage:
+    def __init__(self, clientFilesFolder, fsyncPolicy=FSYNC_BATCHED, promoteOnVerify=True, dirSyncInterval=1.0, dedupe=False, gcInterval=60.0,
+                 compression=None):
+        if fsyncPolicy not in (FSYNC_NONE, FSYNC_FILE, FSYNC_FULL, FSYNC_BATCHED):
+            raise Exception(f"Unknown fsync policy {fsyncPolicy}!")
+        self.clientFilesFolder = clientFilesFolder
+        self.fsyncPolicy = fsyncPolicy
+        self.promoteOnVerify = promoteOnVerify
+        self.dirSyncInterval = dirSyncInterval
+        self.dedupe = dedupe
+        self.gcInterval = gcInterval
+        self.compressionPolicy = storageCodec.CompressionPolicy(**(compression or {}))
+        self.pendingDirs = set()
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        if fsyncPolicy == FSYNC_BATCHED:
+            threading.Thread(target=self.syncLoop, daemon=True).start()
+
+    def getClientFolder(self, clientId):
+        return self.clientFilesFolder + "/" + clientId.hex()
+
+    def getFilePath(self, clientId, fileName):
+        return self.getClientFolder(clientId) + "/" + fileName
+
+    #New unique temp path for a file in folder
+    def getTempPath(self, folder, fileName):
+        return folder + "/." + fileName + "." + uuid.uuid4().hex + TEMP_FILE_SUFFIX
+
+    #Codec a file uploaded by client is stored with
+    def getCodec(self, client, fileName):
+        return self.compressionPolicy.getCodec(client.Name, fileName)
+
+    #Create temp file for a new upload. Returns the open file (compressing what is written to it, unless codec is
+    #CODEC_NONE) and its path
+    def createTempFile(self, clientId, fileName, codec=storageCodec.CODEC_NONE):
+        path = self.getClientFolder(clientId)
+        Path(path).mkdir(parents=True, exist_ok=True)
+        tempPath = self.getTempPath(path, fileName)
+        file = open(tempPath, "wb+", buffering=uploadPipeline.WRITE_BUFFER_SIZE)
+        if codec != storageCodec.CODEC_NONE:
+            file = storageCodec.CompressedFile(file, codec, self.compressionPolicy.getLevel(codec))
+        return file, tempPath
+
+    #Create a temp file with size bytes allocated, for an upload whose parts are written at their offsets
+    #(multi-stream uploads). Falls back to a sparse file where preallocation is not supported
+    def createPreallocatedFile(self, clientId, fileName, size):
+        file, tempPath = self.createTempFile(clientId, fileName)
+        try:
+            if size > 0 and hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(file.fileno(), 0, size)
+                except OSError:
+                    pass
+            file.truncate(size)
+        except Exception:
+            file.close()
+            self.remove(tempPath)
+            raise
+        return file, tempPath
+
+    #Open the temp file of an interrupted upload to continue writing it after its first size bytes (anything written
+    #after them when the upload was interrupted is truncated)
+    def openTempFile(self, tempPath, size):
+        file = open(tempPath, "r+b", buffering=uploadPipeline.WRITE_BUFFER_SIZE)
+        file.truncate(size)
+        file.seek(size)
+        return file
+
+    #Restore the state of a checksum from createChecksum to the saved state of an interrupted upload, whose first
+    #size bytes are already in file
+    def restoreChecksum(self, cksum, state, file, size):
+        cksum.setState(state)
+        if self.dedupe:
+            cksum.hashFile(file, size)
+            file.seek(size)
+
+    #Make sure the content of a completely written upload file is on disk (according to fsync policy)
+    def syncFile(self, file):
+        file.flush()
+        if self.fsyncPolicy != FSYNC_NONE:
+            os.fsync(file.fileno())
+
+    def getObjectPath(self, contentHash):
+        return self.clientFilesFolder + "/" + OBJECTS_FOLDER + "/" + contentHash[:2] + "/" + contentHash
+
+    #Wrap checksum so it calculates the content hash too, when the deduplicated store is used
+    def createChecksum(self, cksum):
+        return HashingChecksum(cksum) if self.dedupe else cksum
+
+    #Content hash calculated by a checksum from createChecksum (None if the deduplicated store is not used).
+    #The same content stored with different codecs is different content in the store, so the codec is part of its key
+    def getContentHash(self, cksum, codec=storageCodec.CODEC_NONE):
+        if not self.dedupe:
+            return None
+        if codec == storageCodec.CODEC_NONE:
+            return cksum.hexdigest()
+        return cksum.hexdigest() + "." + codec
+
+    #Atomically replace the file at filePath with the upload at tempPath.
+    #With contentHash the upload is moved into the deduplicated store (or dropped, if the content is already there), and
+    #filePath is replaced with a hard link to the stored content
+    def promote(self, tempPath, filePath, contentHash=None):
+        if contentHash is None:
+            os.replace(tempPath, filePath)
+            self.syncDirs([os.path.dirname(filePath)])
+            return
+
+        objectPath = self.getObjectPath(contentHash)
+        Path(os.path.dirname(objectPath)).mkdir(parents=True, exist_ok=True)
+        #Link to a temp path first, so filePath is replaced atomically
+        linkPath = self.getTempPath(os.path.dirname(filePath), os.path.basename(filePath))
+        try:
+            #Content is already stored - the upload isn't needed
+            os.link(objectPath, linkPath)
+            os.remove(tempPath)
+        except FileNotFoundError:
+            os.replace(tempPath, objectPath)
+            os.link(objectPath, linkPath)
+        os.replace(linkPath, filePath)
+        self.syncDirs([os.path.dirname(filePath), os.path.dirname(objectPath)])
+
+    #Sync folders after renames, according to the fsync policy
+    def syncDirs(self, folders):
+        if self.fsyncPolicy == FSYNC_FULL:
+            for folder in folders:
+                self.syncDir(folder)
+        elif self.fsyncPolicy == FSYNC_BATCHED:
+            with self.lock:
+                self.pendingDirs.update(folders)
+
+    #Start removing content without references from the deduplicated store, every gcInterval seconds
+    def startGarbageCollector(self, database):
+        if self.dedupe:
+            threading.Thread(target=self.gcLoop, args=(database,), daemon=True).start()
+
+    def gcLoop(self, database):
+        while not self.closed.wait(self.gcInterval):
+            self.collectGarbage(database)
+
+    #Remove content without references. Client files linked to it are not affected (they are hard links)
+    def collectGarbage(self, database):
+        for contentHash in database.takeUnreferencedObjects():
+            try:
+                self.remove(self.getObjectPath(contentHash))
+            except Exception as e:
+                logging.exception('Exception while removing stored content %s: %s', contentHash, e)
+
+    #Remove a file (or temp file) if it exists
+    def remove(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    def syncDir(self, folder):
+        fd = os.open(folder, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    #fsync all folders with renames since the last call
+    def flushDirs(self):
+        with self.lock:
+            folders = self.pendingDirs
+            self.pendingDirs = set()
+        for folder in folders:
+            try:
+                self.syncDir(folder)
+            except Exception as e:
+                logging.exception('Exception while syncing folder %s: %s', folder, e)
+
+    def syncLoop(self):
+        while not self.closed.wait(self.dirSyncInterval):
+            self.flushDirs()
+
+    #Remove temp files left by uploads that were interrupted (e.g. by a crash), except those in keep (interrupted uploads
+    #that can be resumed). Should be called on startup
+    def cleanup(self, keep=()):
+        start = time.perf_counter()
+        removed = 0
+        if os.path.isdir(self.clientFilesFolder):
+            for clientFolder in os.scandir(self.clientFilesFolder):
+                if not clientFolder.is_dir() or clientFolder.name == OBJECTS_FOLDER:
+                    continue
+                for entry in os.scandir(clientFolder.path):
+                    if entry.is_file() and TEMP_FILE_PATTERN.match(entry.name) and entry.path not in keep:
+                        os.remove(entry.path)
+                        removed += 1
+        logging.info("Removed %d interrupted uploads in %.2f seconds", removed, time.perf_counter() - start)
+
+    #Flush pending folder syncs. Should be called on shutdown
+    def close(self):
+        self.closed.set()
+        self.flushDirs()
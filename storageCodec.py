@@ -0,0 +1,101 @@
+import logging
+import lzma
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#Storage codecs. Files are stored as they were uploaded (none), or compressed with one of the others
+CODEC_NONE = "none"
+CODEC_ZLIB = "zlib"
+CODEC_LZMA = "lzma"
+CODEC_ZSTD = "zstd"
+CODECS = (CODEC_NONE, CODEC_ZLIB, CODEC_LZMA, CODEC_ZSTD)
+
+#Default compression levels - fast ones, compression runs while the upload is received
+DEFAULT_LEVELS = {CODEC_ZLIB: 1, CODEC_LZMA: 0, CODEC_ZSTD: 3}
+
+def isAvailable(codec):
+    return codec in CODECS and (codec != CODEC_ZSTD or zstandard is not None)
+
+#Streaming compressor for codec. All compressors have compress(data) and flush() (ends the stream)
+def createCompressor(codec, level=None):
+    if level is None:
+        level = DEFAULT_LEVELS.get(codec)
+    if codec == CODEC_ZLIB:
+        return zlib.compressobj(level)
+    if codec == CODEC_LZMA:
+        return lzma.LZMACompressor(preset=level)
+    if codec == CODEC_ZSTD and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise Exception(f"Codec {codec} is not available!")
+
+#Streaming decompressor for codec. All decompressors have decompress(data)
+def createDecompressor(codec):
+    if codec == CODEC_ZLIB:
+        return zlib.decompressobj()
+    if codec == CODEC_LZMA:
+        return lzma.LZMADecompressor()
+    if codec == CODEC_ZSTD and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise Exception(f"Codec {codec} is not available!")
+
+#File wrapper compressing everything written to it. flush ends the compressed stream, so it is called once, when all
+#the content was written. rawSize and compressedSize count the bytes written before and after compression
+class CompressedFile:
+    def __init__(self, file, codec, level=None):
+        self.file = file
+        self.codec = codec
+        self.compressor = createCompressor(codec, level)
+        self.rawSize = 0
+        self.compressedSize = 0
+
+    def write(self, data):
+        self.rawSize += len(data)
+        compressed = self.compressor.compress(data)
+        if compressed:
+            self.compressedSize += len(compressed)
+            self.file.write(compressed)
+
+    def flush(self):
+        if self.compressor is not None:
+            compressed = self.compressor.flush()
+            self.compressedSize += len(compressed)
+            self.file.write(compressed)
+            self.compressor = None
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+#Chooses the codec of an uploaded file: by client name (clients), else by file extension (extensions, e.g. {".log": "zlib"}),
+#else default. levels overrides DEFAULT_LEVELS per codec. zstd falls back to zlib when zstandard is not installed
+class CompressionPolicy:
+    def __init__(self, default=CODEC_NONE, extensions=None, clients=None, levels=None):
+        self.default = self.checkCodec(default)
+        self.extensions = {extension.lower(): self.checkCodec(codec) for extension, codec in (extensions or {}).items()}
+        self.clients = {name: self.checkCodec(codec) for name, codec in (clients or {}).items()}
+        self.levels = levels or {}
+
+    def checkCodec(self, codec):
+        if codec not in CODECS:
+            raise Exception(f"Unknown codec {codec}!")
+        if not isAvailable(codec):
+            logging.warning("Codec %s is not available (zstandard is not installed), using %s instead", codec, CODEC_ZLIB)
+            return CODEC_ZLIB
+        return codec
+
+    def getCodec(self, clientName, fileName):
+        codec = self.clients.get(clientName)
+        if codec is None:
+            codec = self.extensions.get(os.path.splitext(fileName)[1].lower(), self.default)
+        return codec
+
+    def getLevel(self, codec):
+        return self.levels.get(codec)
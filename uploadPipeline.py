@@ -0,0 +1,90 @@
+import queue
+import threading
+import time
+
+#Size of the file write buffer. Small decrypted chunks are coalesced into writes of this size
+WRITE_BUFFER_SIZE = 1024 * 1024
+#Size of the buffers passed between stages
+PIPELINE_BUFFER_SIZE = 256 * 1024
+#Only content at least this big is received through the pipeline - for smaller files starting the threads costs more
+PIPELINE_MIN_SIZE = 1024 * 1024
+
+#Staged upload pipeline: receive (caller thread) -> decrypt and CRC (own thread) -> disk write (own thread)
+#Stages are connected with bounded queues, so a slow stage applies backpressure to the previous ones without blocking
+#the others. Received data is passed in a fixed pool of preallocated buffers: the receiving stage blocks in getBuffer
+#when all buffers are in use.
+class UploadPipeline:
+    def __init__(self, decryptor, cksum, file, bufferSize, times, queueSize=8):
+        self.decryptor = decryptor
+        self.cksum = cksum
+        self.file = file
+        self.freeBuffers = queue.Queue()
+        for i in range(queueSize):
+            self.freeBuffers.put(bytearray(bufferSize))
+        self.decryptQueue = queue.Queue(queueSize)
+        self.writeQueue = queue.Queue(queueSize)
+        #Encrypted bytes decrypted, and the size of the decrypted data
+        self.encryptedSize = 0
+        self.decryptedSize = 0
+        #Time spent by the stages (metrics.UploadTimes)
+        self.times = times
+        self.error = None
+        self.threads = [threading.Thread(target=self.decryptStage, daemon=True), threading.Thread(target=self.writeStage, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    #Get a free buffer to receive data into. Raises if a later stage failed
+    def getBuffer(self):
+        if self.error is not None:
+            raise self.error
+        return self.freeBuffers.get()
+
+    #Pass received data (size bytes in buffer, must be a multiple of AES block size) to the decrypt stage
+    def submit(self, buffer, size, isLastBlock):
+        self.decryptQueue.put((buffer, size, isLastBlock))
+
+    #Wait for all submitted data to be written. Returns the total decrypted size
+    def finish(self):
+        self.decryptQueue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.decryptedSize
+
+    def decryptStage(self):
+        while True:
+            item = self.decryptQueue.get()
+            if item is None:
+                break
+            buffer, size, isLastBlock = item
+            try:
+                #After an error items are only drained, so the receiving stage doesn't block
+                if self.error is None:
+                    start = time.perf_counter()
+                    decrypted = self.decryptor.decrypt(memoryview(buffer)[:size], isLastBlock)
+                    decryptEnd = time.perf_counter()
+                    self.cksum.update(decrypted)
+                    self.times.decrypt += decryptEnd - start
+                    self.times.crc += time.perf_counter() - decryptEnd
+                    self.encryptedSize += size
+                    self.decryptedSize += len(decrypted)
+                    self.writeQueue.put(decrypted)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.freeBuffers.put(buffer)
+        self.writeQueue.put(None)
+
+    def writeStage(self):
+        while True:
+            decrypted = self.writeQueue.get()
+            if decrypted is None:
+                break
+            try:
+                if self.error is None:
+                    start = time.perf_counter()
+                    self.file.write(decrypted)
+                    self.times.write += time.perf_counter() - start
+            except Exception as e:
+                self.error = e